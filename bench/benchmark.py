@@ -0,0 +1,335 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmarks against the local stand-in server, see standin.py.
+#
+# Scenarios:
+#   download  one subreddit through redditdownload.download() (or
+#             asyncdownload.download() with --engine asyncio) in a forked
+#             process
+#   run       a full run of redditdl.py over --lists lists with
+#             --subreddits subreddits each
+#
+# Every scenario is run --repeat times into a fresh directory. Reported are
+# the wall time, files and bytes written, requests answered by the stand-in
+# and the peak resident set size of the largest process.
+#
+# reddit's minimum of 2 seconds between listing requests does not apply to
+# the stand-in, the listings are throttled by --flood-timeout instead. The
+# image and album hosts get --host-rate requests per second, so the rate
+# limiter does not hide the speed of the code.
+#
+# Usage: python bench/benchmark.py [options] [download|run]...
+
+import json
+import logging
+import multiprocessing
+import optparse
+import os
+import resource
+import shlex
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), "src")
+sys.path.insert(0, SRC_DIR)
+
+import standin
+
+SCENARIO_DOWNLOAD = "download"
+SCENARIO_RUN = "run"
+SCENARIOS = (SCENARIO_DOWNLOAD, SCENARIO_RUN)
+ENGINE_PROCESSES = "processes"
+ENGINE_ASYNCIO = "asyncio"
+DEFAULT_ENGINE = ENGINE_PROCESSES
+DEFAULT_LISTS = 2
+DEFAULT_SUBREDDITS = 4
+DEFAULT_PROCESSES = 4
+DEFAULT_FLOOD_TIMEOUT = 10
+DEFAULT_REPEAT = 1
+DEFAULT_HOST_RATE = 10000.0
+# Hosts of the stand-in that are limited to --host-rate.
+HOSTS = ("imgur.com", "i.imgur.com", standin.IMAGE_HOST, standin.PAGE_HOST)
+
+# Runs redditdl.py without reddit's minimum listing timeout. The workers are
+# forked, so they inherit it.
+RUN_WRAPPER = """
+import runpy, sys
+sys.path.insert(0, {src!r})
+import RedditImageGrab.reddit
+RedditImageGrab.reddit.REDDIT_MIN_TIMEOUT = 1
+sys.argv = [{script!r}] + sys.argv[1:]
+runpy.run_path({script!r}, run_name="__main__")
+"""
+
+
+def start_standin(options):
+    # Returns (process, port) of a new stand-in server.
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(BENCH_DIR, "standin.py")] +
+        standin.get_arguments(options), stdout=subprocess.PIPE)
+    port = int(process.stdout.readline())
+    return (process, port)
+
+
+def get_standin_stats(port, reset=False):
+    url = "http://127.0.0.1:%d/_stats%s" % (port, "?reset=1" if reset else "")
+    # The stand-in must not be asked through itself.
+    opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+    with opener.open(url) as response:
+        return json.loads(response.read().decode("utf-8"))
+
+
+def get_proxy_environment(port):
+    environment = dict(os.environ)
+    proxy = "http://127.0.0.1:%d" % port
+    for name in ("HTTP_PROXY", "http_proxy"):
+        environment[name] = proxy
+    for name in ("NO_PROXY", "no_proxy"):
+        environment.pop(name, None)
+    return environment
+
+
+def get_disk_usage(directory):
+    # Returns (files, bytes) of the downloaded files below directory. Index,
+    # part files and caches start with a dot and are not counted.
+    files = 0
+    size = 0
+    for (root, dirs, names) in os.walk(directory):
+        dirs[:] = [name for name in dirs if not name.startswith(".")]
+        for name in names:
+            if name.startswith(".") or name.endswith(".list"):
+                continue
+            files += 1
+            size += os.path.getsize(os.path.join(root, name))
+    return (files, size)
+
+
+def get_host_rates(options):
+    # [(host, rate, burst), ...] for the hosts of the stand-in
+    if not options.host_rate:
+        return []
+    burst = max(1, int(options.host_rate))
+    return [(host, options.host_rate, burst) for host in HOSTS]
+
+
+def setup_child_logging(verbose):
+    # redditdl.py normally adds the VERBOSE level.
+    logging.VERBOSE = 15
+    logging.addLevelName(logging.VERBOSE, "VERBOSE")
+    logging.Logger.verbose = \
+        lambda obj, msg, *args, **kwargs: \
+        obj.log(logging.VERBOSE, msg, *args, **kwargs)
+    logger = logging.getLogger()
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter(
+        fmt="[{asctime}] [{levelname}] {message}", style='{'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.VERBOSE if verbose else logging.WARNING)
+
+
+def _download_child(outqueue, options, destination, port):
+    # Runs in a forked process, so every repetition starts with new sessions
+    # and a fresh peak memory.
+    os.environ.update(get_proxy_environment(port))
+    setup_child_logging(options.verbose)
+    import RedditImageGrab.ratelimit
+    import RedditImageGrab.reddit
+    import RedditImageGrab.redditdownload
+    RedditImageGrab.reddit.REDDIT_MIN_TIMEOUT = 1
+    for (host, rate, burst) in get_host_rates(options):
+        RedditImageGrab.ratelimit.limiter.set_rate(host, rate, burst)
+    RedditImageGrab.reddit.set_rate(options.flood_timeout)
+    arguments = {"last": "", "score": 0, "num": 0, "update": False,
+                 "sfw": False, "nsfw": False, "regex": None,
+                 "verbose": options.verbose, "quiet": not options.verbose,
+                 "timeout": options.flood_timeout}
+    if options.engine == ENGINE_ASYNCIO:
+        import asyncio
+        import RedditImageGrab.asyncdownload
+        result = asyncio.run(RedditImageGrab.asyncdownload.download(
+            "bench0", destination, **arguments))
+    else:
+        result = RedditImageGrab.redditdownload.download(
+            "bench0", destination, **arguments)
+    outqueue.put((result,
+                  resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def run_download(options, destination, port):
+    # Returns the peak RSS in KiB.
+    outqueue = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=_download_child, args=(outqueue, options, destination, port))
+    process.start()
+    (_, peak_rss) = outqueue.get()
+    process.join()
+    return peak_rss
+
+
+def run_full(options, destination, port):
+    # Returns the peak RSS in KiB of the largest process of the run.
+    lists = os.path.join(destination, "lists")
+    os.makedirs(lists)
+    for list_number in range(options.lists):
+        with open(os.path.join(lists, "list%d.list" % list_number),
+                  "w") as list_file:
+            for subreddit_number in range(options.subreddits):
+                list_file.write("bench%d_%d\n" % (list_number,
+                                                  subreddit_number))
+    script = os.path.join(SRC_DIR, "redditdl.py")
+    command = [sys.executable, "-c",
+               RUN_WRAPPER.format(src=SRC_DIR, script=script),
+               "-d", destination, "-p", str(options.processes),
+               "--engine", options.engine,
+               "--flood-timeout", str(options.flood_timeout),
+               "--no-log", "-q"]
+    for (host, rate, burst) in get_host_rates(options):
+        command.extend(["--host-rate", "%s=%s/%d" % (host, rate, burst)])
+    if options.verbose:
+        command.append("-v")
+    command.extend(shlex.split(options.run_args))
+    command.append(lists)
+    process = subprocess.Popen(command, env=get_proxy_environment(port),
+                               cwd=SRC_DIR)
+    # The rusage of a child includes the children it has waited for.
+    (_, status, usage) = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise RuntimeError("redditdl.py exited with %d" % process.returncode)
+    return usage.ru_maxrss
+
+
+RUNNERS = {SCENARIO_DOWNLOAD: run_download,
+           SCENARIO_RUN: run_full}
+
+
+def run_scenario(scenario, options, port):
+    destination = tempfile.mkdtemp(prefix="reddit-download-bench-")
+    try:
+        get_standin_stats(port, reset=True)
+        start = time.monotonic()
+        peak_rss = RUNNERS[scenario](options, destination, port)
+        elapsed = time.monotonic() - start
+        stats = get_standin_stats(port)
+        (files, size) = get_disk_usage(destination)
+    finally:
+        shutil.rmtree(destination, ignore_errors=True)
+    return {"scenario": scenario,
+            "engine": options.engine,
+            "seconds": elapsed,
+            "files": files,
+            "bytes": size,
+            "requests": stats["total_requests"],
+            "requests_by_kind": stats["requests"],
+            "bytes_sent": stats["bytes_sent"],
+            "files_per_second": files / elapsed,
+            "megabytes_per_second": size / elapsed / (1024 * 1024),
+            "requests_per_second": stats["total_requests"] / elapsed,
+            "peak_rss_kib": peak_rss}
+
+
+def summarize(results):
+    # Median of the repetitions of one scenario.
+    summary = dict(results[0])
+    for key in ("seconds", "files_per_second", "megabytes_per_second",
+                "requests_per_second", "peak_rss_kib"):
+        summary[key] = statistics.median(result[key] for result in results)
+    summary["repeat"] = len(results)
+    return summary
+
+
+def format_result(result):
+    return ("{scenario:<9} {engine:<9} {seconds:8.2f} s {files:6d} files "
+            "{megabytes_per_second:8.2f} MiB/s {files_per_second:8.1f} "
+            "files/s {requests_per_second:8.1f} req/s  peak {peak:.1f} "
+            "MiB".format(peak=result["peak_rss_kib"] / 1024.0, **result))
+
+
+if __name__ == '__main__':
+    usage = "Usage: %prog [options] [{0}]...".format("|".join(SCENARIOS))
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("--engine", action="store", type="choice",
+                      dest="engine", default=DEFAULT_ENGINE,
+                      choices=[ENGINE_PROCESSES, ENGINE_ASYNCIO],
+                      help="download engine [default: %default]")
+    parser.add_option("--lists", action="store", type="int", dest="lists",
+                      default=DEFAULT_LISTS, metavar="NUM",
+                      help="lists of the full run [default: %default]")
+    parser.add_option("--subreddits", action="store", type="int",
+                      dest="subreddits", default=DEFAULT_SUBREDDITS,
+                      metavar="NUM", help="subreddits per list of the full "
+                      "run [default: %default]")
+    parser.add_option("-p", "--processes", action="store", type="int",
+                      dest="processes", default=DEFAULT_PROCESSES,
+                      metavar="NUM", help="processes of the full run "
+                      "[default: %default]")
+    parser.add_option("--flood-timeout", action="store", type="int",
+                      dest="flood_timeout", default=DEFAULT_FLOOD_TIMEOUT,
+                      metavar="MILLISECONDS", help="time between listing "
+                      "requests [default: %default]")
+    parser.add_option("--host-rate", action="store", type="float",
+                      dest="host_rate", default=DEFAULT_HOST_RATE,
+                      metavar="RATE", help="requests per second to the "
+                      "image and album hosts, 0 keeps the limits of the "
+                      "downloader [default: %default]")
+    parser.add_option("--run-args", action="store", type="string",
+                      dest="run_args", default="", metavar="ARGS",
+                      help="additional options for redditdl.py in the full "
+                      "run, e.g. \"--dedup --cache\"")
+    parser.add_option("--repeat", action="store", type="int", dest="repeat",
+                      default=DEFAULT_REPEAT, metavar="NUM",
+                      help="run every scenario NUM times and report the "
+                      "median [default: %default]")
+    parser.add_option("--json", action="store_true", dest="json",
+                      default=False, help="print the results as JSON")
+    parser.add_option("-v", "--verbose", action="store_true", dest="verbose",
+                      default=False, help="show the log of the downloads")
+    standin.add_options(parser)
+    (options, args) = parser.parse_args()
+
+    scenarios = args or list(SCENARIOS)
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            parser.error("unknown scenario \"{0}\"".format(scenario))
+    if options.repeat < 1 or options.flood_timeout < 1:
+        parser.error("--repeat and --flood-timeout must be at least 1")
+    if options.host_rate < 0:
+        parser.error("--host-rate must not be negative")
+
+    (server, port) = start_standin(options)
+    try:
+        summaries = list()
+        for scenario in scenarios:
+            results = [run_scenario(scenario, options, port)
+                       for _ in range(options.repeat)]
+            summary = summarize(results)
+            summaries.append(summary)
+            if not options.json:
+                print(format_result(summary), flush=True)
+        if options.json:
+            print(json.dumps(summaries, indent=2, sort_keys=True))
+    finally:
+        server.terminate()
+        server.wait()
@@ -0,0 +1,331 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Local stand-in for reddit, imgur and image hosts.
+#
+# The server is used as HTTP proxy (HTTP_PROXY=http://127.0.0.1:PORT), so the
+# downloader talks to its usual URLs and everything ends up here:
+#
+#   www.reddit.com/r/SUB[/SORT].json  listing of --links links, paginated by
+#                                     "limit" (at most 100) and "after"
+#   www.reddit.com/r/A+B[/SORT].json  combined listing, the --links links of
+#                                     every subreddit taking turns
+#   imgur.com/a/ID                    album page with --album-size images
+#   pages.bench.test/...              HTML page with an image URL
+#   anything else                     image of --min-size to --max-size bytes
+#
+# Links, albums and image sizes only depend on their URL, so every run sees
+# the same data. GET /_stats on the server itself returns the counters as
+# JSON, /_stats?reset=1 resets them afterwards.
+#
+# Usage: python standin.py [options]
+# The first line written to stdout is the port the server listens on.
+
+import http.server
+import json
+import optparse
+import random
+import sys
+import threading
+import time
+import urllib.parse
+import zlib
+
+DEFAULT_PORT = 0
+DEFAULT_LINKS = 200
+DEFAULT_ALBUM_RATIO = 0.1
+DEFAULT_ALBUM_SIZE = 5
+DEFAULT_PAGE_RATIO = 0.0
+DEFAULT_MIN_SIZE = 50 * 1024
+DEFAULT_MAX_SIZE = 500 * 1024
+DEFAULT_LATENCY = 0.0
+DEFAULT_ERROR_RATE = 0.0
+# reddit returns at most 100 links per page
+MAX_PAGE_SIZE = 100
+DEFAULT_PAGE_SIZE = 25
+# Fullnames count down from here, so the first link is the newest one.
+ID_BASE = 36 ** 6
+IMAGE_HOST = "i.bench.test"
+PAGE_HOST = "pages.bench.test"
+JPEG_MAGIC = b"\xff\xd8\xff\xe0"
+WRITE_SIZE = 64 * 1024
+
+KINDS = ("listing", "album", "image", "page", "error", "other")
+
+
+def to_base36(number):
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    result = ""
+    while number:
+        (number, digit) = divmod(number, 36)
+        result = digits[digit] + result
+    return result or "0"
+
+
+def pick(key, ratio):
+    # Deterministic choice with probability ratio for key.
+    return zlib.crc32(key.encode("utf-8")) % 10000 < ratio * 10000
+
+
+class StandIn(object):
+    def __init__(self, links=DEFAULT_LINKS, album_ratio=DEFAULT_ALBUM_RATIO,
+                 album_size=DEFAULT_ALBUM_SIZE, page_ratio=DEFAULT_PAGE_RATIO,
+                 min_size=DEFAULT_MIN_SIZE, max_size=DEFAULT_MAX_SIZE,
+                 latency=DEFAULT_LATENCY, error_rate=DEFAULT_ERROR_RATE):
+        # latency: seconds every response is delayed
+        # error_rate: fraction of album and image requests answered with 503
+        self.links = links
+        self.album_ratio = album_ratio
+        self.album_size = album_size
+        self.page_ratio = page_ratio
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.padding = bytes(WRITE_SIZE)
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.requests = {kind: 0 for kind in KINDS}
+            self.bytes_sent = 0
+
+    def get_stats(self):
+        with self.lock:
+            return {"requests": dict(self.requests),
+                    "total_requests": sum(self.requests.values()),
+                    "bytes_sent": self.bytes_sent}
+
+    def count(self, kind, size):
+        with self.lock:
+            self.requests[kind] += 1
+            self.bytes_sent += size
+
+    def get_link(self, subreddit, number, position):
+        # number: of the link in its subreddit
+        # position: of the link in the listing, gives the fullname
+        key = "%s/%d" % (subreddit, number)
+        if pick(key + "/album", self.album_ratio):
+            url = "http://imgur.com/a/%s%d" % (subreddit, number)
+        elif pick(key + "/page", self.page_ratio):
+            url = "http://%s/%s.jpg" % (PAGE_HOST, key)
+        else:
+            url = "http://%s/%s.jpg" % (IMAGE_HOST, key)
+        return {"kind": "t3",
+                "data": {"title": "%s post %d" % (subreddit, number),
+                         "url": url,
+                         "name": "t3_" + to_base36(ID_BASE - position),
+                         "score": number % 1000,
+                         "over_18": False,
+                         "subreddit": subreddit,
+                         "is_self": False}}
+
+    def get_listing(self, subreddit, params):
+        subreddits = subreddit.split("+")
+        total = self.links * len(subreddits)
+        limit = DEFAULT_PAGE_SIZE
+        try:
+            limit = max(1, min(int(params.get("limit", limit)),
+                               MAX_PAGE_SIZE))
+        except ValueError:
+            pass
+        start = 0
+        after = params.get("after")
+        if after:
+            start = ID_BASE - int(after.split("_", 1)[-1], 36) + 1
+        end = min(start + limit, total)
+        children = [self.get_link(subreddits[position % len(subreddits)],
+                                  position // len(subreddits), position)
+                    for position in range(start, end)]
+        return {"kind": "Listing",
+                "data": {"children": children,
+                         "after": (children[-1]["data"]["name"]
+                                   if end < total else None)}}
+
+    def get_album(self, album_id):
+        items = ",".join('{"hash":"%sx%d","title":"","ext":".jpg"}' % (
+            album_id, number) for number in range(self.album_size))
+        return ("<html><script>var album = {\"images\":[%s]};</script>"
+                "</html>" % items)
+
+    def get_image_size(self, path):
+        span = self.max_size - self.min_size + 1
+        return self.min_size + zlib.crc32(path.encode("utf-8")) % span
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, kind, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.standin.count(kind, len(body))
+
+    def send_image(self, path):
+        standin = self.server.standin
+        size = standin.get_image_size(path)
+        # Different content for every URL, so --dedup has nothing to link.
+        head = (JPEG_MAGIC + path.encode("utf-8"))[:size]
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        self.wfile.write(head)
+        remaining = size - len(head)
+        while remaining > 0:
+            chunk = standin.padding[:min(remaining, WRITE_SIZE)]
+            self.wfile.write(chunk)
+            remaining -= len(chunk)
+        standin.count("image", size)
+
+    def do_GET(self):
+        standin = self.server.standin
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        if not url.netloc and url.path == "/_stats":
+            stats = standin.get_stats()
+            if params.get("reset"):
+                standin.reset_stats()
+            body = json.dumps(stats).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        if standin.latency:
+            time.sleep(standin.latency)
+        host = (url.hostname or self.headers.get("Host", "")).lower()
+        parts = url.path.strip("/").split("/")
+        if host.endswith("reddit.com") and len(parts) >= 2 and \
+                parts[0] == "r":
+            subreddit = urllib.parse.unquote(parts[1])
+            if subreddit.endswith(".json"):
+                subreddit = subreddit[:-len(".json")]
+            body = json.dumps(standin.get_listing(subreddit, params))
+            self.send_body("listing", 200, "application/json",
+                           body.encode("utf-8"))
+        elif standin.error_rate and random.random() < standin.error_rate:
+            self.send_body("error", 503, "text/plain", b"try again later")
+        elif host.endswith("imgur.com") and len(parts) >= 2 and \
+                parts[0] == "a":
+            self.send_body("album", 200, "text/html; charset=utf-8",
+                           standin.get_album(parts[1]).encode("utf-8"))
+        elif host == PAGE_HOST:
+            body = ("<html><img src=\"http://%s%s\"></html>" % (
+                IMAGE_HOST, url.path)).encode("utf-8")
+            self.send_body("page", 200, "text/html; charset=utf-8", body)
+        elif url.path.strip("/"):
+            self.send_image(host + url.path)
+        else:
+            self.send_body("other", 404, "text/plain", b"not found")
+
+
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    # Many workers connect at once.
+    request_queue_size = 128
+
+    def __init__(self, address, standin):
+        http.server.ThreadingHTTPServer.__init__(self, address, Handler)
+        self.standin = standin
+
+    def handle_error(self, request, client_address):
+        # Clients close the connection of rejected responses early.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            http.server.ThreadingHTTPServer.handle_error(
+                self, request, client_address)
+
+
+def add_options(parser):
+    # Options of the stand-in, shared with benchmark.py.
+    group = optparse.OptionGroup(parser, "stand-in options")
+    group.add_option("--links", action="store", type="int", dest="links",
+                     default=DEFAULT_LINKS, metavar="NUM",
+                     help="links per subreddit [default: %default]")
+    group.add_option("--album-ratio", action="store", type="float",
+                     dest="album_ratio", default=DEFAULT_ALBUM_RATIO,
+                     metavar="FRACTION", help="links that are imgur albums "
+                     "[default: %default]")
+    group.add_option("--album-size", action="store", type="int",
+                     dest="album_size", default=DEFAULT_ALBUM_SIZE,
+                     metavar="NUM", help="images per album "
+                     "[default: %default]")
+    group.add_option("--page-ratio", action="store", type="float",
+                     dest="page_ratio", default=DEFAULT_PAGE_RATIO,
+                     metavar="FRACTION", help="links that look like images "
+                     "but are HTML pages [default: %default]")
+    group.add_option("--min-size", action="store", type="int",
+                     dest="min_size", default=DEFAULT_MIN_SIZE // 1024,
+                     metavar="KB", help="smallest image [default: %default]")
+    group.add_option("--max-size", action="store", type="int",
+                     dest="max_size", default=DEFAULT_MAX_SIZE // 1024,
+                     metavar="KB", help="largest image [default: %default]")
+    group.add_option("--latency", action="store", type="float",
+                     dest="latency", default=DEFAULT_LATENCY * 1000,
+                     metavar="MILLISECONDS", help="delay every response "
+                     "by MILLISECONDS [default: %default]")
+    group.add_option("--error-rate", action="store", type="float",
+                     dest="error_rate", default=DEFAULT_ERROR_RATE,
+                     metavar="FRACTION", help="album and image requests "
+                     "answered with 503 [default: %default]")
+    parser.add_option_group(group)
+
+
+def get_arguments(options):
+    # Command line of standin.py for the options of add_options().
+    return ["--links", str(options.links),
+            "--album-ratio", str(options.album_ratio),
+            "--album-size", str(options.album_size),
+            "--page-ratio", str(options.page_ratio),
+            "--min-size", str(options.min_size),
+            "--max-size", str(options.max_size),
+            "--latency", str(options.latency),
+            "--error-rate", str(options.error_rate)]
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="Usage: %prog [options]")
+    parser.add_option("--port", action="store", type="int", dest="port",
+                      default=DEFAULT_PORT, help="port to listen on, 0 picks "
+                      "a free one [default: %default]")
+    add_options(parser)
+    (options, args) = parser.parse_args()
+
+    standin = StandIn(links=options.links, album_ratio=options.album_ratio,
+                      album_size=options.album_size,
+                      page_ratio=options.page_ratio,
+                      min_size=options.min_size * 1024,
+                      max_size=options.max_size * 1024,
+                      latency=options.latency / 1000.0,
+                      error_rate=options.error_rate)
+    server = Server(("127.0.0.1", options.port), standin)
+    print(server.server_address[1], flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    sys.exit(0)
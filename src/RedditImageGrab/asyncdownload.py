@@ -0,0 +1,626 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# asyncio implementation of redditdownload.download().
+#
+# Listing, imgur album resolution and image downloads run as coroutines on a
+# single event loop, so one process can keep hundreds of transfers in flight.
+# Filters, file names and the returned statistics are the same as in
+# redditdownload.download(). Needs aiohttp.
+
+import asyncio
+import contextlib
+import functools
+import json
+import logging
+import os
+import time
+import urllib.parse
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from . import budget
+from . import classify
+from . import dedup
+from . import httpcache
+from . import imgur
+from . import index
+from . import linkfilter
+from . import manifest
+from . import metrics
+from . import ratelimit
+from . import reddit
+from . import redditdownload
+from . import session
+
+# Number of concurrent transfers per event loop.
+DEFAULT_CONCURRENCY = 100
+# Number of links of a single subreddit that are processed concurrently.
+DEFAULT_PENDING_LINKS = redditdownload.DEFAULT_LISTING_QUEUE_SIZE
+
+logger = logging.getLogger()
+
+
+def is_available():
+    return aiohttp is not None
+
+
+def get_host_slots(host_slots, url,
+                   concurrency=redditdownload.DEFAULT_ALBUM_CONCURRENCY):
+    # Returns the semaphore of the host of url in host_slots, a dict shared
+    # by everything running on the same loop.
+    host = urllib.parse.urlsplit(url).netloc.lower()
+    slots = host_slots.get(host)
+    if slots is None:
+        slots = host_slots[host] = asyncio.Semaphore(concurrency)
+    return slots
+
+
+def _get_errors():
+    return (aiohttp.ClientError, asyncio.TimeoutError, OSError,
+            UnicodeEncodeError, ValueError)
+
+
+def create_client(concurrency=DEFAULT_CONCURRENCY):
+    # Has to be called from inside the event loop.
+    if aiohttp is None:
+        raise ImportError("The asyncio engine requires aiohttp.")
+    connector = aiohttp.TCPConnector(limit=concurrency,
+                                     limit_per_host=concurrency)
+    timeout = aiohttp.ClientTimeout(sock_connect=redditdownload.TIMEOUT,
+                                    sock_read=redditdownload.TIMEOUT)
+    return aiohttp.ClientSession(
+        connector=connector, timeout=timeout, trust_env=True,
+        headers={"User-Agent": session.USER_AGENT})
+
+
+async def acquire(url):
+    # Same budget as the blocking code, but sleeps without blocking the loop.
+    wait = ratelimit.limiter.reserve(ratelimit.get_host(url))
+    if wait > 0:
+        await asyncio.sleep(wait)
+    metrics.observe_phase("ratelimit", max(0.0, wait))
+    return wait
+
+
+@contextlib.asynccontextmanager
+async def request(client, url, **kwargs):
+    # client.get() that records the time until the response headers arrived
+    start = time.monotonic()
+    async with client.get(url, **kwargs) as response:
+        metrics.observe_latency(ratelimit.get_host(url),
+                                time.monotonic() - start)
+        yield response
+
+
+async def get_links(client, subreddit, limit=None, sort=None, stop_at=None,
+                    time_filter=None, min_score=None, link_filter=None,
+                    rejected=None, stop=None):
+    # See reddit.get_links()
+    url = reddit.get_listing_url(subreddit, sort)
+    limit = limit or reddit.REDDIT_LINK_LIMIT
+    params = reddit.get_listing_params(sort, time_filter)
+
+    links = 0
+    while links < limit:
+        params["limit"] = reddit.get_page_size(limit, links)
+        json_data = None
+        try:
+            with metrics.timed("listing"):
+                content = await fetch_cached(client, url, params=params)
+            json_data = json.loads(content.decode("utf-8"))
+        except asyncio.TimeoutError:
+            logger.verbose("Connection to \"%s\" timed out.", url)
+        except ValueError:
+            pass
+        if not json_data:
+            return
+        try:
+            (page, after) = reddit.parse_listing(json_data)
+        except (KeyError, TypeError):
+            # There is no "after" to continue with.
+            logger.error("URL \"%s\" returned an invalid listing, stopping "
+                         "here.", url)
+            return
+        for link_data in page:
+            if reddit.is_past_end(link_data["name"], link_data["score"],
+                                  subreddit, sort, stop_at, min_score):
+                return
+            if stop is not None and stop(link_data):
+                return
+            links += 1
+            link = reddit.get_link(link_data, link_filter, rejected)
+            if link:
+                yield link
+            if links >= limit:
+                return
+        if not after:
+            # last page
+            return
+        params["after"] = after
+
+
+async def get_combined_links(client, items, num, update, score=0, sort=None,
+                             time_filter=None, link_filter=None):
+    # See redditdownload.get_combined_links()
+    loop = asyncio.get_running_loop()
+    (sort, stop_at) = await loop.run_in_executor(
+        None, functools.partial(redditdownload.get_combined_start, items,
+                                update, sort=sort))
+    link_filter = redditdownload.get_link_filter(score, False, False, None,
+                                                 link_filter)
+    subreddits = [subreddit for (subreddit, _) in items]
+    splitter = reddit.LinkSplitter(subreddits, limit=num, stop_at=stop_at)
+    links = get_links(client, reddit.get_combined_name(subreddits),
+                      sort=sort, time_filter=time_filter, min_score=score,
+                      link_filter=link_filter,
+                      rejected=splitter.add_rejected,
+                      stop=splitter.is_past_end)
+    try:
+        async for link in links:
+            if not splitter.add(link):
+                break
+    finally:
+        await links.aclose()
+    return splitter
+
+
+async def iterate_planned(records):
+    # The links of manifest records, in place of get_links().
+    for record in records:
+        yield manifest.get_link(record)
+
+
+async def iterate_links(links):
+    # Links of a combined listing, in place of get_links().
+    for link in links:
+        yield link
+
+
+async def fetch_cached(client, url, params=None):
+    # Returns the body of url, see httpcache.HTTPCache.get(). Cache files are
+    # read and written in the default executor.
+    cache = httpcache.cache
+    if cache is None:
+        await acquire(url)
+        logger.debug("Opening URL \"%s\"", url)
+        async with request(client, url, params=params) as response:
+            return await response.read()
+
+    loop = asyncio.get_running_loop()
+    entry = await loop.run_in_executor(None, cache.lookup, url, params)
+    if entry is not None and entry.is_fresh(cache.ttl):
+        cache.hits += 1
+        logger.debug("Using cached response for \"%s\".", url)
+        return entry.content
+    await acquire(url)
+    logger.debug("Opening URL \"%s\"", url)
+    async with request(client, url, params=params,
+                          headers=cache.get_conditional_headers(entry)) \
+            as response:
+        content = await response.read()
+        (status, headers) = (response.status, response.headers)
+    if status == 304 and entry is not None:
+        cache.revalidated += 1
+        logger.debug("\"%s\" has not changed.", url)
+        await loop.run_in_executor(None, cache.refresh, entry)
+        return entry.content
+    cache.misses += 1
+    if status == 200:
+        await loop.run_in_executor(None, cache.store, url, params, headers,
+                                   content)
+    return content
+
+
+async def extract_urls(client, url):
+    if classify.classify(url) == classify.DIRECT:
+        return [url]
+    if not (redditdownload.is_imgur_url(url) and
+            redditdownload.is_imgur_album(url)):
+        return [url]
+    loop = asyncio.get_running_loop()
+    album_id = imgur.get_album_id(url)
+    items = await loop.run_in_executor(None, imgur.get_cached_items,
+                                       album_id)
+    if items is None:
+        try:
+            content = await fetch_cached(client, url)
+        except asyncio.TimeoutError:
+            return []
+        items = imgur.parse_album(content.decode("utf-8", errors="replace"))
+        await loop.run_in_executor(None, imgur.cache_items, album_id, items)
+    return imgur.get_image_urls(items)
+
+
+async def read_head(content, size=redditdownload.SNIFF_SIZE):
+    # See redditdownload.read_head(), content is an aiohttp.StreamReader.
+    head = b""
+    while len(head) < size:
+        chunk = await content.read(size - len(head))
+        if not chunk:
+            break
+        head += chunk
+    return head
+
+
+def _get_transfer_errors():
+    return (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError,
+            asyncio.TimeoutError)
+
+
+async def _transfer(client, url, part, destination, identifier,
+                    max_filename_len, chunk_size, buffer_size, hashed):
+    # See redditdownload._transfer(), disk access is done in the default
+    # executor to keep the loop responsive.
+    loop = asyncio.get_running_loop()
+    await acquire(url)
+    logger.debug("Opening URL \"%s\"", url)
+    async with request(client, url,
+                       headers=part.get_request_headers()) as response:
+        if response.status == 416 and part.offset:
+            await loop.run_in_executor(None, part.discard)
+            return await _transfer(client, url, part, destination,
+                                   identifier, max_filename_len, chunk_size,
+                                   buffer_size, hashed)
+        part.accept_response(response.status, response.headers)
+        head = None
+        if redditdownload.needs_sniffing(response.headers, part.offset):
+            head = await read_head(response.content)
+        try:
+            extension = redditdownload.check_response(url, response.headers,
+                                                      head)
+        except redditdownload.WrongFileTypeException:
+            # Closes the connection instead of reading the rest of the body.
+            response.close()
+            raise
+        dest_path = os.path.join(destination, redditdownload.get_file_name(
+            identifier, extension, max_filename_len))
+
+        start = time.monotonic()
+        filehandle = await loop.run_in_executor(None, part.open, buffer_size)
+        file_hash = None
+        if hashed:
+            file_hash = dedup.new_hash()
+            await loop.run_in_executor(None, part.hash_existing, file_hash)
+        write_time = time.monotonic() - start
+        size = part.offset
+        if head:
+            write_start = time.monotonic()
+            await loop.run_in_executor(None, filehandle.write, head)
+            write_time += time.monotonic() - write_start
+            size += len(head)
+            budget.add_bytes(len(head))
+            metrics.add("bytes", len(head))
+            if file_hash:
+                file_hash.update(head)
+        async for chunk in response.content.iter_chunked(chunk_size):
+            write_start = time.monotonic()
+            await loop.run_in_executor(None, filehandle.write, chunk)
+            write_time += time.monotonic() - write_start
+            size += len(chunk)
+            budget.add_bytes(len(chunk))
+            metrics.add("bytes", len(chunk))
+            if file_hash:
+                file_hash.update(chunk)
+        write_start = time.monotonic()
+        await loop.run_in_executor(None, filehandle.flush)
+        write_time += time.monotonic() - write_start
+        metrics.observe_phase("transfer",
+                              time.monotonic() - start - write_time)
+    return (dest_path, size, file_hash, write_time)
+
+
+async def download_from_url(client, url, destination, identifier,
+                            download_index, max_filename_len, name=None,
+                            chunk_size=redditdownload.DEFAULT_CHUNK_SIZE,
+                            buffer_size=redditdownload.DEFAULT_BUFFER_SIZE,
+                            content_store=None,
+                            resume_retries=redditdownload.
+                            DEFAULT_RESUME_RETRIES):
+    # The index is SQLite, it is only used from the default executor.
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, redditdownload.check_downloaded, url,
+                               identifier, download_index)
+    budget.reserve_file()
+    try:
+        if content_store is not None and await loop.run_in_executor(
+                None, redditdownload.link_known_url, url, destination,
+                identifier, download_index, max_filename_len, name,
+                content_store):
+            return
+
+        part = redditdownload.PartFile(destination, url)
+        attempt = 0
+        while True:
+            try:
+                (dest_path, size, file_hash, write_time) = await _transfer(
+                    client, url, part, destination, identifier,
+                    max_filename_len, chunk_size, buffer_size,
+                    content_store is not None)
+                break
+            except _get_transfer_errors():
+                await loop.run_in_executor(None, part.keep)
+                if attempt >= resume_retries or not part.offset:
+                    raise
+                attempt += 1
+                logger.verbose("Transfer of \"%s\" interrupted after %d "
+                               "bytes, continuing.", url, part.offset)
+            except redditdownload.FileExistsException:
+                part.close()
+                raise
+            except BaseException:
+                part.discard()
+                raise
+        try:
+            # One observation per file, the writes of the transfer and
+            # moving the file into place.
+            start = time.monotonic()
+            saved = await loop.run_in_executor(None, functools.partial(
+                redditdownload.save_file, part.path, dest_path,
+                identifier, size, file_hash, url, name, download_index,
+                content_store))
+            metrics.observe_phase(
+                "write", write_time + time.monotonic() - start)
+        finally:
+            part.remove_meta()
+            part.close()
+        if not saved:
+            budget.release_file()
+            return
+    except BaseException:
+        budget.release_file()
+        raise
+
+    logger.verbose('Downloaded URL \"%s\" to \"%s\".', url, dest_path)
+
+
+# returns a tuple: (processed, downloaded, skipped, errors)
+async def download(subreddit, destination, last, score, num, update, sfw,
+                   nsfw, regex, verbose, quiet, timeout, client=None,
+                   transfers=None,
+                   chunk_size=redditdownload.DEFAULT_CHUNK_SIZE,
+                   buffer_size=redditdownload.DEFAULT_BUFFER_SIZE,
+                   content_store=None, host_slots=None,
+                   album_concurrency=redditdownload.DEFAULT_ALBUM_CONCURRENCY,
+                   plan=None, planned=None, sort=None, time_filter=None,
+                   links=None, rejected=None, link_filter=None):
+    # client: aiohttp.ClientSession to use, created if not given
+    # transfers: asyncio.Semaphore limiting the concurrent transfers, shared
+    #            by all subreddits running on the same loop
+    # host_slots: dict of the per host semaphores, see get_host_slots()
+    # album_concurrency: files of an album downloaded at the same time from
+    #                    one host
+    # plan, planned, sort, time_filter, links, rejected, link_filter: see
+    # redditdownload.download()
+
+    if client is None:
+        async with create_client() as client:
+            return await download(subreddit, destination, last, score, num,
+                                  update, sfw, nsfw, regex, verbose, quiet,
+                                  timeout, client=client, transfers=transfers,
+                                  chunk_size=chunk_size,
+                                  buffer_size=buffer_size,
+                                  content_store=content_store,
+                                  host_slots=host_slots,
+                                  album_concurrency=album_concurrency,
+                                  plan=plan, planned=planned, sort=sort,
+                                  time_filter=time_filter, links=links,
+                                  rejected=rejected, link_filter=link_filter)
+    if transfers is None:
+        transfers = asyncio.Semaphore(DEFAULT_CONCURRENCY)
+    if host_slots is None:
+        host_slots = dict()
+
+    download_errors = _get_errors()
+    loop = asyncio.get_running_loop()
+
+    # Create the specified directory if it doesn't already exist.
+    if not os.path.exists(destination):
+        logger.debug("Directory \"%s\" does not exist, will be created.",
+                     destination)
+        os.mkdir(destination)
+
+    max_filename_len = os.statvfs(destination)[9]
+    processed = 0
+    downloaded = 0
+    errors = 0
+    skipped = 0
+    planned_files = 0
+
+    # fullname -> URLs of the planned links
+    planned_urls = None
+    if planned is not None:
+        planned_urls = dict((record["name"], record["urls"])
+                            for record in planned)
+
+    # Files being downloaded count against num before they are done, like
+    # in redditdownload.fetch_items(), so num is never exceeded.
+    running = 0
+    slots = asyncio.Condition()
+
+    def done():
+        if plan:
+            return num > 0 and planned_files >= num
+        return (num > 0 and downloaded >= num) or budget.exhausted()
+
+    async def reserve_slot():
+        # Waits until a file may be started. Returns False once none may be
+        # started anymore.
+        nonlocal running
+        async with slots:
+            while (num > 0 and downloaded < num and
+                   running + downloaded >= num):
+                await slots.wait()
+            if done():
+                return False
+            running += 1
+            return True
+
+    async def release_slot(result):
+        nonlocal running, downloaded
+        running -= 1
+        if result == redditdownload.ITEM_DOWNLOADED:
+            downloaded += 1
+        async with slots:
+            slots.notify_all()
+
+    async def process(link):
+        nonlocal downloaded, errors, skipped, planned_files
+        if planned_urls is None and redditdownload.is_unsupported(link):
+            skipped += 1
+            return
+        if await loop.run_in_executor(None, download_index.has_link,
+                                      link.name):
+            logger.verbose("\"%s\" has already been downloaded, will be "
+                           "skipped.", link.title)
+            skipped += 1
+            return
+        if planned_urls is not None:
+            urls = planned_urls[link.name]
+        else:
+            try:
+                with metrics.timed("resolve"):
+                    urls = await extract_urls(client, link.url)
+            except download_errors as error:
+                logger.verbose("Error %s for %s", repr(error), link.url)
+                errors += 1
+                failed.append(link.name)
+                return
+        if not urls:
+            return
+        if plan:
+            if not done():
+                plan(subreddit, destination, link, urls)
+                planned_files += len(urls)
+            return
+
+        identifier = redditdownload.get_identifier(link.title)
+        items = list()
+        for (filecount, url) in enumerate(urls):
+            # Only append numbers if more than one file.
+            mutated_identifier = identifier
+            if len(urls) > 1:
+                mutated_identifier += "_%s" % filecount
+            items.append(fetch_item(url, mutated_identifier, link.name,
+                                    album=len(urls) > 1))
+        # The files of an album are downloaded concurrently.
+        results = await asyncio.gather(*items)
+        # A link is recorded in the index once all of its files are there.
+        if all(result in (redditdownload.ITEM_DOWNLOADED,
+                          redditdownload.ITEM_SKIPPED) for result in results):
+            await loop.run_in_executor(None, download_index.add_link,
+                                       link.name, link.url)
+        else:
+            failed.append(link.name)
+
+    async def fetch_item(url, identifier, name, album=False):
+        # Returns one of redditdownload.ITEM_*. The files of albums only get
+        # album_concurrency transfers per host.
+        if album:
+            async with get_host_slots(host_slots, url, album_concurrency):
+                return await fetch_item(url, identifier, name)
+        if not await reserve_slot():
+            return redditdownload.ITEM_NOT_STARTED
+        result = redditdownload.ITEM_ERROR
+        try:
+            result = await download_file(url, identifier, name)
+        finally:
+            await release_slot(result)
+        return result
+
+    async def download_file(url, identifier, name):
+        nonlocal errors, skipped
+        try:
+            async with transfers:
+                await download_from_url(client, url, destination,
+                                        identifier, download_index,
+                                        max_filename_len, name=name,
+                                        chunk_size=chunk_size,
+                                        buffer_size=buffer_size,
+                                        content_store=content_store)
+            return redditdownload.ITEM_DOWNLOADED
+        except budget.BudgetExhaustedException:
+            return redditdownload.ITEM_BUDGET
+        except (redditdownload.WrongFileTypeException,
+                redditdownload.FileExistsException) as error:
+            if not quiet:
+                logger.verbose('%s', error)
+            skipped += 1
+            return redditdownload.ITEM_SKIPPED
+        except asyncio.TimeoutError:
+            logger.verbose("Connection to \"%s\" timed out.", url)
+            errors += 1
+            return redditdownload.ITEM_ERROR
+        except download_errors as error:
+            logger.verbose("Error %s for %s", repr(error), url)
+            errors += 1
+            return redditdownload.ITEM_ERROR
+
+    download_index = await loop.run_in_executor(None, index.open_index,
+                                                destination)
+    if planned is not None:
+        links = iterate_planned(planned)
+    elif links is not None:
+        links = iterate_links(links)
+    else:
+        (sort, stop_at) = await loop.run_in_executor(None, functools.partial(
+            redditdownload.get_update_start, subreddit, last, update,
+            download_index, sort=sort))
+        rejected = linkfilter.Rejected()
+        links = get_links(client, subreddit, limit=num,
+                          sort=sort, stop_at=stop_at, time_filter=time_filter,
+                          min_score=score,
+                          link_filter=redditdownload.get_link_filter(
+                              score, sfw, nsfw, regex, link_filter),
+                          rejected=rejected.add)
+    seen = list()
+    failed = list()
+    pending = set()
+    try:
+        async for link in links:
+            processed += 1
+            if not link:
+                continue
+            if done():
+                break
+            seen.append(link.name)
+            pending.add(asyncio.ensure_future(process(link)))
+            if len(pending) >= DEFAULT_PENDING_LINKS:
+                (_, pending) = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+        if pending:
+            await asyncio.gather(*pending)
+        # A plan has not downloaded anything yet, the run that executes it
+        # saves the cursor.
+        if update and not plan:
+            if rejected is not None:
+                seen.extend(rejected.get_names(subreddit))
+            await loop.run_in_executor(
+                None, redditdownload.save_update_cursor, subreddit,
+                download_index, seen, failed)
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        await loop.run_in_executor(None, download_index.close)
+
+    filtered = redditdownload.add_filtered(subreddit, rejected)
+    return (processed + filtered, downloaded, skipped + filtered, errors)
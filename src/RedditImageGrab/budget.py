@@ -0,0 +1,116 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Limits for a whole run, shared by all worker processes.
+#
+# Every download reserves one file of the budget before it is started and
+# gives it back if it does not produce a file, so concurrent workers can never
+# download more than max_files files in total. Transferred bytes are counted
+# while the files are written. Once either limit is reached, no new downloads
+# are started; downloads that are already running are finished.
+
+import ctypes
+import logging
+import multiprocessing
+
+logger = logging.getLogger()
+
+# Positions in the shared array.
+_MAX_FILES = 0
+_MAX_BYTES = 1
+_FILES = 2
+_BYTES = 3
+
+
+class BudgetExhaustedException(Exception):
+    """Exception raised when the download budget of the run is used up"""
+
+
+class Budget(object):
+    # max_files, max_bytes: 0 means no limit
+    # Has to be created before the worker processes are started.
+    def __init__(self, max_files=0, max_bytes=0):
+        self.values = multiprocessing.Array(ctypes.c_longlong, 4)
+        self.values[_MAX_FILES] = max_files
+        self.values[_MAX_BYTES] = max_bytes
+
+    def _exhausted(self):
+        # Caller has to hold the lock.
+        values = self.values
+        return ((values[_MAX_FILES] and
+                 values[_FILES] >= values[_MAX_FILES]) or
+                (values[_MAX_BYTES] and
+                 values[_BYTES] >= values[_MAX_BYTES]))
+
+    def exhausted(self):
+        with self.values.get_lock():
+            return bool(self._exhausted())
+
+    def reserve_file(self):
+        # Raises BudgetExhaustedException if no more files may be downloaded.
+        with self.values.get_lock():
+            if self._exhausted():
+                raise BudgetExhaustedException(
+                    "Download budget of the run is used up.")
+            self.values[_FILES] += 1
+
+    def release_file(self):
+        # Gives back a reserved file that was not downloaded.
+        with self.values.get_lock():
+            self.values[_FILES] -= 1
+
+    def add_bytes(self, size):
+        with self.values.get_lock():
+            self.values[_BYTES] += size
+
+    def get_usage(self):
+        # Returns (files, bytes) used so far.
+        with self.values.get_lock():
+            return (self.values[_FILES], self.values[_BYTES])
+
+
+budget = None
+
+
+def configure(max_files=0, max_bytes=0):
+    # Sets the budget of the run. Has to be called before the workers are
+    # started.
+    global budget
+    budget = None
+    if max_files or max_bytes:
+        budget = Budget(max_files, max_bytes)
+    return budget
+
+
+def exhausted():
+    return budget is not None and budget.exhausted()
+
+
+def reserve_file():
+    if budget is not None:
+        budget.reserve_file()
+
+
+def release_file():
+    if budget is not None:
+        budget.release_file()
+
+
+def add_bytes(size):
+    if budget is not None:
+        budget.add_bytes(size)
@@ -0,0 +1,185 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Classification of link URLs without any network access.
+#
+# Every URL is one of:
+#   direct       an image that can be downloaded as it is
+#   resolvable   a page that is turned into image URLs, e.g. imgur albums
+#   unsupported  something that will never be an image (videos, self posts)
+#   unknown      anything else, downloaded and checked by its content-type
+#
+# Rules match the host (including its subdomains) and optionally a regular
+# expression on the path, or the extension of the path. Host rules are
+# checked before extension rules, and rules loaded from a file before the
+# built-in ones. A rules file has one rule per line:
+#
+#   KIND DOMAIN [PATH-REGEX]
+#   KIND .EXTENSION
+#
+# Empty lines and lines starting with "#" are ignored.
+
+import logging
+import os.path
+import re
+import urllib.parse
+
+DIRECT = "direct"
+RESOLVABLE = "resolvable"
+UNSUPPORTED = "unsupported"
+UNKNOWN = "unknown"
+KINDS = (DIRECT, RESOLVABLE, UNSUPPORTED)
+
+COMMENT_CHAR = "#"
+
+# Domains with a resolver in redditdownload.extract_urls().
+RESOLVABLE_DOMAINS = ("imgur.com",)
+
+# (kind, domain, path regex or None)
+DEFAULT_HOST_RULES = (
+    (RESOLVABLE, "imgur.com", r"^/a/"),
+    (UNSUPPORTED, "imgur.com", r"^/gallery/"),
+    (UNSUPPORTED, "reddit.com", r"^/r/[^/]+/comments/"),
+    (UNSUPPORTED, "redd.it", r"^/[^/.]+$"),
+    (UNSUPPORTED, "v.redd.it", None),
+    (UNSUPPORTED, "youtube.com", None),
+    (UNSUPPORTED, "youtu.be", None),
+    (UNSUPPORTED, "vimeo.com", None),
+    (UNSUPPORTED, "gfycat.com", None),
+    (UNSUPPORTED, "streamable.com", None),
+    (UNSUPPORTED, "twitter.com", None),
+)
+# (kind, extension)
+DEFAULT_EXTENSION_RULES = (
+    (DIRECT, ".jpg"),
+    (DIRECT, ".jpeg"),
+    (DIRECT, ".png"),
+    (DIRECT, ".gif"),
+    (UNSUPPORTED, ".gifv"),
+    (UNSUPPORTED, ".mp4"),
+    (UNSUPPORTED, ".webm"),
+    (UNSUPPORTED, ".mov"),
+    (UNSUPPORTED, ".avi"),
+    (UNSUPPORTED, ".pdf"),
+    (UNSUPPORTED, ".zip"),
+)
+
+logger = logging.getLogger()
+
+
+class Classifier(object):
+    def __init__(self, host_rules=DEFAULT_HOST_RULES,
+                 extension_rules=DEFAULT_EXTENSION_RULES):
+        # domain -> [(compiled path regex or None, kind), ...]
+        self.hosts = dict()
+        # extension -> kind
+        self.extensions = dict()
+        self.add_rules(host_rules, extension_rules)
+
+    def add_rules(self, host_rules=(), extension_rules=(), first=False):
+        # first: the rules are checked before the existing ones
+        if first:
+            host_rules = reversed(host_rules)
+            extension_rules = reversed(extension_rules)
+        for (kind, domain, path) in host_rules:
+            domain = domain.lower().lstrip(".")
+            check_host_rule(kind, domain)
+            rule = (re.compile(path) if path else None, kind)
+            rules = self.hosts.setdefault(domain, list())
+            if first:
+                rules.insert(0, rule)
+            else:
+                rules.append(rule)
+        for (kind, extension) in extension_rules:
+            check_kind(kind)
+            extension = extension.lower()
+            if first or extension not in self.extensions:
+                self.extensions[extension] = kind
+
+    def classify(self, url):
+        parsed = urllib.parse.urlsplit(url)
+        host = (parsed.hostname or "").lower()
+        path = parsed.path
+        # "i.imgur.com" is checked as "i.imgur.com", "imgur.com" and "com"
+        labels = host.split(".")
+        for i in range(len(labels)):
+            for (regex, kind) in self.hosts.get(".".join(labels[i:]), ()):
+                if regex is None or regex.search(path):
+                    return kind
+        extension = os.path.splitext(path)[1].lower()
+        return self.extensions.get(extension, UNKNOWN)
+
+
+def check_kind(kind):
+    if kind not in KINDS:
+        raise ValueError("Unknown kind \"{0}\", must be one of: {1}".format(
+            kind, ", ".join(KINDS)))
+
+
+def check_host_rule(kind, domain):
+    check_kind(kind)
+    if kind == RESOLVABLE and domain not in RESOLVABLE_DOMAINS:
+        raise ValueError("No resolver for \"{0}\", resolvable domains are: "
+                         "{1}".format(domain, ", ".join(RESOLVABLE_DOMAINS)))
+
+
+def parse_rules(path):
+    # Returns (host rules, extension rules) of a rules file. Raises
+    # ValueError with the line number if a line is invalid.
+    host_rules = list()
+    extension_rules = list()
+    with open(path) as rules_file:
+        for (number, line) in enumerate(rules_file, 1):
+            line = line.strip()
+            if not line or line.startswith(COMMENT_CHAR):
+                continue
+            fields = line.split(None, 2)
+            try:
+                if len(fields) < 2:
+                    raise ValueError("Expected KIND DOMAIN [PATH-REGEX] or "
+                                     "KIND .EXTENSION")
+                check_kind(fields[0])
+                if fields[1].startswith("."):
+                    if len(fields) > 2:
+                        raise ValueError("Extension rules take no path")
+                    extension_rules.append((fields[0], fields[1]))
+                else:
+                    check_host_rule(fields[0], fields[1].lower())
+                    path_regex = fields[2] if len(fields) > 2 else None
+                    if path_regex:
+                        re.compile(path_regex)
+                    host_rules.append((fields[0], fields[1], path_regex))
+            except (ValueError, re.error) as error:
+                raise ValueError("{0}:{1}: {2}".format(path, number, error))
+    return (host_rules, extension_rules)
+
+
+classifier = Classifier()
+
+
+def configure(path):
+    # Adds the rules in the file at path in front of the built-in ones. Has
+    # to be called before the workers are started.
+    (host_rules, extension_rules) = parse_rules(path)
+    classifier.add_rules(host_rules, extension_rules, first=True)
+    logger.debug("Loaded %d host and %d extension rules from \"%s\".",
+                 len(host_rules), len(extension_rules), path)
+
+
+def classify(url):
+    return classifier.classify(url)
@@ -0,0 +1,161 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Content-addressed store for deduplicating downloads.
+#
+# The store maps the SHA-256 digest of every downloaded file to its path, and
+# every source URL to the digest of its content. It is shared by all
+# subreddits and lists of a run. When a download turns out to be a copy of a
+# file that is already on disk, the new file becomes a hardlink to the old
+# one. When the URL itself is known, the download is skipped entirely.
+
+import binascii
+import errno
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+
+STORE_FILE_NAME = ".reddit-download-content.sqlite"
+HASH_ALGORITHM = "sha256"
+# Seconds to wait for a lock held by another process.
+LOCK_TIMEOUT = 30.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS content (
+    digest TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS urls (
+    url TEXT PRIMARY KEY,
+    digest TEXT NOT NULL
+);
+"""
+
+# Errors that mean "cannot hardlink here", e.g. another file system or too
+# many links. The downloaded copy is kept in that case.
+LINK_ERRORS = (errno.EXDEV, errno.EMLINK, errno.EPERM, errno.EACCES,
+               errno.ENOTSUP)
+
+logger = logging.getLogger()
+
+
+def new_hash():
+    return hashlib.new(HASH_ALGORITHM)
+
+
+class ContentStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=LOCK_TIMEOUT,
+                                          check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.executescript(SCHEMA)
+        # Statistics of this process.
+        self.linked_files = 0
+        # Disk space saved by hardlinking.
+        self.linked_bytes = 0
+        # Bytes that were neither transferred nor written because the URL
+        # was known.
+        self.avoided_bytes = 0
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def _lookup(self, digest):
+        # Returns (path, size) of the file with the given digest if it still
+        # exists unchanged, None otherwise.
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT path, size FROM content WHERE digest = ?",
+                (digest,)).fetchone()
+        if row is None:
+            return None
+        (path, size) = row
+        try:
+            if os.stat(path).st_size == size:
+                return (path, size)
+        except OSError:
+            pass
+        # The file is gone or has changed, forget about it.
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM content WHERE digest = ?",
+                                    (digest,))
+        return None
+
+    def find_url(self, url):
+        # Returns (path, size) of an existing file with the content of url.
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT digest FROM urls WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+        return self._lookup(row[0])
+
+    def find_digest(self, digest):
+        return self._lookup(digest)
+
+    def add(self, digest, path, size, url=None):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO content (digest, path, size) VALUES "
+                "(?, ?, ?)", (digest, os.path.abspath(path), size))
+            if url:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO urls (url, digest) VALUES (?, ?)",
+                    (url, digest))
+
+    def link(self, source, dest_path):
+        # Atomically makes dest_path a hardlink to source. Returns False if
+        # the file system does not allow it.
+        if os.path.abspath(source) == os.path.abspath(dest_path):
+            return True
+        temp_path = os.path.join(
+            os.path.dirname(dest_path), ".%s.link" %
+            binascii.hexlify(os.urandom(8)).decode("ascii"))
+        try:
+            os.link(source, temp_path)
+        except OSError as error:
+            if error.errno in LINK_ERRORS:
+                logger.debug("Cannot link \"%s\" to \"%s\": %s", dest_path,
+                             source, error)
+                return False
+            raise
+        try:
+            os.replace(temp_path, dest_path)
+        except OSError:
+            os.unlink(temp_path)
+            raise
+        return True
+
+    def log_stats(self, level=logging.DEBUG):
+        logger.log(level, "Deduplicated %d files, saved %d bytes of disk "
+                   "space and %d bytes of transfers and writes.",
+                   self.linked_files, self.linked_bytes, self.avoided_bytes)
+
+
+def open_store(path):
+    # path can be a directory, the store is created inside it then.
+    if os.path.isdir(path):
+        path = os.path.join(path, STORE_FILE_NAME)
+    return ContentStore(path)
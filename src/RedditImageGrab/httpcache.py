@@ -0,0 +1,257 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# On-disk cache for small documents like listings and imgur album pages.
+#
+# Responses are stored together with their ETag and Last-Modified headers.
+# Within the TTL a cached response is returned without any request, after
+# that it is revalidated with If-None-Match / If-Modified-Since, so unchanged
+# documents only cost a 304. Entries are evicted, least recently used first,
+# when the cache grows beyond its maximum size.
+
+import binascii
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+
+from . import ratelimit
+from . import session
+
+CACHE_DIR_NAME = ".reddit-download-cache"
+# Seconds a response is used without asking the server again.
+DEFAULT_TTL = 0
+# Maximum size of the cache in bytes.
+DEFAULT_MAX_SIZE = 100 * 1024 * 1024
+# Check the size of the cache every EVICT_INTERVAL stored responses.
+EVICT_INTERVAL = 50
+
+logger = logging.getLogger()
+
+
+class CachedResponse(object):
+    # The parts of a requests.Response the listing and album code uses.
+    def __init__(self, url, status_code, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def encoding(self):
+        content_type = self.headers.get("content-type", "")
+        for part in content_type.split(";")[1:]:
+            (key, _, value) = part.strip().partition("=")
+            if key.lower() == "charset" and value:
+                return value.strip("\"'")
+        return "utf-8"
+
+    @property
+    def text(self):
+        try:
+            return self.content.decode(self.encoding, errors="replace")
+        except LookupError:
+            return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class CacheEntry(object):
+    def __init__(self, key, meta, content):
+        self.key = key
+        self.meta = meta
+        self.content = content
+
+    def is_fresh(self, ttl):
+        return time.time() - self.meta["stored"] < ttl
+
+    def get_response(self):
+        return CachedResponse(self.meta["url"], 200, self.meta["headers"],
+                              self.content)
+
+
+class HTTPCache(object):
+    def __init__(self, directory, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.stored = 0
+        # Statistics of this process.
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def get_key(self, url, params=None):
+        if params:
+            url = url + "?" + urllib.parse.urlencode(sorted(params.items()))
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    def _get_paths(self, key):
+        base = os.path.join(self.directory, key[:2], key)
+        return (base + ".json", base + ".body")
+
+    def lookup(self, url, params=None):
+        key = self.get_key(url, params)
+        (meta_path, body_path) = self._get_paths(key)
+        try:
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+            with open(body_path, "rb") as body_file:
+                content = body_file.read()
+        except (OSError, ValueError):
+            return None
+        if len(content) != meta.get("size"):
+            return None
+        # The access time of the body is used for eviction.
+        try:
+            os.utime(body_path)
+        except OSError:
+            pass
+        return CacheEntry(key, meta, content)
+
+    def get_conditional_headers(self, entry):
+        headers = dict()
+        if entry is None:
+            return headers
+        if entry.meta["headers"].get("etag"):
+            headers["If-None-Match"] = entry.meta["headers"]["etag"]
+        if entry.meta["headers"].get("last-modified"):
+            headers["If-Modified-Since"] = \
+                entry.meta["headers"]["last-modified"]
+        return headers
+
+    def _write(self, path, data):
+        temp_path = "%s.%s.tmp" % (
+            path, binascii.hexlify(os.urandom(4)).decode("ascii"))
+        with open(temp_path, "wb") as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, path)
+
+    def refresh(self, entry):
+        # The server said the entry is still valid.
+        entry.meta["stored"] = time.time()
+        (meta_path, _) = self._get_paths(entry.key)
+        try:
+            self._write(meta_path, json.dumps(entry.meta).encode("utf-8"))
+        except OSError as error:
+            logger.debug("Could not update cache entry %s: %s", entry.key,
+                         error)
+
+    def store(self, url, params, headers, content):
+        key = self.get_key(url, params)
+        (meta_path, body_path) = self._get_paths(key)
+        meta = {"url": url,
+                "stored": time.time(),
+                "size": len(content),
+                "headers": {name: headers[name] for name in
+                            ("etag", "last-modified", "content-type")
+                            if headers.get(name)}}
+        try:
+            os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+            self._write(body_path, content)
+            self._write(meta_path, json.dumps(meta).encode("utf-8"))
+        except OSError as error:
+            logger.debug("Could not cache \"%s\": %s", url, error)
+            return
+        with self.lock:
+            self.stored += 1
+            evict = self.stored % EVICT_INTERVAL == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        # Removes the least recently used entries until the cache is smaller
+        # than max_size.
+        entries = list()
+        total = 0
+        for (root, _, files) in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".body"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        if total <= self.max_size:
+            return
+        entries.sort()
+        for (_, size, path) in entries:
+            if total <= self.max_size:
+                break
+            for remove_path in (path, path[:-len(".body")] + ".json"):
+                try:
+                    os.unlink(remove_path)
+                except OSError:
+                    pass
+            total -= size
+        logger.debug("Evicted cache entries, cache size is now %d bytes.",
+                     total)
+
+    def get(self, url, params=None, headers=None, timeout=None):
+        entry = self.lookup(url, params)
+        if entry is not None and entry.is_fresh(self.ttl):
+            self.hits += 1
+            logger.debug("Using cached response for \"%s\".", url)
+            return entry.get_response()
+        request_headers = dict(headers or {})
+        request_headers.update(self.get_conditional_headers(entry))
+        ratelimit.acquire(url)
+        response = session.get(url, params=params, headers=request_headers,
+                               timeout=timeout)
+        if response.status_code == 304 and entry is not None:
+            self.revalidated += 1
+            logger.debug("\"%s\" has not changed.", url)
+            self.refresh(entry)
+            return entry.get_response()
+        self.misses += 1
+        if response.status_code == 200:
+            self.store(url, params, response.headers, response.content)
+        return response
+
+    def log_stats(self, level=logging.DEBUG):
+        logger.log(level, "HTTP cache: %d hits, %d revalidated, %d misses.",
+                   self.hits, self.revalidated, self.misses)
+
+
+cache = None
+
+
+def configure(directory, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE):
+    # Enables the cache for get(). Has to be called before the workers are
+    # started.
+    global cache
+    cache = HTTPCache(directory, ttl=ttl, max_size=max_size)
+    cache.evict()
+    return cache
+
+
+def get(url, params=None, headers=None, timeout=None):
+    # Rate limited GET through the cache if it is enabled.
+    if cache is not None:
+        return cache.get(url, params=params, headers=headers, timeout=timeout)
+    ratelimit.acquire(url)
+    return session.get(url, params=params, headers=headers, timeout=timeout)
@@ -0,0 +1,159 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# imgur album resolution.
+#
+# An album page is turned into a list of (hash, extension) items, which are
+# kept in a small SQLite database for a while, so albums that show up again
+# (in another subreddit, or in the next run) do not have to be fetched and
+# parsed again.
+
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+ALBUM_CACHE_FILE_NAME = ".reddit-download-albums.sqlite"
+# Seconds a resolved album is used before it is fetched again.
+DEFAULT_ALBUM_TTL = 24 * 60 * 60
+DEFAULT_EXTENSION = ".jpg"
+IMAGE_URL = "http://i.imgur.com/{0}{1}"
+# Seconds to wait for a lock held by another process.
+LOCK_TIMEOUT = 30.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS albums (
+    album_id TEXT PRIMARY KEY,
+    items TEXT NOT NULL,
+    resolved REAL NOT NULL
+);
+"""
+
+HASH_REGEX = re.compile(r'"hash":"([^"]+)"')
+EXT_REGEX = re.compile(r'"ext":"(\.[A-Za-z0-9]+)')
+
+logger = logging.getLogger()
+
+
+def get_album_id(url):
+    # "http://imgur.com/a/abc12#0" -> "abc12"
+    parts = urllib.parse.urlparse(url).path.split("/")
+    if len(parts) >= 3 and parts[1] == "a" and parts[2]:
+        return parts[2]
+    return None
+
+
+def parse_album(text):
+    # Returns the (hash, extension) items of an album page, in order and
+    # without duplicates. The extension is the one of the image that follows
+    # the hash in the same JSON object.
+    items = list()
+    seen = set()
+    matches = list(HASH_REGEX.finditer(text))
+    for (i, match) in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        ext = EXT_REGEX.search(text, match.end(), end)
+        image_hash = match.group(1)
+        if image_hash in seen:
+            continue
+        seen.add(image_hash)
+        items.append((image_hash,
+                      ext.group(1).lower() if ext else DEFAULT_EXTENSION))
+    return items
+
+
+def get_image_urls(items):
+    return [IMAGE_URL.format(image_hash, ext) for (image_hash, ext) in items]
+
+
+class AlbumCache(object):
+    def __init__(self, path, ttl=DEFAULT_ALBUM_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=LOCK_TIMEOUT,
+                                          check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.executescript(SCHEMA)
+
+    def get(self, album_id):
+        # Returns the items of the album or None if it is unknown or too old.
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT items, resolved FROM albums WHERE album_id = ?",
+                (album_id,)).fetchone()
+        if row is None or time.time() - row[1] >= self.ttl:
+            return None
+        logger.debug("Using cached items of imgur album %s.", album_id)
+        return [tuple(item) for item in json.loads(row[0])]
+
+    def put(self, album_id, items):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO albums (album_id, items, resolved) "
+                "VALUES (?, ?, ?)", (album_id, json.dumps(items), time.time()))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+cache_path = None
+cache_ttl = DEFAULT_ALBUM_TTL
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def configure(path, ttl=DEFAULT_ALBUM_TTL):
+    # Enables the album cache. Every process opens its own connection.
+    global cache_path, cache_ttl
+    cache_path = path
+    cache_ttl = ttl
+
+
+def get_cache():
+    # Returns the AlbumCache of this process or None if it is disabled.
+    if not cache_path or cache_ttl <= 0:
+        return None
+    pid = os.getpid()
+    with _caches_lock:
+        cache = _caches.get(pid)
+        if cache is None:
+            # Connections inherited from the parent must not be used.
+            _caches.clear()
+            cache = _caches[pid] = AlbumCache(cache_path, cache_ttl)
+    return cache
+
+
+def get_cached_items(album_id):
+    cache = get_cache()
+    if cache is None or album_id is None:
+        return None
+    return cache.get(album_id)
+
+
+def cache_items(album_id, items):
+    cache = get_cache()
+    if cache is None or album_id is None or not items:
+        return
+    cache.put(album_id, items)
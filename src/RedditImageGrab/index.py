@@ -0,0 +1,177 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Index of the files in a destination directory.
+#
+# Every destination directory gets a small SQLite database that records the
+# downloaded files (by identifier, i.e. title, and source URL) and the reddit
+# links (by fullname) that have been completely downloaded. Lookups do not
+# need to list the directory anymore. It also keeps the newest link seen per
+# subreddit for --update.
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+INDEX_FILE_NAME = ".reddit-download.sqlite"
+# Seconds to wait for a lock held by another process.
+LOCK_TIMEOUT = 30.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    identifier TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    size INTEGER,
+    name TEXT,
+    url TEXT,
+    added REAL
+);
+CREATE INDEX IF NOT EXISTS files_url ON files (url);
+CREATE TABLE IF NOT EXISTS links (
+    name TEXT PRIMARY KEY,
+    url TEXT,
+    added REAL
+);
+CREATE TABLE IF NOT EXISTS cursors (
+    subreddit TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    updated REAL
+);
+"""
+
+logger = logging.getLogger()
+
+
+class DownloadIndex(object):
+    def __init__(self, destination):
+        self.destination = destination
+        self.path = os.path.join(destination, INDEX_FILE_NAME)
+        self.created = not os.path.exists(self.path)
+        # The index is shared between the stages of the download pipeline.
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT,
+                                          check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _exists(self, query, value):
+        with self.lock:
+            return self.connection.execute(query, (value,)).fetchone() \
+                is not None
+
+    def __contains__(self, identifier):
+        return self.has_identifier(identifier)
+
+    def has_identifier(self, identifier):
+        return self._exists("SELECT 1 FROM files WHERE identifier = ?",
+                            identifier)
+
+    def has_url(self, url):
+        return self._exists("SELECT 1 FROM files WHERE url = ?", url)
+
+    def has_link(self, name):
+        return self._exists("SELECT 1 FROM links WHERE name = ?", name)
+
+    def add_file(self, identifier, path, size, name=None, url=None):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO files (identifier, path, size, name, "
+                "url, added) VALUES (?, ?, ?, ?, ?, ?)",
+                (identifier, os.path.basename(path), size, name, url,
+                 time.time()))
+
+    def add_link(self, name, url=None):
+        # Marks a reddit link as completely downloaded.
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO links (name, url, added) VALUES "
+                "(?, ?, ?)", (name, url, time.time()))
+
+    def get_cursor(self, subreddit):
+        # Returns the fullname of the newest link seen in subreddit by the
+        # last complete update, or None.
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT name FROM cursors WHERE subreddit = ?",
+                (subreddit.lower(),)).fetchone()
+        return row[0] if row else None
+
+    def set_cursor(self, subreddit, name):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO cursors (subreddit, name, updated) "
+                "VALUES (?, ?, ?)", (subreddit.lower(), name, time.time()))
+
+    def rebuild(self):
+        # Replaces the file entries with the files found in the directory.
+        # Hidden files (the index itself, unfinished downloads) are ignored,
+        # identifiers never start with a dot. Fullnames and URLs are not
+        # stored on disk and are lost.
+        rows = list()
+        for entry in os.scandir(self.destination):
+            if entry.name.startswith(".") or not entry.is_file():
+                continue
+            rows.append((os.path.splitext(entry.name)[0], entry.name,
+                         entry.stat().st_size, entry.stat().st_mtime))
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM files")
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO files (identifier, path, size, "
+                "added) VALUES (?, ?, ?, ?)", rows)
+        logger.debug("Rebuilt index of \"%s\" with %d files.",
+                     self.destination, len(rows))
+        return len(rows)
+
+
+def open_index(destination):
+    # Opens the index of destination. Directories that were filled before the
+    # index existed are scanned once.
+    index = DownloadIndex(destination)
+    if index.created:
+        index.rebuild()
+    return index
+
+
+def rebuild_tree(directory):
+    # Rebuilds the index of every directory below directory that contains
+    # files or an index. Returns the number of indexed directories.
+    count = 0
+    for (root, dirs, files) in os.walk(directory):
+        # Hidden directories like the HTTP cache are not downloads.
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        if INDEX_FILE_NAME not in files and not any(
+                not name.startswith(".") for name in files):
+            continue
+        with DownloadIndex(root) as index:
+            files_indexed = index.rebuild()
+        logger.info("Indexed %d files in \"%s\".", files_indexed, root)
+        count += 1
+    return count
@@ -0,0 +1,161 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Filters on the links of a listing.
+#
+# The filter options are compiled once into a list of checks that only
+# contains the options that are set, the cheap ones first. They run on the
+# "data" objects of the listing JSON, so reddit.get_links() drops rejected
+# links before a RedditLink is made for them. Rejected links are counted per
+# subreddit and reason instead of being logged one by one.
+#
+# Domains match their subdomains, e.g. "imgur.com" matches "i.imgur.com".
+# The title and flair regular expressions have to match at the start, like
+# --regex always did.
+
+import collections
+import logging
+import re
+import time
+import urllib.parse
+
+# reasons a link is rejected for, in the order they are checked
+SCORE = "score"
+NSFW = "nsfw"
+SFW = "sfw"
+SELF = "self"
+AGE = "age"
+DOMAIN = "domain"
+FLAIR = "flair"
+TITLE = "title"
+REASONS = (SCORE, NSFW, SFW, SELF, AGE, DOMAIN, FLAIR, TITLE)
+
+logger = logging.getLogger()
+
+
+class LinkFilter(object):
+    def __init__(self, score=0, sfw=False, nsfw=False, regex=None,
+                 domains=None, exclude_domains=None, max_age=None,
+                 no_self=False, flair=None):
+        # score: minimum score
+        # sfw, nsfw: only links that are (not) marked as NSFW
+        # regex, flair: regular expressions for the title and the flair
+        # domains: only links to these domains, exclude_domains: none to these
+        # max_age: only links posted in the last max_age seconds
+        # no_self: no self posts
+        self.checks = list()
+        # Links below a score of 0 have always been skipped.
+        if score is not None:
+            self.checks.append((SCORE, lambda data: data["score"] >= score))
+        if sfw:
+            self.checks.append((NSFW, lambda data: not data["over_18"]))
+        if nsfw:
+            self.checks.append((SFW, lambda data: data["over_18"]))
+        if no_self:
+            self.checks.append((SELF,
+                                lambda data: not data.get("is_self", False)))
+        if max_age:
+            self.checks.append((AGE, lambda data: is_recent(data, max_age)))
+        if domains or exclude_domains:
+            included = set(get_domain(domain) for domain in domains or ())
+            excluded = set(get_domain(domain)
+                           for domain in exclude_domains or ())
+            self.checks.append((DOMAIN, lambda data: is_domain_allowed(
+                get_link_domain(data), included, excluded)))
+        if flair:
+            flair_compiled = re.compile(flair)
+            self.checks.append((FLAIR, lambda data: flair_compiled.match(
+                data.get("link_flair_text") or "") is not None))
+        if regex:
+            regex_compiled = re.compile(regex)
+            self.checks.append((TITLE, lambda data: regex_compiled.match(
+                data["title"]) is not None))
+
+    def __bool__(self):
+        return bool(self.checks)
+
+    def get_reason(self, data):
+        # Returns the reason data is rejected for or None if it passes.
+        for (reason, check) in self.checks:
+            if not check(data):
+                return reason
+        return None
+
+
+class Rejected(object):
+    # Links rejected by a LinkFilter. With split, they are kept per
+    # subreddit, for combined listings.
+    def __init__(self, split=False):
+        self.split = split
+        # subreddit -> Counter of reasons
+        self.counts = collections.defaultdict(collections.Counter)
+        # subreddit -> fullnames of the rejected links, they still move the
+        # cursor of --update
+        self.names = collections.defaultdict(list)
+
+    def _get_key(self, subreddit):
+        return (subreddit or "").lower() if self.split else None
+
+    def add(self, data, reason):
+        key = self._get_key(data.get("subreddit"))
+        self.counts[key][reason] += 1
+        self.names[key].append(data["name"])
+
+    def get(self, subreddit=None):
+        # Returns the Counter of reasons of subreddit.
+        return self.counts.get(self._get_key(subreddit),
+                               collections.Counter())
+
+    def get_names(self, subreddit=None):
+        return self.names.get(self._get_key(subreddit), [])
+
+
+def get_domain(domain):
+    return domain.lower().strip(".")
+
+
+def is_recent(data, max_age):
+    created = data.get("created_utc")
+    return created is None or time.time() - created <= max_age
+
+
+def get_link_domain(data):
+    # reddit sends the domain of the link, "self.SUBREDDIT" for self posts.
+    domain = data.get("domain")
+    if not domain:
+        domain = urllib.parse.urlsplit(data["url"]).hostname or ""
+    return domain.lower()
+
+
+def is_domain_allowed(domain, included, excluded):
+    # "i.imgur.com" is checked as "i.imgur.com", "imgur.com" and "com".
+    labels = domain.split(".")
+    suffixes = set(".".join(labels[i:]) for i in range(len(labels)))
+    if excluded and not suffixes.isdisjoint(excluded):
+        return False
+    return not included or not suffixes.isdisjoint(included)
+
+
+def log_rejected(subreddit, counts):
+    # counts: Counter of reasons, see Rejected.get()
+    if not counts:
+        return
+    logger.verbose("Filtered out %d links of /r/%s: %s", sum(counts.values()),
+                   subreddit, ", ".join("%d %s" % (counts[reason], reason)
+                                        for reason in REASONS
+                                        if counts[reason]))
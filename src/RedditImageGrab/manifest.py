@@ -0,0 +1,156 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Download manifests, written by a plan run and read by an execute run.
+#
+# A manifest has one JSON object per line and link:
+#
+#   {"name": "t3_1a2b3c", "title": "...", "score": 42, "nsfw": false,
+#    "url": "https://imgur.com/a/xyz", "subreddit": "pics",
+#    "destination": "mylist/pics", "urls": ["https://i.imgur.com/..."]}
+#
+# destination is relative to the DEST of the run, so a manifest can be
+# executed on another machine. The file names are made from the title, like
+# in a normal run. Lines are written as soon as a link is resolved, by all
+# workers, so an interrupted plan still leaves a usable manifest.
+
+import json
+import logging
+import os
+import os.path
+
+from . import metrics
+from . import reddit
+
+FIELDS = ("name", "title", "score", "nsfw", "url", "subreddit",
+          "destination", "urls")
+
+logger = logging.getLogger()
+
+
+class Writer(object):
+    def __init__(self, path, root, lock):
+        # root: DEST of the run, the destinations are written relative to it
+        # lock: multiprocessing.Lock shared by all workers
+        # The file is opened before the workers are forked, every line is
+        # appended with a single write.
+        self.path = path
+        self.root = root
+        self.lock = lock
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC |
+                          os.O_APPEND, 0o644)
+
+    def write(self, subreddit, destination, link, urls):
+        record = get_record(self.root, subreddit, destination, link, urls)
+        line = (json.dumps(record, sort_keys=True) + "\n").encode("utf-8")
+        with self.lock:
+            os.write(self.fd, line)
+        metrics.add("planned")
+
+    def close(self):
+        os.close(self.fd)
+
+
+def get_record(root, subreddit, destination, link, urls):
+    return {"name": link.name,
+            "title": link.title,
+            "score": link.score,
+            "nsfw": link.nsfw,
+            "url": link.url,
+            "subreddit": subreddit,
+            "destination": os.path.relpath(destination, root),
+            "urls": list(urls)}
+
+
+def get_link(record):
+    return reddit.RedditLink(record["title"], record["url"], record["name"],
+                             record["score"], record["nsfw"])
+
+
+def check_record(record):
+    if not isinstance(record, dict):
+        raise ValueError("Expected a JSON object")
+    missing = [field for field in FIELDS if field not in record]
+    if missing:
+        raise ValueError("Missing fields: {0}".format(", ".join(missing)))
+    if not isinstance(record["urls"], list):
+        raise ValueError("\"urls\" must be a list")
+    # Never write outside of DEST.
+    destination = os.path.normpath(record["destination"])
+    if (os.path.isabs(destination) or destination == os.curdir or
+            destination.split(os.sep)[0] == os.pardir):
+        raise ValueError("Invalid destination \"{0}\"".format(
+            record["destination"]))
+
+
+def parse_range(text):
+    # "FIRST-LAST", "FIRST-" or "-LAST", line numbers start at 1. Returns
+    # (first, last), None for an open end.
+    (first, separator, last) = text.partition("-")
+    if not separator:
+        raise ValueError("Expected FIRST-LAST, FIRST- or -LAST: "
+                         "\"{0}\"".format(text))
+    try:
+        first = int(first) if first.strip() else None
+        last = int(last) if last.strip() else None
+    except ValueError:
+        raise ValueError("Line numbers must be integers: \"{0}\"".format(text))
+    if (first is not None and first < 1) or (last is not None and last < 1):
+        raise ValueError("Line numbers start at 1: \"{0}\"".format(text))
+    if first is not None and last is not None and last < first:
+        raise ValueError("Empty range: \"{0}\"".format(text))
+    return (first, last)
+
+
+def read(paths, first=None, last=None):
+    # Yields the records of the manifests at paths. The lines of all
+    # manifests are numbered one after another, only the lines first to last
+    # (inclusive) are read. Raises ValueError with the file and line number
+    # if a line is invalid.
+    number = 0
+    for path in paths:
+        with open(path, encoding="utf-8") as manifest_file:
+            for (line_number, line) in enumerate(manifest_file, 1):
+                if not line.strip():
+                    continue
+                number += 1
+                if first is not None and number < first:
+                    continue
+                if last is not None and number > last:
+                    return
+                try:
+                    record = json.loads(line)
+                    check_record(record)
+                except ValueError as error:
+                    raise ValueError("{0}:{1}: {2}".format(
+                        path, line_number, error))
+                yield record
+
+
+def group_by_destination(records):
+    # Returns [(destination, [record, ...]), ...] in the order the
+    # destinations first appear.
+    groups = dict()
+    order = list()
+    for record in records:
+        destination = os.path.normpath(record["destination"])
+        if destination not in groups:
+            groups[destination] = list()
+            order.append(destination)
+        groups[destination].append(record)
+    return [(destination, groups[destination]) for destination in order]
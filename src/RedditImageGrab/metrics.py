@@ -0,0 +1,441 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Statistics of a run.
+#
+# Every worker process counts into its own WorkerMetrics and regularly sends
+# a complete snapshot of it to the main process over a queue. The Collector
+# in the main process keeps the latest snapshot of every worker and adds them
+# up, so no counter is ever updated by two processes. The totals can be
+# exported while the run is going, as a Prometheus text file or over HTTP,
+# and as JSON at the end.
+#
+# Besides the counters, every worker keeps histograms of the time it spends
+# in the phases of a download (see PHASES), so a slow run shows whether it
+# waits for the rate limit, the network or the disk.
+
+import contextlib
+import http.server
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger()
+
+# Seconds between two snapshots of a worker.
+DEFAULT_REPORT_INTERVAL = 5.0
+# Upper bounds of the request latency histogram in seconds.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+# Upper bounds of the phase histograms in seconds.
+PHASE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0,
+                 float("inf"))
+METRIC_PREFIX = "reddit_download_"
+# How often the collector checks whether it has been stopped.
+POLL_INTERVAL = 0.5
+
+# (name, help) of the counters kept by the workers
+COUNTERS = (
+    ("subreddits", "Subreddits that have been downloaded."),
+    ("processed", "Links that have been processed."),
+    ("downloaded", "Files that have been downloaded."),
+    ("skipped", "Links and files that have been skipped."),
+    ("errors", "Links and files that could not be downloaded."),
+    ("bytes", "Bytes of downloaded files."),
+    ("dedup_files", "Files that have been replaced by hardlinks."),
+    ("dedup_bytes_saved", "Disk space saved by hardlinks in bytes."),
+    ("dedup_bytes_avoided", "Bytes not transferred because the URL was "
+     "known."),
+    ("unsupported", "Links that have been skipped without a request because "
+     "their URL is not supported."),
+    ("rejected", "Responses that were not images and have been closed "
+     "early."),
+    ("rejected_bytes_avoided", "Bytes of rejected responses that have not "
+     "been transferred."),
+    ("planned", "Links that have been written to a download manifest."),
+    ("filtered", "Links of the listings that have been rejected by the "
+     "filters."),
+)
+# (name, help) of the gauges kept by the workers
+GAUGES = (
+    ("active_subreddits", "Subreddits that are being downloaded."),
+)
+# (name, help) of the phases whose wall clock time is measured
+PHASES = (
+    ("listing", "Fetching a page of a listing, including rate limit waits."),
+    ("resolve", "Resolving the image URLs of a link, including rate limit "
+     "waits."),
+    ("transfer", "Receiving the body of a file, without writing it."),
+    ("write", "Writing a file to disk and moving it into place."),
+    ("ratelimit", "Waiting for the rate limit of a host."),
+)
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # not cumulative, counts[i] is the number of values in
+        # (buckets[i - 1], buckets[i]]
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for (i, bound) in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        for (i, count) in enumerate(other.counts):
+            self.counts[i] += count
+        self.sum += other.sum
+        self.count += other.count
+
+    def to_dict(self):
+        return {"counts": list(self.counts), "sum": self.sum,
+                "count": self.count}
+
+    @classmethod
+    def from_dict(cls, data, buckets=LATENCY_BUCKETS):
+        histogram = cls(buckets)
+        histogram.counts = list(data["counts"])
+        histogram.sum = data["sum"]
+        histogram.count = data["count"]
+        return histogram
+
+
+class WorkerMetrics(object):
+    # Metrics of one process. Updated by all threads of the process.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {name: 0 for (name, _) in COUNTERS + GAUGES}
+        self.latencies = dict()
+        self.phases = dict()
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.values[name] += value
+
+    def observe_latency(self, host, seconds):
+        with self.lock:
+            histogram = self.latencies.get(host)
+            if histogram is None:
+                histogram = self.latencies[host] = Histogram()
+            histogram.observe(seconds)
+
+    def observe_phase(self, phase, seconds):
+        with self.lock:
+            histogram = self.phases.get(phase)
+            if histogram is None:
+                histogram = self.phases[phase] = Histogram(PHASE_BUCKETS)
+            histogram.observe(seconds)
+
+    def snapshot(self):
+        with self.lock:
+            return {"values": dict(self.values),
+                    "latencies": {host: histogram.to_dict() for
+                                  (host, histogram) in
+                                  self.latencies.items()},
+                    "phases": {phase: histogram.to_dict() for
+                               (phase, histogram) in self.phases.items()}}
+
+
+class Reporter(object):
+    # Sends snapshots of a WorkerMetrics to the collector, every interval
+    # seconds and once more when stopped.
+    def __init__(self, worker_metrics, outqueue, interval):
+        self.worker_metrics = worker_metrics
+        self.outqueue = outqueue
+        self.interval = interval
+        self.worker = "%s-%d" % (multiprocessing.current_process().name,
+                                 os.getpid())
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run,
+                                       name="metrics-reporter", daemon=True)
+        self.thread.start()
+
+    def _send(self):
+        self.outqueue.put((self.worker, self.worker_metrics.snapshot()))
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self._send()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        self._send()
+
+
+class Collector(object):
+    # Lives in the main process and merges the snapshots of all workers.
+    def __init__(self, inqueue, interval=DEFAULT_REPORT_INTERVAL,
+                 textfile=None, get_queue_depth=None):
+        # textfile: path of a Prometheus text file that is rewritten every
+        #           interval seconds
+        # get_queue_depth: function returning the number of subreddits that
+        #                  are still waiting for a worker
+        self.inqueue = inqueue
+        self.interval = interval
+        self.textfile = textfile
+        self.get_queue_depth = get_queue_depth
+        self.lock = threading.Lock()
+        self.snapshots = dict()
+        self.start_time = time.time()
+        # (time, downloaded, bytes) of the previous export, for the current
+        # throughput
+        self.previous = (self.start_time, 0, 0)
+        self.throughput = (0.0, 0.0)
+        self.stop_event = threading.Event()
+        self.server = None
+        self.thread = threading.Thread(target=self._run,
+                                       name="metrics-collector", daemon=True)
+        self.thread.start()
+
+    def _drain(self, timeout=0):
+        # Waits up to timeout seconds for the first snapshot, then takes
+        # everything that is already there.
+        while True:
+            try:
+                (worker, snapshot) = self.inqueue.get(timeout=timeout)
+            except queue.Empty:
+                return
+            with self.lock:
+                self.snapshots[worker] = snapshot
+            timeout = 0
+
+    def _run(self):
+        next_export = time.monotonic() + self.interval
+        while not self.stop_event.is_set():
+            self._drain(timeout=min(POLL_INTERVAL, max(
+                0.0, next_export - time.monotonic())))
+            if time.monotonic() >= next_export:
+                self._update_throughput()
+                self.write_textfile()
+                next_export += self.interval
+
+    def _update_throughput(self):
+        totals = self.get_totals()
+        now = time.time()
+        (then, downloaded, size) = self.previous
+        elapsed = max(now - then, 1e-6)
+        with self.lock:
+            self.throughput = (
+                (totals["values"]["downloaded"] - downloaded) / elapsed,
+                (totals["values"]["bytes"] - size) / elapsed)
+            self.previous = (now, totals["values"]["downloaded"],
+                             totals["values"]["bytes"])
+
+    def stop(self):
+        # Has to be called after all workers have exited.
+        self.stop_event.set()
+        self.thread.join()
+        self._drain(timeout=0)
+        self._update_throughput()
+        self.write_textfile()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def get_totals(self):
+        with self.lock:
+            snapshots = list(self.snapshots.values())
+            throughput = self.throughput
+        values = {name: 0 for (name, _) in COUNTERS + GAUGES}
+        latencies = dict()
+        phases = dict()
+        for snapshot in snapshots:
+            for (name, value) in snapshot["values"].items():
+                values[name] = values.get(name, 0) + value
+            for (host, data) in snapshot["latencies"].items():
+                histogram = latencies.setdefault(host, Histogram())
+                histogram.merge(Histogram.from_dict(data))
+            for (phase, data) in snapshot.get("phases", {}).items():
+                histogram = phases.setdefault(phase,
+                                              Histogram(PHASE_BUCKETS))
+                histogram.merge(Histogram.from_dict(data, PHASE_BUCKETS))
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        totals = {"values": values,
+                  "latencies": latencies,
+                  "phases": phases,
+                  "workers": len(snapshots),
+                  "elapsed": elapsed,
+                  "files_per_second": throughput[0],
+                  "bytes_per_second": throughput[1],
+                  "average_files_per_second": values["downloaded"] / elapsed,
+                  "average_bytes_per_second": values["bytes"] / elapsed}
+        if self.get_queue_depth is not None:
+            try:
+                totals["queued_subreddits"] = self.get_queue_depth()
+            except NotImplementedError:
+                # not available on every platform
+                pass
+        return totals
+
+    def to_prometheus(self):
+        totals = self.get_totals()
+        lines = list()
+
+        def add(name, metric_type, help_text, samples):
+            name = METRIC_PREFIX + name
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, metric_type))
+            for (labels, value) in samples:
+                lines.append("%s%s %s" % (name, labels, value))
+
+        for (name, help_text) in COUNTERS:
+            add(name + "_total", "counter", help_text,
+                [("", totals["values"][name])])
+        for (name, help_text) in GAUGES:
+            add(name, "gauge", help_text, [("", totals["values"][name])])
+        if "queued_subreddits" in totals:
+            add("queued_subreddits", "gauge", "Subreddits waiting for a "
+                "worker.", [("", totals["queued_subreddits"])])
+        add("files_per_second", "gauge", "Files downloaded per second "
+            "recently.", [("", "%.3f" % totals["files_per_second"])])
+        add("bytes_per_second", "gauge", "Bytes downloaded per second "
+            "recently.", [("", "%.3f" % totals["bytes_per_second"])])
+
+        def add_histograms(name, help_text, label, histograms):
+            if not histograms:
+                return
+            name = METRIC_PREFIX + name
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s histogram" % name)
+            for (key, histogram) in sorted(histograms.items()):
+                cumulative = 0
+                for (bound, count) in zip(histogram.buckets,
+                                          histogram.counts):
+                    cumulative += count
+                    lines.append('%s_bucket{%s="%s",le="%s"} %d' % (
+                        name, label, key,
+                        "+Inf" if bound == float("inf") else bound,
+                        cumulative))
+                lines.append('%s_sum{%s="%s"} %.6f' % (name, label, key,
+                                                       histogram.sum))
+                lines.append('%s_count{%s="%s"} %d' % (name, label, key,
+                                                       histogram.count))
+
+        add_histograms("request_duration_seconds", "Time until the response "
+                       "headers of a request arrived.", "host",
+                       totals["latencies"])
+        add_histograms("phase_duration_seconds", "Wall clock time spent in "
+                       "the phases of the downloads.", "phase",
+                       totals["phases"])
+        return "\n".join(lines) + "\n"
+
+    def to_json(self):
+        totals = self.get_totals()
+        for key in ("latencies", "phases"):
+            totals[key] = {
+                name: dict(histogram.to_dict(), buckets=[
+                    None if bound == float("inf") else bound
+                    for bound in histogram.buckets])
+                for (name, histogram) in totals[key].items()}
+        return json.dumps(totals, indent=2, sort_keys=True)
+
+    def write_textfile(self):
+        if not self.textfile:
+            return
+        _write_atomically(self.textfile, self.to_prometheus())
+
+    def write_json(self, path):
+        _write_atomically(path, self.to_json() + "\n")
+
+    def serve(self, port, address="127.0.0.1"):
+        # Serves the metrics at http://address:port/metrics.
+        collector = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = collector.to_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((address, port),
+                                                      Handler)
+        threading.Thread(target=self.server.serve_forever,
+                         name="metrics-server", daemon=True).start()
+        logger.debug("Serving metrics on http://%s:%d/metrics", address,
+                     self.server.server_address[1])
+
+
+def _write_atomically(path, text):
+    temp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(temp_path, "w") as temp_file:
+        temp_file.write(text)
+    os.replace(temp_path, path)
+
+
+# Metrics of this process, see start_reporting().
+worker_metrics = WorkerMetrics()
+_reporter = None
+
+
+def add(name, value=1):
+    worker_metrics.add(name, value)
+
+
+def observe_latency(host, seconds):
+    worker_metrics.observe_latency(host, seconds)
+
+
+def observe_phase(phase, seconds):
+    worker_metrics.observe_phase(phase, seconds)
+
+
+@contextlib.contextmanager
+def timed(phase):
+    # Measures the wall clock time of the block as phase.
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        worker_metrics.observe_phase(phase, time.monotonic() - start)
+
+
+def start_reporting(outqueue, interval=DEFAULT_REPORT_INTERVAL):
+    # Called by every worker process when it starts. The metrics inherited
+    # from the parent are dropped.
+    global worker_metrics, _reporter
+    worker_metrics = WorkerMetrics()
+    _reporter = Reporter(worker_metrics, outqueue, interval)
+
+
+def stop_reporting():
+    # Sends the final snapshot of this process.
+    global _reporter
+    if _reporter is not None:
+        _reporter.stop()
+        _reporter = None
@@ -0,0 +1,190 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A small producer/consumer pipeline built from threads and bounded queues.
+#
+# The first stage iterates over a source (e.g. reddit.get_links()) and every
+# following stage applies a function to the items of the previous one. The
+# last stage is the thread iterating over the pipeline. Every queue is
+# bounded, so a fast producer can only run a limited number of items ahead of
+# the consumer.
+
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger()
+
+# How often blocked stages check whether the pipeline has been closed.
+POLL_INTERVAL = 0.5
+
+_END = object()
+
+
+class _Failure(object):
+    def __init__(self, error):
+        self.error = error
+
+
+class StageStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        # Time spent doing actual work.
+        self.busy = 0.0
+        # Time spent waiting for the previous stage.
+        self.wait_input = 0.0
+        # Time spent waiting for the next stage to make room in the queue.
+        self.wait_output = 0.0
+
+    def __str__(self):
+        return ("stage %s: %d items, busy %.2fs, waited %.2fs for input and "
+                "%.2fs for output" % (self.name, self.items, self.busy,
+                                      self.wait_input, self.wait_output))
+
+
+class Pipeline(object):
+    def __init__(self, source, stages, queue_sizes, name="pipeline"):
+        # source: iterable producing the items of the first stage
+        # stages: list of (name, function) tuples, applied in order. The
+        #         first entry names the source stage and its function is
+        #         ignored.
+        # queue_sizes: maximum size of the queue behind every stage
+        if len(queue_sizes) != len(stages):
+            raise ValueError("Need one queue size per stage.")
+        self.name = name
+        self.stop = threading.Event()
+        self.queues = [queue.Queue(maxsize=max(size, 1))
+                       for size in queue_sizes]
+        self.stats = [StageStats(stage_name) for (stage_name, _) in stages]
+        self.stats.append(StageStats("consumer"))
+        self.threads = list()
+        self.threads.append(threading.Thread(
+            target=self._run_source, args=(source,),
+            name="%s-%s" % (name, stages[0][0]), daemon=True))
+        for (index, (stage_name, function)) in enumerate(stages[1:], 1):
+            self.threads.append(threading.Thread(
+                target=self._run_stage, args=(index, function),
+                name="%s-%s" % (name, stage_name), daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def _put(self, index, item):
+        outqueue = self.queues[index]
+        stats = self.stats[index]
+        start = time.monotonic()
+        try:
+            while not self.stop.is_set():
+                try:
+                    outqueue.put(item, timeout=POLL_INTERVAL)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        finally:
+            stats.wait_output += time.monotonic() - start
+
+    def _get(self, index):
+        # Returns the next item for stage index, which reads from the queue
+        # behind stage index - 1.
+        inqueue = self.queues[index - 1]
+        stats = self.stats[index]
+        start = time.monotonic()
+        try:
+            while not self.stop.is_set():
+                try:
+                    return inqueue.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    continue
+            return _END
+        finally:
+            stats.wait_input += time.monotonic() - start
+
+    def _run_source(self, source):
+        stats = self.stats[0]
+        iterator = iter(source)
+        try:
+            while not self.stop.is_set():
+                start = time.monotonic()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    stats.busy += time.monotonic() - start
+                stats.items += 1
+                if not self._put(0, item):
+                    break
+        except Exception as error:
+            self._put(0, _Failure(error))
+            return
+        finally:
+            if hasattr(iterator, "close"):
+                iterator.close()
+        self._put(0, _END)
+
+    def _run_stage(self, index, function):
+        stats = self.stats[index]
+        while True:
+            item = self._get(index)
+            if item is _END or isinstance(item, _Failure):
+                self._put(index, item)
+                return
+            start = time.monotonic()
+            try:
+                result = function(item)
+            except Exception as error:
+                self._put(index, _Failure(error))
+                return
+            finally:
+                stats.busy += time.monotonic() - start
+            stats.items += 1
+            if not self._put(index, result):
+                return
+
+    def __iter__(self):
+        index = len(self.queues)
+        stats = self.stats[index]
+        while True:
+            item = self._get(index)
+            if item is _END:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            stats.items += 1
+            start = time.monotonic()
+            try:
+                yield item
+            finally:
+                stats.busy += time.monotonic() - start
+
+    def close(self):
+        self.stop.set()
+        for thread in self.threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def log_stats(self, level=logging.DEBUG):
+        for stats in self.stats:
+            logger.log(level, "%s: %s", self.name, stats)
@@ -0,0 +1,128 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# cProfile for the worker processes.
+#
+# cProfile only sees the thread it was enabled in, so every thread started
+# while a worker is profiled (pipeline stages, album downloads, executor
+# threads of the event loop) gets a profile of its own. When the worker is
+# done, all of them are dumped into one file, and the main process merges
+# the files of all workers.
+
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+
+# Number of functions listed in the report.
+DEFAULT_REPORT_LINES = 25
+DEFAULT_SORT = "cumulative"
+
+logger = logging.getLogger()
+
+
+class WorkerProfiler(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.profiles = list()
+
+    def _add_profile(self):
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def _start_thread(self, frame, event, arg):
+        # Installed by threading.setprofile(), runs once in every new thread
+        # and replaces itself with a profiler.
+        sys.setprofile(None)
+        self._add_profile()
+
+    def start(self):
+        threading.setprofile(self._start_thread)
+        self._add_profile()
+
+    def stop(self, path):
+        # Has to be called by the thread that called start(), after all other
+        # threads have finished.
+        threading.setprofile(None)
+        with self.lock:
+            profiles = list(self.profiles)
+        # Stats() of a profile disables it in the current thread only, the
+        # profile of this thread is the first one.
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            try:
+                stats.add(profile)
+            except TypeError:
+                # the thread did not call anything while it was profiled
+                pass
+        stats.dump_stats(path)
+
+
+def get_worker_path(path, worker):
+    return "%s.%s" % (path, worker)
+
+
+def merge(path, worker_paths):
+    # Merges the profiles of the workers into path and removes them. Returns
+    # the merged pstats.Stats or None if there are no profiles.
+    stats = None
+    for worker_path in worker_paths:
+        if not os.path.exists(worker_path):
+            logger.warning("No profile of a worker at \"%s\".", worker_path)
+            continue
+        if stats is None:
+            stats = pstats.Stats(worker_path)
+        else:
+            stats.add(worker_path)
+        os.remove(worker_path)
+    if stats is not None:
+        stats.dump_stats(path)
+    return stats
+
+
+def format_report(stats, lines=DEFAULT_REPORT_LINES, sort=DEFAULT_SORT):
+    output = io.StringIO()
+    stats.stream = output
+    stats.sort_stats(sort).print_stats(lines)
+    return output.getvalue()
+
+
+profiler = None
+
+
+def start(path):
+    # Starts profiling this process if path is set. Called by the workers.
+    global profiler
+    profiler = None
+    if path:
+        profiler = WorkerProfiler()
+        profiler.start()
+
+
+def stop(path, worker):
+    # Writes the profile of this process to get_worker_path(path, worker).
+    global profiler
+    if profiler is None:
+        return
+    profiler.stop(get_worker_path(path, worker))
+    profiler = None
@@ -0,0 +1,166 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Per-host token buckets shared by all worker processes.
+#
+# The state of every bucket lives in shared memory that is created when this
+# module is imported, so all processes forked afterwards draw from the same
+# budget. Hosts that are listed in the rate table get a bucket of their own,
+# all other hosts are hashed into a fixed number of shared buckets using the
+# default rate.
+
+import ctypes
+import logging
+import multiprocessing
+import time
+import urllib.parse
+import zlib
+
+from . import metrics
+
+logger = logging.getLogger()
+
+# host: (requests per second, burst)
+# reddit asks for no more than thirty requests per minute, see
+# https://github.com/reddit/reddit/wiki/API
+DEFAULT_HOST_RATES = {
+    "www.reddit.com": (0.5, 1),
+    "imgur.com": (5.0, 5),
+    "i.imgur.com": (20.0, 20),
+}
+DEFAULT_RATE = (5.0, 5)
+# Number of buckets for hosts that are not in the rate table.
+DEFAULT_SHARED_BUCKETS = 32
+# Maximum number of hosts in the rate table.
+MAX_CONFIGURED_HOSTS = 64
+
+# Layout of a single bucket in the shared array.
+_TOKENS = 0
+_UPDATED = 1
+_RATE = 2
+_BURST = 3
+_FIELDS = 4
+
+
+class HostRateLimiter(object):
+    def __init__(self, host_rates=None, default_rate=DEFAULT_RATE,
+                 shared_buckets=DEFAULT_SHARED_BUCKETS):
+        self.default_rate = default_rate
+        self.shared_buckets = shared_buckets
+        # host -> bucket index. Only changed before the workers are started,
+        # the processes inherit a copy.
+        self.hosts = {}
+        self.state = multiprocessing.Array(
+            ctypes.c_double,
+            (MAX_CONFIGURED_HOSTS + shared_buckets) * _FIELDS)
+        for index in range(shared_buckets):
+            self._init_bucket(MAX_CONFIGURED_HOSTS + index, *default_rate)
+        for (host, (rate, burst)) in (host_rates or {}).items():
+            self.set_rate(host, rate, burst)
+
+    def _init_bucket(self, index, rate, burst):
+        offset = index * _FIELDS
+        with self.state.get_lock():
+            self.state[offset + _TOKENS] = burst
+            self.state[offset + _UPDATED] = 0
+            self.state[offset + _RATE] = rate
+            self.state[offset + _BURST] = burst
+
+    def set_rate(self, host, rate, burst=1):
+        # New hosts have to be added before the workers are started, the rate
+        # of known hosts can be changed at any time.
+        if rate <= 0 or burst < 1:
+            raise ValueError("Invalid rate %s/%s for host %s" % (rate, burst,
+                                                                 host))
+        index = self.hosts.get(host)
+        if index is None:
+            if len(self.hosts) >= MAX_CONFIGURED_HOSTS:
+                raise ValueError("Too many hosts in the rate table.")
+            index = len(self.hosts)
+            self.hosts[host] = index
+            self._init_bucket(index, rate, burst)
+            return
+        offset = index * _FIELDS
+        with self.state.get_lock():
+            self.state[offset + _RATE] = rate
+            self.state[offset + _BURST] = burst
+            self.state[offset + _TOKENS] = min(self.state[offset + _TOKENS],
+                                               burst)
+
+    def _bucket(self, host):
+        index = self.hosts.get(host)
+        if index is None:
+            index = MAX_CONFIGURED_HOSTS + \
+                zlib.crc32(host.encode("utf-8")) % self.shared_buckets
+        return index * _FIELDS
+
+    def reserve(self, host):
+        # Takes a token from the bucket of host and returns the number of
+        # seconds the caller has to wait before sending the request. Tokens
+        # may go negative, so concurrent callers queue up behind each other
+        # instead of waking up at the same time.
+        offset = self._bucket(host)
+        with self.state.get_lock():
+            now = time.monotonic()
+            tokens = self.state[offset + _TOKENS]
+            updated = self.state[offset + _UPDATED]
+            rate = self.state[offset + _RATE]
+            burst = self.state[offset + _BURST]
+            if updated:
+                tokens = min(burst, tokens + (now - updated) * rate)
+            tokens -= 1
+            self.state[offset + _TOKENS] = tokens
+            self.state[offset + _UPDATED] = now
+        if tokens >= 0:
+            return 0.0
+        return -tokens / rate
+
+    def acquire(self, host):
+        # Blocks until a request to host may be sent. Returns the time slept.
+        wait = self.reserve(host)
+        if wait > 0:
+            logger.debug("Rate limit for %s reached, waiting %.3f seconds.",
+                         host, wait)
+            time.sleep(wait)
+        return wait
+
+
+def get_host(url):
+    return urllib.parse.urlparse(url).netloc.lower()
+
+
+def parse_rate(value):
+    # Parses "HOST=RATE[/BURST]" into (host, rate, burst).
+    try:
+        (host, rate) = value.split("=", 1)
+        burst = 1
+        if "/" in rate:
+            (rate, burst) = rate.split("/", 1)
+        return (host.strip().lower(), float(rate), int(burst))
+    except ValueError:
+        raise ValueError("Invalid rate \"%s\", expected HOST=RATE[/BURST]" %
+                         value)
+
+
+limiter = HostRateLimiter(DEFAULT_HOST_RATES)
+
+
+def acquire(url):
+    wait = limiter.acquire(get_host(url))
+    metrics.observe_phase("ratelimit", max(0.0, wait))
+    return wait
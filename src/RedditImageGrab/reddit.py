@@ -17,42 +17,150 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-import multiprocessing
 import socket
-import time
 
 import requests
 
+from . import httpcache
+from . import linkfilter
+from . import metrics
+from . import ratelimit
+
 USER_AGENT = ("reddit-download script. "
               "http://github.com/whatevsz/reddit-download")
+REDDIT_URL = "http://www.reddit.com/r/"
 REDDIT_LINK_LIMIT = 1000
+# reddit sends at most this many links per page, whatever limit asks for.
+REDDIT_PAGE_SIZE = 100
 REDDIT_MIN_TIMEOUT = 2000
+# fields of a link every listing has to contain
+LINK_FIELDS = ("title", "url", "name", "score", "over_18")
 TIMEOUT = 10.0
 
+SORT_HOT = "hot"
+SORT_NEW = "new"
+SORT_TOP = "top"
+SORTS = (SORT_HOT, SORT_NEW, SORT_TOP)
+# time windows of the top listing
+TIME_FILTERS = ("hour", "day", "week", "month", "year", "all")
+
 logger = logging.getLogger()
 
 # Disable logging for the requests module.
 requests_log = logging.getLogger("requests")
 requests_log.setLevel(logging.WARNING)
 
-lock = multiprocessing.Lock()
-
 
 class RedditLink(object):
-    def __init__(self, title, url, name, score, nsfw):
+    def __init__(self, title, url, name, score, nsfw, subreddit=None):
         self.nsfw = nsfw
         self.name = name
         self.url = url
         self.score = score
         self.title = title
+        self.subreddit = subreddit
 
 
-def get_links(subreddit, timeout=REDDIT_MIN_TIMEOUT, limit=None, headers=None,
-              params=None):
-    # param limit:
-    # return LIMIT links, up to an upstream maximum of 1000
-    # if None or 0, request as many links as possible
+# Splits the links of a combined listing of several subreddits ("a+b+c") by
+# their subreddit. Every subreddit gets up to limit links; it is done once it
+# has them or once the listing reaches its stop_at. The "new" listing is
+# ordered by age across all subreddits, so a link that is not newer than the
+# stop_at of a subreddit ends that subreddit, whichever subreddit the link
+# belongs to. Links rejected by the filter of the listing are kept in
+# rejected, only those of subreddits that are not done yet.
+class LinkSplitter(object):
+    def __init__(self, subreddits, limit=None, stop_at=None):
+        # stop_at: {subreddit: fullname or None}, see get_links()
+        self.limit = limit or REDDIT_LINK_LIMIT
+        self.links = dict((subreddit.lower(), list())
+                          for subreddit in subreddits)
+        self.stop_at = dict((subreddit.lower(), name) for (subreddit, name)
+                            in (stop_at or {}).items() if name)
+        self.open = set(self.links)
+        self.rejected = linkfilter.Rejected(split=True)
+
+    def is_past_end(self, link_data):
+        # Called by get_links() with every link before it is filtered.
+        # Returns True once no subreddit wants more links.
+        for (subreddit, name) in list(self.stop_at.items()):
+            if not is_newer(link_data["name"], name):
+                logger.debug("Reached already seen link %s in /r/%s.",
+                             name, subreddit)
+                self.open.discard(subreddit)
+                del self.stop_at[subreddit]
+        return not self.open
+
+    def add(self, link):
+        # Returns False once no subreddit wants more links.
+        subreddit = (link.subreddit or "").lower()
+        if subreddit in self.open:
+            self.links[subreddit].append(link)
+            if len(self.links[subreddit]) >= self.limit:
+                self.open.discard(subreddit)
+        return bool(self.open)
+
+    def add_rejected(self, link_data, reason):
+        if (link_data.get("subreddit") or "").lower() in self.open:
+            self.rejected.add(link_data, reason)
+
+    def get_links(self, subreddit):
+        return self.links.get(subreddit.lower(), [])
+
+
+def get_listing_url(subreddit, sort=None):
+    # The front page of a subreddit is its hot listing.
+    if sort and sort != SORT_HOT:
+        return REDDIT_URL + subreddit + "/" + sort + ".json"
+    return REDDIT_URL + subreddit + ".json"
+
+
+def get_combined_name(subreddits):
+    # One listing of all subreddits, see LinkSplitter.
+    return "+".join(subreddits)
+
+
+def get_listing_params(sort=None, time_filter=None):
+    params = dict()
+    if sort == SORT_TOP and time_filter:
+        params["t"] = time_filter
+    return params
+
+
+def get_page_size(limit, links):
+    # Number of links to ask for with the next page, when links of limit
+    # have been seen.
+    return min(REDDIT_PAGE_SIZE, limit - links)
+
+
+def is_past_end(name, score, subreddit, sort=None, stop_at=None,
+                min_score=None):
+    # Whether the listing can stop before the link with the fullname name,
+    # because it and all links after it are either known (stop_at) or score
+    # lower than min_score.
+    if stop_at and not is_newer(name, stop_at):
+        logger.debug("Reached already seen link %s in /r/%s.", name,
+                     subreddit)
+        return True
+    # The top listing is ordered by score.
+    if sort == SORT_TOP and min_score is not None and score < min_score:
+        logger.debug("Reached link %s with a score of %s in /r/%s, the rest "
+                     "of the top listing scores lower than %s.", name, score,
+                     subreddit, min_score)
+        return True
+    return False
+
+
+def get_id(fullname):
+    # Fullnames look like "t3_1a2b3c", the part after the underscore is a
+    # base 36 number that grows with every new post.
+    return int(fullname.split("_", 1)[-1], 36)
+
+
+def is_newer(fullname, other):
+    return get_id(fullname) > get_id(other)
+
 
+def check_timeout(timeout):
     # timeout must be at least 2000 ms, otherwise a warning will be issued and
     # 2000 will be selected, as reddit asks for a 2 second timeout between
     # requests:
@@ -60,64 +168,133 @@ def get_links(subreddit, timeout=REDDIT_MIN_TIMEOUT, limit=None, headers=None,
     #  Make no more than thirty requests per minute. This allows some
     # burstiness to your requests, but keep it sane. On average, we should see
     # no more than one request every two seconds from you.
+    if timeout < REDDIT_MIN_TIMEOUT:
+        logger.warning("A timeout of %d milliseconds is against the reddit "
+                       "API rules. It will be set to %d milliseconds instead.",
+                       timeout, REDDIT_MIN_TIMEOUT)
+        timeout = REDDIT_MIN_TIMEOUT
+    return timeout
+
+
+def set_rate(timeout=REDDIT_MIN_TIMEOUT):
+    # Keeps the listing requests of all processes together at one per
+    # timeout milliseconds. The rate limiter is shared memory, this has to be
+    # called before the workers are started.
+    timeout = check_timeout(timeout)
+    ratelimit.limiter.set_rate(ratelimit.get_host(REDDIT_URL),
+                               1000.0 / timeout)
+
+
+def parse_listing(json_data):
+    # Returns a tuple ([link data, ...], after) for one page of a listing,
+    # the "data" objects of the links as they are. Links without one of
+    # LINK_FIELDS are left out. Raises KeyError if the JSON is not a valid
+    # listing.
+    page = list()
+    for link in json_data["data"]["children"]:
+        link_data = link.get("data") if isinstance(link, dict) else None
+        if not isinstance(link_data, dict):
+            logger.verbose("Skipping an invalid link of the listing.")
+            continue
+        missing = [field for field in LINK_FIELDS if field not in link_data]
+        if missing:
+            logger.verbose("Skipping link %s of the listing, it has no %s.",
+                           link_data.get("name"), ", ".join(missing))
+            continue
+        page.append(link_data)
+    return (page, json_data["data"]["after"])
+
+
+def get_link(link_data, link_filter=None, rejected=None):
+    # Returns the RedditLink of the data of a link, or None if link_filter
+    # rejects it. Rejected links are passed to rejected(link_data, reason)
+    # instead, see linkfilter.Rejected.
+    if link_filter:
+        reason = link_filter.get_reason(link_data)
+        if reason is not None:
+            if rejected is not None:
+                rejected(link_data, reason)
+            return None
+    return RedditLink(link_data["title"],
+                      link_data["url"],
+                      link_data["name"],
+                      link_data["score"],
+                      link_data["over_18"],
+                      link_data.get("subreddit"))
+
 
-    url = "http://www.reddit.com/r/" + subreddit + ".json"
+def get_links(subreddit, limit=None, headers=None, params=None, sort=None,
+              stop_at=None, time_filter=None, min_score=None,
+              link_filter=None, rejected=None, stop=None):
+    # param limit:
+    # return LIMIT links, up to an upstream maximum of 1000
+    # if None or 0, request as many links as possible
+    # param sort:
+    # listing to fetch, one of SORTS. The default is reddit's front page of
+    # the subreddit ("hot")
+    # param stop_at:
+    # fullname of a link, stop as soon as a link that is not newer shows up.
+    # Only makes sense with sort="new"
+    # param time_filter:
+    # time window of the top listing, one of TIME_FILTERS
+    # param min_score:
+    # stop as soon as a link scores lower. Only used with sort="top"
+    # param link_filter:
+    # linkfilter.LinkFilter, links it rejects are not returned but passed to
+    # rejected(link data, reason). They count against limit.
+    # param stop:
+    # called with the data of every link before it is filtered, the listing
+    # stops once it returns True. See LinkSplitter.is_past_end()
+
+    url = get_listing_url(subreddit, sort)
 
     headers = {'User-Agent': USER_AGENT}
 
     headers = headers or {}
     params = params or {}
+    params.update(get_listing_params(sort, time_filter))
     limit = limit or REDDIT_LINK_LIMIT
-    params["limit"] = limit
-    if timeout < REDDIT_MIN_TIMEOUT:
-        logger.warning("A timeout of %d milliseconds is against the reddit "
-                       "API rules. It will be set to %d milliseconds instead.",
-                       timeout, REDDIT_MIN_TIMEOUT)
-        timeout = REDDIT_MIN_TIMEOUT
+
+    # Throttling is done by the rate limiter shared by all processes, see
+    # set_rate().
 
     links = 0
-    last_request = 0
-    firstrun = True
-    # sends a request and locks for timeout milliseconds
     while links < limit:
-        with lock:
-            time_since_last_request = time.monotonic() - last_request
-            if time_since_last_request < timeout / 1000 and not firstrun:
-                sleeptime = timeout / 1000 - time_since_last_request
-                time.sleep(sleeptime)
-            firstrun = False
-            last_request = time.monotonic()
-            json_data = None
-            try:
-                json_data = requests.get(
+        params["limit"] = get_page_size(limit, links)
+        json_data = None
+        try:
+            # Unchanged pages are answered by the HTTP cache, if enabled.
+            with metrics.timed("listing"):
+                json_data = httpcache.get(
                     url, params=params, headers=headers, timeout=TIMEOUT).\
                     json()
-            except (requests.packages.urllib3.exceptions.TimeoutError,
-                    TimeoutError, requests.exceptions.Timeout,
-                    socket.timeout):
-                logger.verbose("Connection to \"%s\" timed out.", url)
-            except ValueError:
-                pass
-            try:
-                if json_data:
-                    for link in json_data["data"]["children"]:
-                        link_data = link["data"]
-                        link = RedditLink(link_data["title"],
-                                          link_data["url"],
-                                          link_data["name"],
-                                          link_data["score"],
-                                          link_data["over_18"])
-                        yield link
-                        links += 1
-                        if links >= limit:
-                            return
-                else:
-                    return
-            except KeyError:
-                logger.error("URL \"%s\" returned an invalid JSON. Skipping "
-                             "this page.", url)
-                continue
-        after = json_data["data"]["after"]
+        except (requests.packages.urllib3.exceptions.TimeoutError,
+                TimeoutError, requests.exceptions.Timeout,
+                socket.timeout):
+            logger.verbose("Connection to \"%s\" timed out.", url)
+        except ValueError:
+            pass
+        if not json_data:
+            return
+        try:
+            (page, after) = parse_listing(json_data)
+        except (KeyError, TypeError):
+            # There is no "after" to continue with.
+            logger.error("URL \"%s\" returned an invalid listing, stopping "
+                         "here.", url)
+            return
+        for link_data in page:
+            if is_past_end(link_data["name"], link_data["score"], subreddit,
+                           sort, stop_at, min_score):
+                return
+            if stop is not None and stop(link_data):
+                return
+            links += 1
+            link = get_link(link_data, link_filter, rejected)
+            if link:
+                yield link
+            if links >= limit:
+                return
         if not after:
             # last page
             return
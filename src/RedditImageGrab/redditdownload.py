@@ -1,24 +1,114 @@
 import argparse
+import concurrent.futures
+import errno
+import functools
+import hashlib
 import http.client
-import io
+import itertools
+import json
 import logging
-import multiprocessing
 import os
 import os.path
-import re
 import socket
+import threading
 import time
 import urllib.error
 import urllib.parse
 import urllib.request
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 import requests
 
+from . import budget
+from . import classify
+from . import dedup
+from . import httpcache
+from . import imgur
+from . import index
+from . import linkfilter
+from . import manifest
+from . import metrics
+from . import pipeline
+from . import ratelimit
 from . import reddit
+from . import session
 
 USER_AGENT = ("reddit-download script. "
               "http://github.com/whatevsz/reddit-download")
 TIMEOUT = 10.0
+# Size of the pieces the response body is read in.
+DEFAULT_CHUNK_SIZE = 64 * 1024
+# Write buffer of the destination file.
+DEFAULT_BUFFER_SIZE = 256 * 1024
+# Unfinished downloads are kept as ".<hash of the URL>.part" in the
+# destination directory, next to a ".part.json" file with their validators.
+PART_PREFIX = "."
+PART_SUFFIX = ".part"
+PART_META_SUFFIX = ".part.json"
+# Number of times an interrupted transfer is continued right away.
+DEFAULT_RESUME_RETRIES = 2
+
+# Downloaded files get the usual permissions according to the umask.
+_umask = os.umask(0)
+os.umask(_umask)
+FILE_MODE = 0o666 & ~_umask
+# Number of links the listing stage may fetch ahead of the downloads.
+DEFAULT_LISTING_QUEUE_SIZE = 200
+# Number of resolved links waiting to be downloaded.
+DEFAULT_RESOLVE_QUEUE_SIZE = 20
+
+RESOLVE_OK = 0
+RESOLVE_EMPTY = 1
+RESOLVE_SKIPPED = 2
+RESOLVE_ERROR = 3
+
+# Responses without a content-type or with one of these are accepted or
+# rejected by the first bytes of their body.
+GENERIC_MIME_TYPES = ("", "application/octet-stream", "binary/octet-stream")
+# (magic number, extension) of the accepted file types
+MAGIC_NUMBERS = ((b"\xff\xd8\xff", ".jpg"),
+                 (b"\x89PNG\r\n\x1a\n", ".png"),
+                 (b"GIF87a", ".gif"),
+                 (b"GIF89a", ".gif"))
+# Bytes of the body needed to recognize the file type.
+SNIFF_SIZE = max(len(magic) for (magic, _) in MAGIC_NUMBERS)
+
+# Number of files of an album that are downloaded at the same time from one
+# host.
+DEFAULT_ALBUM_CONCURRENCY = 4
+
+# Outcome of a single file of a link.
+ITEM_DOWNLOADED = 0
+ITEM_SKIPPED = 1
+ITEM_ERROR = 2
+ITEM_BUDGET = 3
+ITEM_NOT_STARTED = 4
+
+DOWNLOAD_ERRORS = (urllib.error.HTTPError,
+                   urllib.error.URLError,
+                   http.client.HTTPException,
+                   TimeoutError,
+                   UnicodeEncodeError,
+                   ConnectionError,
+                   requests.exceptions.RequestException,
+                   requests.exceptions.ConnectionError,
+                   requests.exceptions.HTTPError,
+                   requests.packages.urllib3.exceptions.DecodeError,
+                   requests.packages.urllib3.exceptions.LocationParseError,
+                   ValueError)
+
+# Errors that interrupt a transfer, which can be continued afterwards.
+TRANSFER_ERRORS = (requests.exceptions.ConnectionError,
+                   requests.exceptions.ChunkedEncodingError,
+                   requests.exceptions.Timeout,
+                   requests.packages.urllib3.exceptions.TimeoutError,
+                   socket.timeout,
+                   ConnectionError,
+                   TimeoutError)
 
 logger = logging.getLogger()
 
@@ -31,53 +121,35 @@ class FileExistsException(Exception):
     """Exception raised when file exists in specified directory"""
 
 
-request_timeout_lock = multiprocessing.Lock()
-request_imgur_album_lock = multiprocessing.Lock()
-last_request = 0
-firstrun = True
-
+def urlopen_timeout_wrapper(url, stream=False, headers=None):
+    # waits for the rate limit of the host and sends the request
+    ratelimit.acquire(url)
 
-def urlopen_timeout_wrapper(url, lock, timeout=200):
-    global last_request, firstrun
-    # sends a request and locks for timeout milliseconds
-    with lock:
-        time_since_last_request = time.monotonic() - last_request
-        if time_since_last_request < timeout / 1000 and not firstrun:
-            sleeptime = timeout / 1000 - time_since_last_request
-            time.sleep(sleeptime)
-        firstrun = False
-        last_request = time.monotonic()
-
-        logger.debug("Opening URL \"%s\"", url)
-        response = None
-        try:
-            response = requests.get(url, timeout=TIMEOUT)
-        except (requests.packages.urllib3.exceptions.TimeoutError,
-                requests.exceptions.Timeout,
-                socket.timeout):
-            raise
+    logger.debug("Opening URL \"%s\"", url)
+    response = None
+    try:
+        response = session.get(url, timeout=TIMEOUT, stream=stream,
+                               headers=headers)
+    except (requests.packages.urllib3.exceptions.TimeoutError,
+            requests.exceptions.Timeout,
+            socket.timeout):
+        raise
 
     return response
 
 
-def download_from_url(url, destination, identifier, files_in_dest,
-                      max_filename_len):
-    # Extension is not significant
-    if identifier in files_in_dest:
-        raise FileExistsException('URL \"%s\" already downloaded.' % url)
-
+def get_extension(url, filetype_mime):
     # Imgur does not care about extensions. If a MIME type is available, we
     # will change the extension accordingly if necessary
-    response = None
-    try:
-        response = urlopen_timeout_wrapper(url, request_timeout_lock)
-    except (requests.packages.urllib3.exceptions.TimeoutError,
-            requests.exceptions.Timeout, socket.timeout) as error:
-        raise
+    filetype_mime = get_mime_type(filetype_mime)
+    # HTML pages and videos are rejected even if the URL looks like an image
+    if (filetype_mime not in GENERIC_MIME_TYPES and
+            not filetype_mime.startswith("image/")):
+        raise WrongFileTypeException(
+            'WRONG FILE TYPE: URL \"%s\" is of type \"%s\"' % (
+                url, filetype_mime))
+
     extension_mime = None
-    filetype_mime = None
-    if 'content-type' in response.headers.keys():
-        filetype_mime = response.headers['content-type']
     if filetype_mime == "image/jpeg" or filetype_mime == "image/jpg":
         extension_mime = ".jpg"
     elif filetype_mime == "image/png":
@@ -96,7 +168,64 @@ def download_from_url(url, destination, identifier, files_in_dest,
         raise WrongFileTypeException(
             'WRONG FILE TYPE: URL \"%s\" has is of type \"%s\"' % (url,
                                                                    extension))
+    return extension
+
+
+def get_mime_type(content_type):
+    # "text/html; charset=utf-8" -> "text/html"
+    return (content_type or "").split(";")[0].strip().lower()
+
+
+def needs_sniffing(headers, offset=0):
+    # Whether the file type has to be taken from the start of the body. Not
+    # possible for continued downloads, they keep the type of the URL.
+    return (not offset and
+            get_mime_type(headers.get("content-type")) in GENERIC_MIME_TYPES)
+
+
+def sniff_extension(head):
+    for (magic, extension) in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return extension
+    return None
+
+
+def check_response(url, headers, head=None):
+    # Returns the extension of the file in a response, decided from its
+    # content-type or, see needs_sniffing(), from head, the first bytes of
+    # the body. Raises WrongFileTypeException before the rest of the body is
+    # read, its size is counted as not transferred.
+    try:
+        if head is not None:
+            extension = sniff_extension(head)
+            if extension is None:
+                raise WrongFileTypeException(
+                    'WRONG FILE TYPE: URL \"%s\" is not an image' % url)
+            return extension
+        return get_extension(url, headers.get("content-type"))
+    except WrongFileTypeException:
+        avoided = 0
+        try:
+            avoided = max(0, int(headers.get("content-length")) -
+                          len(head or b""))
+        except (TypeError, ValueError):
+            pass
+        metrics.add("rejected")
+        metrics.add("rejected_bytes_avoided", avoided)
+        raise
 
+
+def read_head(chunks, size=SNIFF_SIZE):
+    # Reads from the chunks iterator until there are at least size bytes.
+    head = b""
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= size:
+            break
+    return head
+
+
+def get_file_name(identifier, extension, max_filename_len):
     dest_file_name = identifier + extension
 
     # Shortened too long filenames
@@ -105,70 +234,396 @@ def download_from_url(url, destination, identifier, files_in_dest,
                     "truncated to %d characters.", dest_file_name,
                     max_filename_len)
         dest_file_name = truncate_filename(dest_file_name, max_filename_len)
+    return dest_file_name
+
+
+class PartFile(object):
+    # Files are written to a part file in the destination directory first and
+    # renamed when they are complete, so an interrupted download never leaves
+    # a truncated file behind. The name starts with a dot, which identifiers
+    # never do (see get_identifier()). The part file is named after the URL
+    # and kept together with the ETag or Last-Modified header of the
+    # response, so an interrupted transfer can be continued with a Range
+    # request, in the same run or the next one.
+    def __init__(self, destination, url):
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()[:20]
+        self.path = os.path.join(destination, PART_PREFIX + key + PART_SUFFIX)
+        self.meta_path = os.path.join(destination,
+                                      PART_PREFIX + key + PART_META_SUFFIX)
+        self.url = url
+        # validator belongs to the data in the part file, response_validator
+        # to the response being received. The part file only takes the new
+        # one when open() has truncated it, an error before that keeps the
+        # old data together with its own validator.
+        self.validator = None
+        self.response_validator = None
+        self.offset = 0
+        self.filehandle = None
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.meta_path) as meta_file:
+                meta = json.load(meta_file)
+            offset = os.path.getsize(self.path)
+        except (OSError, ValueError):
+            return
+        if meta.get("url") == self.url and meta.get("validator"):
+            self.validator = meta["validator"]
+            self.offset = offset
+
+    def get_request_headers(self):
+        # Asks for the rest of the file, but only if it has not changed.
+        if not self.offset:
+            return {}
+        logger.debug("Continuing \"%s\" at byte %d.", self.url, self.offset)
+        return {"Range": "bytes=%d-" % self.offset,
+                "If-Range": self.validator}
+
+    def accept_response(self, status, headers):
+        # Returns True if the response continues the part file. Otherwise the
+        # server does not support ranges or the file has changed, and it is
+        # downloaded from the start.
+        if self.offset and status == 206 and headers.get(
+                "content-range", "").startswith("bytes %d-" % self.offset):
+            self.response_validator = self.validator
+            return True
+        if self.offset:
+            logger.debug("Cannot continue \"%s\", starting over.", self.url)
+        self.offset = 0
+        # Strong ETags and dates are the only validators If-Range accepts.
+        etag = headers.get("etag")
+        if etag and not etag.startswith("W/"):
+            self.response_validator = etag
+        else:
+            self.response_validator = headers.get("last-modified")
+        return False
+
+    def open(self, buffer_size=DEFAULT_BUFFER_SIZE):
+        # Opens the part file for writing at offset, for the response passed
+        # to accept_response(). Raises FileExistsException if another
+        # download of the same URL is writing to it.
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    raise FileExistsException(
+                        'URL \"%s\" is being downloaded.' % self.url)
+            if os.fstat(fd).st_size < self.offset:
+                self.offset = 0
+            os.ftruncate(fd, self.offset)
+            os.lseek(fd, self.offset, os.SEEK_SET)
+            self.filehandle = open(fd, "r+b", buffering=buffer_size)
+        except BaseException:
+            os.close(fd)
+            raise
+        self.validator = self.response_validator
+        meta = {"url": self.url, "validator": self.validator}
+        with open(self.meta_path, "w") as meta_file:
+            json.dump(meta, meta_file)
+        return self.filehandle
+
+    def hash_existing(self, file_hash):
+        # Adds the content that is already on disk to file_hash.
+        with open(self.path, "rb") as part_file:
+            remaining = self.offset
+            while remaining > 0:
+                data = part_file.read(min(remaining, DEFAULT_CHUNK_SIZE))
+                if not data:
+                    break
+                file_hash.update(data)
+                remaining -= len(data)
+
+    def can_resume(self):
+        return bool(self.validator) and os.path.exists(self.path)
+
+    def close(self):
+        # Unlocks the part file. Called after it has been saved or discarded.
+        if self.filehandle is not None:
+            self.filehandle.close()
+            self.filehandle = None
+
+    def keep(self):
+        # Keeps the data for the next attempt if it can be continued.
+        self.close()
+        if self.can_resume():
+            self.offset = os.path.getsize(self.path)
+        else:
+            self.discard()
+
+    def discard(self):
+        self.close()
+        discard_temp_file(self.path)
+        self.remove_meta()
+        self.offset = 0
+        self.validator = None
+        self.response_validator = None
+
+    def remove_meta(self):
+        discard_temp_file(self.meta_path)
+
+
+def discard_temp_file(temp_path):
+    try:
+        os.unlink(temp_path)
+    except FileNotFoundError:
+        pass
 
-    dest_path = os.path.join(destination, dest_file_name)
 
-    # wtf python, figure it out
-    filehandle = None
+def finish_temp_file(temp_path, dest_path):
     try:
-        filehandle = open(dest_path, 'wb')
-        filehandle.write(response.content)
+        os.chmod(temp_path, FILE_MODE)
+        os.replace(temp_path, dest_path)
     except OSError as error:
-        if error.errno == 36:
+        discard_temp_file(temp_path)
+        if error.errno == errno.ENAMETOOLONG:
             # dirty as fuck, i dont care anymore
-            pass
-            #dest_file_name = truncate_filename(dest_file_name,
-            #                                   20)
-            #dest_path = os.path.join(destination, dest_file_name)
-            #with open(dest_path, 'wb') as filehandle:
-            #    filehandle.write(response.content)
+            logger.verbose("Filename \"%s\" is too long, file is not "
+                           "saved.", dest_path)
+            return False
         else:
             raise
-    finally:
-        if filehandle:
-            filehandle.close()
+    return True
+
+
+def check_downloaded(url, identifier, download_index):
+    # Extension is not significant
+    if identifier in download_index or download_index.has_url(url):
+        raise FileExistsException('URL \"%s\" already downloaded.' % url)
+
+
+def link_known_url(url, destination, identifier, download_index,
+                   max_filename_len, name, content_store):
+    # If the content of url is already on disk, hardlinks it to the
+    # destination without downloading it again. Returns True on success.
+    existing = content_store.find_url(url)
+    if existing is None:
+        return False
+    (source, size) = existing
+    dest_path = os.path.join(destination, get_file_name(
+        identifier, os.path.splitext(source)[1], max_filename_len))
+    if not content_store.link(source, dest_path):
+        return False
+    content_store.linked_files += 1
+    content_store.linked_bytes += size
+    content_store.avoided_bytes += size
+    download_index.add_file(identifier, dest_path, size, name=name, url=url)
+    logger.verbose('URL \"%s\" is already known, linked \"%s\" to \"%s\".',
+                   url, dest_path, source)
+    return True
+
+
+def save_file(temp_path, dest_path, identifier, size, file_hash, url, name,
+              download_index, content_store):
+    # Moves a finished download into place and records it. If the content is
+    # already on disk, the file is replaced by a hardlink to the existing one.
+    # Returns False if the file could not be saved.
+    digest = None
+    if content_store is not None:
+        digest = file_hash.hexdigest()
+        existing = content_store.find_digest(digest)
+        if existing and content_store.link(existing[0], dest_path):
+            discard_temp_file(temp_path)
+            content_store.linked_files += 1
+            content_store.linked_bytes += size
+            content_store.add(digest, existing[0], size, url=url)
+            download_index.add_file(identifier, dest_path, size, name=name,
+                                    url=url)
+            logger.verbose('Content of \"%s\" is already on disk, linked '
+                           '\"%s\" to \"%s\".', url, dest_path, existing[0])
+            return True
+    if not finish_temp_file(temp_path, dest_path):
+        return False
+    if content_store is not None:
+        content_store.add(digest, dest_path, size, url=url)
+    download_index.add_file(identifier, dest_path, size, name=name, url=url)
+    return True
+
+
+def _transfer(url, part, destination, identifier, max_filename_len,
+              chunk_size, buffer_size, hashed):
+    # Downloads url into the part file, continuing it if possible. Returns
+    # (dest_path, size, file_hash, write_time), the part file is still open
+    # then. write_time is the time spent writing, it is recorded together
+    # with saving the file.
+    response = urlopen_timeout_wrapper(url, stream=True,
+                                       headers=part.get_request_headers())
+    with response:
+        if response.status_code == 416 and part.offset:
+            # The part file does not fit the file on the server anymore.
+            part.discard()
+            return _transfer(url, part, destination, identifier,
+                             max_filename_len, chunk_size, buffer_size,
+                             hashed)
+        part.accept_response(response.status_code, response.headers)
+        # Only the headers, and maybe the first chunk, have been received, a
+        # rejected response is closed without reading the rest.
+        chunks = response.iter_content(chunk_size=chunk_size)
+        head = None
+        if needs_sniffing(response.headers, part.offset):
+            head = read_head(chunks)
+        extension = check_response(url, response.headers, head)
+
+        dest_path = os.path.join(
+            destination, get_file_name(identifier, extension,
+                                       max_filename_len))
+
+        # Only chunk_size bytes of the body are held in memory at a time.
+        # The time spent writing is measured apart from the transfer.
+        start = time.monotonic()
+        filehandle = part.open(buffer_size)
+        file_hash = None
+        if hashed:
+            file_hash = dedup.new_hash()
+            part.hash_existing(file_hash)
+        write_time = time.monotonic() - start
+        size = part.offset
+        if head:
+            chunks = itertools.chain([head], chunks)
+        for chunk in chunks:
+            write_start = time.monotonic()
+            filehandle.write(chunk)
+            write_time += time.monotonic() - write_start
+            size += len(chunk)
+            budget.add_bytes(len(chunk))
+            metrics.add("bytes", len(chunk))
+            if file_hash:
+                file_hash.update(chunk)
+        write_start = time.monotonic()
+        filehandle.flush()
+        write_time += time.monotonic() - write_start
+        metrics.observe_phase("transfer",
+                              time.monotonic() - start - write_time)
+    return (dest_path, size, file_hash, write_time)
+
+
+def download_from_url(url, destination, identifier, download_index,
+                      max_filename_len, name=None,
+                      chunk_size=DEFAULT_CHUNK_SIZE,
+                      buffer_size=DEFAULT_BUFFER_SIZE, content_store=None,
+                      resume_retries=DEFAULT_RESUME_RETRIES):
+    # name: fullname of the reddit link, stored in the index
+    # content_store: dedup.ContentStore to deduplicate against, optional
+    # resume_retries: how often an interrupted transfer is continued before
+    #                 giving up. The part file is kept for the next run.
+    # Raises budget.BudgetExhaustedException if the run may not download any
+    # more files.
+    check_downloaded(url, identifier, download_index)
+    budget.reserve_file()
+    try:
+        if content_store is not None and link_known_url(
+                url, destination, identifier, download_index,
+                max_filename_len, name, content_store):
+            return
+
+        part = PartFile(destination, url)
+        attempt = 0
+        while True:
+            try:
+                (dest_path, size, file_hash, write_time) = _transfer(
+                    url, part, destination, identifier, max_filename_len,
+                    chunk_size, buffer_size, content_store is not None)
+                break
+            except TRANSFER_ERRORS:
+                part.keep()
+                if attempt >= resume_retries or not part.offset:
+                    raise
+                attempt += 1
+                logger.verbose("Transfer of \"%s\" interrupted after %d "
+                               "bytes, continuing.", url, part.offset)
+            except FileExistsException:
+                # The part file belongs to another download.
+                part.close()
+                raise
+            except BaseException:
+                part.discard()
+                raise
+        try:
+            # One observation per file, the writes of the transfer and
+            # moving the file into place.
+            start = time.monotonic()
+            saved = save_file(part.path, dest_path, identifier, size,
+                              file_hash, url, name, download_index,
+                              content_store)
+            metrics.observe_phase(
+                "write", write_time + time.monotonic() - start)
+        finally:
+            part.remove_meta()
+            part.close()
+        if not saved:
+            budget.release_file()
+            return
+    except BaseException:
+        budget.release_file()
+        raise
 
     logger.verbose('Downloaded URL \"%s\" to \"%s\".', url,
                    dest_path)
 
 
+def parse_imgur_album(text):
+    return imgur.get_image_urls(imgur.parse_album(text))
+
+
 def extract_imgur_album_urls(album_url):
-    try:
-        response = \
-            urlopen_timeout_wrapper(album_url, lock=request_imgur_album_lock)
-    except (requests.packages.urllib3.exceptions.TimeoutError,
-            requests.exceptions.Timeout, socket.timeout):
-        return []
-    hash_regex = re.compile(r'\"hash\":\"(.[^\"]*)\"')
-    items = []
-    with io.StringIO(response.text) as memfile:
-        for line in memfile.readlines():
-            results = re.findall(hash_regex, line)
-            if results:
-                items.extend(results)
+    album_id = imgur.get_album_id(album_url)
+    items = imgur.get_cached_items(album_id)
+    if items is None:
+        try:
+            logger.debug("Opening URL \"%s\"", album_url)
+            response = httpcache.get(album_url, timeout=TIMEOUT)
+        except (requests.packages.urllib3.exceptions.TimeoutError,
+                requests.exceptions.Timeout, socket.timeout):
+            return []
+        items = imgur.parse_album(response.text)
+        imgur.cache_items(album_id, items)
+    return imgur.get_image_urls(items)
 
-    urls = ['http://i.imgur.com/{0}.jpg'.format(imghash) for imghash in items]
-    return urls
 
+def is_imgur_url(url):
+    if 'imgur.com' in urllib.parse.urlparse(url).netloc:
+        return True
+    elif 'imgur.com' in url:
+        logger.warning("\"%s\" might be an imgur URL. Please investigate.",
+                       url)
+    return False
 
-def process_imgur_url(url):
+
+def is_imgur_album(url):
     if urllib.parse.urlparse(url).path.startswith("/a/"):
-        return extract_imgur_album_urls(url)
+        return True
     elif 'imgur.com/a/' in url:
         logger.warning("\"%s\" might be an imgur album. Please investigate.",
                        url)
+    return False
+
+
+def process_imgur_url(url):
+    if is_imgur_album(url):
+        return extract_imgur_album_urls(url)
     return [url]
 
 
 def extract_urls(url):
-    if 'imgur.com' in urllib.parse.urlparse(url).netloc:
+    if classify.classify(url) == classify.DIRECT:
+        return [url]
+    if is_imgur_url(url):
         return process_imgur_url(url)
-    elif 'imgur.com' in url:
-        logger.warning("\"%s\" might be an imgur URL. Please investigate.",
-                       url)
     return [url]
 
 
+def is_unsupported(link):
+    # Links that can never be downloaded are skipped before any request.
+    if classify.classify(link.url) != classify.UNSUPPORTED:
+        return False
+    logger.verbose("UNSUPPORTED: \"%s\" links to \"%s\", will be "
+                   "skipped.", link.title, link.url)
+    metrics.add("unsupported")
+    return True
+
+
 def truncate_filename(file_name, limit):
     ext = os.path.splitext(file_name)[1]
     file_name = file_name[:(limit - len(ext))]
@@ -182,22 +637,185 @@ def get_identifier(title):
     return title.replace('/', '-').lstrip(".")
 
 
-# returns a tuple: (processed, downoaded, errors, skipped)
+def get_link_filter(score, sfw, nsfw, regex, link_filter=None):
+    # The filter of download(), made from the basic filter options unless
+    # link_filter is given.
+    if link_filter is None:
+        link_filter = linkfilter.LinkFilter(score=score, sfw=sfw, nsfw=nsfw,
+                                            regex=regex)
+    return link_filter
+
+
+def add_filtered(subreddit, rejected):
+    # Logs and counts the links the filter rejected in the listing of
+    # subreddit, see linkfilter.Rejected. Returns their number.
+    if rejected is None:
+        return 0
+    counts = rejected.get(subreddit)
+    count = sum(counts.values())
+    if count:
+        linkfilter.log_rejected(subreddit, counts)
+        metrics.add("filtered", count)
+    return count
+
+
+def get_update_start(subreddit, last, update, download_index, sort=None):
+    # Returns (sort, stop_at) for reddit.get_links(). An update only fetches
+    # links newer than last or, if not given, the newest link seen by the
+    # previous update, so it has to use the "new" listing. Otherwise sort is
+    # returned as it is.
+    stop_at = last or None
+    if update and not stop_at:
+        stop_at = download_index.get_cursor(subreddit)
+    if stop_at:
+        logger.debug("Fetching links in /r/%s newer than %s.", subreddit,
+                     stop_at)
+    if update or stop_at:
+        return (reddit.SORT_NEW, stop_at)
+    return (sort, None)
+
+
+def get_combined_start(items, update, sort=None):
+    # Like get_update_start() for a combined listing of the subreddits of
+    # items, [(subreddit, destination), ...]. Returns (sort,
+    # {subreddit: stop_at}). Destinations that do not exist yet have no
+    # cursor.
+    stop_at = dict()
+    if not update:
+        return (sort, stop_at)
+    for (subreddit, destination) in items:
+        if not os.path.isdir(destination):
+            continue
+        with index.open_index(destination) as download_index:
+            (_, stop_at[subreddit]) = get_update_start(
+                subreddit, None, update, download_index)
+    return (reddit.SORT_NEW, stop_at)
+
+
+def get_combined_links(items, num, update, score=0, sort=None,
+                       time_filter=None, link_filter=None):
+    # Fetches the links of several subreddits with one listing and returns
+    # a reddit.LinkSplitter holding them. Every subreddit gets up to num
+    # links. The links of a subreddit are passed to download() as links,
+    # together with the links link_filter rejected as rejected. Without
+    # link_filter, only score is checked.
+    # items: [(subreddit, destination), ...], destination as in download()
+    (sort, stop_at) = get_combined_start(items, update, sort=sort)
+    link_filter = get_link_filter(score, False, False, None, link_filter)
+    subreddits = [subreddit for (subreddit, _) in items]
+    splitter = reddit.LinkSplitter(subreddits, limit=num, stop_at=stop_at)
+    for link in reddit.get_links(reddit.get_combined_name(subreddits),
+                                 sort=sort, time_filter=time_filter,
+                                 min_score=score,
+                                 link_filter=link_filter,
+                                 rejected=splitter.add_rejected,
+                                 stop=splitter.is_past_end):
+        if not splitter.add(link):
+            break
+    return splitter
+
+
+def save_update_cursor(subreddit, download_index, seen, failed):
+    # seen: fullnames of all processed links
+    # failed: fullnames of the links that were not downloaded completely
+    # The next update may stop at the newest link that is older than every
+    # failed link, so failed links are tried again.
+    if failed:
+        oldest_failed = min(reddit.get_id(name) for name in failed)
+        seen = [name for name in seen if reddit.get_id(name) < oldest_failed]
+    if not seen:
+        return
+    newest = max(seen, key=reddit.get_id)
+    cursor = download_index.get_cursor(subreddit)
+    if cursor is None or reddit.is_newer(newest, cursor):
+        logger.debug("Saving %s as newest link of /r/%s.", newest, subreddit)
+        download_index.set_cursor(subreddit, newest)
+
+
+_host_slots = {}
+_host_slots_lock = threading.Lock()
+
+
+def get_host_slots(url, concurrency=DEFAULT_ALBUM_CONCURRENCY):
+    # Returns the semaphore limiting the concurrent downloads from the host
+    # of url in this process.
+    host = urllib.parse.urlsplit(url).netloc.lower()
+    with _host_slots_lock:
+        slots = _host_slots.get(host)
+        if slots is None:
+            slots = _host_slots[host] = threading.BoundedSemaphore(concurrency)
+    return slots
+
+
+def fetch_items(executor, fetch, items, max_files=0):
+    # Calls fetch(url, identifier) for all (url, identifier) items in the
+    # executor and returns their ITEM_* results in order. With max_files,
+    # an item is only started while less than max_files items have been
+    # downloaded or are running, so the limit is never exceeded. Items left
+    # over once it is reached are ITEM_NOT_STARTED.
+    condition = threading.Condition()
+    state = {"running": 0, "downloaded": 0}
+
+    def run(url, identifier):
+        if max_files > 0:
+            with condition:
+                while (state["downloaded"] < max_files and
+                       state["running"] + state["downloaded"] >= max_files):
+                    condition.wait()
+                if state["downloaded"] >= max_files:
+                    return ITEM_NOT_STARTED
+                state["running"] += 1
+        result = ITEM_ERROR
+        try:
+            result = fetch(url, identifier)
+        finally:
+            if max_files > 0:
+                with condition:
+                    state["running"] -= 1
+                    if result == ITEM_DOWNLOADED:
+                        state["downloaded"] += 1
+                    condition.notify_all()
+        return result
+
+    if len(items) == 1:
+        return [run(*items[0])]
+    futures = [executor.submit(run, url, identifier)
+               for (url, identifier) in items]
+    return [future.result() for future in futures]
+
+
+# returns a tuple: (processed, downloaded, skipped, errors)
 def download(subreddit, destination, last, score, num, update, sfw, nsfw,
-             regex, verbose, quiet, timeout):
-
-    if update:
-        raise NotImplementedError(
-            "The update functionality is not implemented.")
-
-    files_in_dest = os.listdir(destination)
-    # Extensions are not significant
-    files_in_dest = [os.path.splitext(f)[0] for f in files_in_dest]
-    max_filename_len = os.statvfs(destination)[9]
-    processed = 0
-    downloaded = 0
-    errors = 0
-    skipped = 0
+             regex, verbose, quiet, timeout,
+             listing_queue_size=DEFAULT_LISTING_QUEUE_SIZE,
+             resolve_queue_size=DEFAULT_RESOLVE_QUEUE_SIZE,
+             chunk_size=DEFAULT_CHUNK_SIZE, buffer_size=DEFAULT_BUFFER_SIZE,
+             content_store=None,
+             album_concurrency=DEFAULT_ALBUM_CONCURRENCY, plan=None,
+             planned=None, sort=None, time_filter=None, links=None,
+             rejected=None, link_filter=None):
+    # last: fullname of a link, only links newer than this one are fetched
+    # timeout: unused, the listings of all processes are throttled by
+    #          reddit.set_rate()
+    # update: only fetch links newer than the ones seen by the last update
+    # sort, time_filter: listing to fetch, see reddit.get_links(). A top
+    #                    listing stops at the first link below score.
+    # content_store: dedup.ContentStore shared with other subreddits
+    # album_concurrency: files of an album downloaded at the same time from
+    #                    one host
+    # plan: if set, nothing is downloaded. Every link that would be is
+    #       passed to plan(subreddit, destination, link, urls) instead, see
+    #       manifest.Writer
+    # planned: manifest records to download instead of the listing of the
+    #          subreddit, see manifest.read(). Their filters have been
+    #          applied when they were planned.
+    # links: links of the subreddit from a combined listing, see
+    #        get_combined_links(). Used instead of its own listing.
+    # rejected: linkfilter.Rejected with the links of the combined listing
+    #           the filter rejected
+    # link_filter: linkfilter.LinkFilter applied to the listing, replaces
+    #              score, sfw, nsfw and regex. The rejected links are only
+    #              counted as processed and skipped.
 
     # Create the specified directory if it doesn't already exist.
     if not os.path.exists(destination):
@@ -205,121 +823,159 @@ def download(subreddit, destination, last, score, num, update, sfw, nsfw,
                      destination)
         os.mkdir(destination)
 
-    # If a regex has been specified, compile the rule (once)
-    regex_compiled = None
-    if regex:
-        regex_compiled = re.compile(regex)
+    max_filename_len = os.statvfs(destination)[9]
+    processed = 0
+    downloaded = 0
+    errors = 0
+    skipped = 0
+    planned_files = 0
 
-    links = reddit.get_links(subreddit, timeout=timeout, limit=num)
+    # fullname -> URLs of the planned links
+    planned_urls = None
+    if planned is not None:
+        planned_urls = dict((record["name"], record["urls"])
+                            for record in planned)
 
-    for link in links:
-        processed += 1
+    # Runs in the resolve stage of the pipeline. Returns a tuple
+    # (status, link, urls), status is one of RESOLVE_*.
+    def resolve(link):
         if not link:
-            continue
-        identifier = get_identifier(link.title)
-
-        if link.score < score:
-            logger.verbose("SCORE: \"%s\" has score of %s which is lower "
-                           "than the required score of %s, will be skipped.",
-                           link.title, link.score, score)
-            skipped += 1
-            continue
-        if sfw and link.nsfw:
-            logger.verbose('NSFW: \"%s\" is marked as NSFW, will be '
-                           "skipped", link.title)
-            skipped += 1
-            continue
-        if nsfw and not link.nsfw:
-            logger.verbose("NOT NSFW: \"%s\" is not marked as NSFW, will "
-                           "be skipped.", link.title)
-            skipped += 1
-            continue
-        if regex and not re.match(regex_compiled, link.title):
-            logger.verbose("REGEX: \"%s\" did not match regular expression "
-                           "%s, will be skipped.", link.title)
-            skipped += 1
-            continue
-
-        filecount = 0
-        urls = []
+            return (RESOLVE_EMPTY, link, None)
+        if planned_urls is None and is_unsupported(link):
+            return (RESOLVE_SKIPPED, link, None)
+        if download_index.has_link(link.name):
+            logger.verbose("\"%s\" has already been downloaded, will be "
+                           "skipped.", link.title)
+            return (RESOLVE_SKIPPED, link, None)
+        if planned_urls is not None:
+            return (RESOLVE_OK, link, planned_urls[link.name])
         try:
-            urls = extract_urls(link.url)
-
-        except (urllib.error.HTTPError,
-                urllib.error.URLError,
-                http.client.HTTPException,
-                TimeoutError,
-                UnicodeEncodeError,
-                ConnectionError,
-                requests.exceptions.RequestException,
-                requests.exceptions.ConnectionError,
-                requests.exceptions.HTTPError,
-                requests.packages.urllib3.exceptions.DecodeError,
-                requests.packages.urllib3.exceptions.LocationParseError,
-                ValueError) as error:
-            if urls:
-                if len(urls) == 1:
-                    urls = urls[0]
-                logger.verbose("Error %s for %s", repr(error), urls)
-            errors += 1
-            continue
+            with metrics.timed("resolve"):
+                urls = extract_urls(link.url)
+            return (RESOLVE_OK, link, urls)
+        except DOWNLOAD_ERRORS as error:
+            logger.verbose("Error %s for %s", repr(error), link.url)
+            return (RESOLVE_ERROR, link, None)
+
+    # Listing pages are fetched in their own thread, so the next page is
+    # requested while the images of the current one are downloaded. URL
+    # resolution (e.g. imgur albums) runs in a third thread.
+    download_index = index.open_index(destination)
+    if planned is not None:
+        links = [manifest.get_link(record) for record in planned]
+    elif links is None:
+        (sort, stop_at) = get_update_start(subreddit, last, update,
+                                           download_index, sort=sort)
+        rejected = linkfilter.Rejected()
+        links = reddit.get_links(
+            subreddit, limit=num, sort=sort,
+            stop_at=stop_at, time_filter=time_filter, min_score=score,
+            link_filter=get_link_filter(score, sfw, nsfw, regex, link_filter),
+            rejected=rejected.add)
+    link_pipeline = pipeline.Pipeline(
+        links, [("listing", None), ("resolve", resolve)],
+        [listing_queue_size, resolve_queue_size], name="/r/%s" % subreddit)
+
+    def fetch_item(url, identifier, name=None):
+        # Runs in the threads of the executor, returns one of ITEM_*.
+        try:
+            with get_host_slots(url, album_concurrency):
+                download_from_url(url, destination, identifier,
+                                  download_index, max_filename_len,
+                                  name=name, chunk_size=chunk_size,
+                                  buffer_size=buffer_size,
+                                  content_store=content_store)
+            return ITEM_DOWNLOADED
+        except budget.BudgetExhaustedException:
+            return ITEM_BUDGET
+        except WrongFileTypeException as error:
+            if not quiet:
+                logger.verbose('%s', error)
+            return ITEM_SKIPPED
+        except (requests.packages.urllib3.exceptions.TimeoutError,
+                requests.exceptions.Timeout, socket.timeout):
+            logger.verbose("Connection to \"%s\" timed out.", url)
+            return ITEM_ERROR
+        except FileExistsException as error:
+            if not quiet:
+                logger.verbose('%s', error)
+            return ITEM_SKIPPED
+        except DOWNLOAD_ERRORS as error:
+            logger.verbose("Error %s for %s", repr(error), url)
+            return ITEM_ERROR
+
+    executor = concurrent.futures.ThreadPoolExecutor(album_concurrency)
+    seen = list()
+    failed = list()
+    with download_index, link_pipeline, executor:
+        for (status, link, urls) in link_pipeline:
+            processed += 1
+            if link:
+                seen.append(link.name)
+            if status == RESOLVE_SKIPPED:
+                skipped += 1
+                continue
+            if status == RESOLVE_ERROR:
+                errors += 1
+                failed.append(link.name)
+                continue
+            if not urls:
+                continue
 
-        if not urls:
-            continue
+            if plan:
+                plan(subreddit, destination, link, urls)
+                planned_files += len(urls)
+                if num > 0 and planned_files >= num:
+                    break
+                continue
 
-        for url in urls:
-            try:
+            identifier = get_identifier(link.title)
+            items = list()
+            for (filecount, url) in enumerate(urls):
                 # Only append numbers if more than one file.
                 mutated_identifier = identifier
                 if len(urls) > 1:
                     mutated_identifier += "_%s" % filecount
-
-                # has to be updated BEFORE calling download_from_url(), as it
-                # might raise a FileExistsException, continue, the next
-                # mutated_identifier would be the same as before,
-                # download_from_url() would raise the same exception, and so
-                # on, so all leftover items of an imgur album would be skipped.
-                filecount += 1
-
-                download_from_url(url, destination, mutated_identifier,
-                                  files_in_dest, max_filename_len)
-                downloaded += 1
-
-                if num > 0 and downloaded >= num:
-                    break
-            except WrongFileTypeException as error:
-                if not quiet:
-                    logger.verbose('%s', error)
-                skipped += 1
-            except (requests.packages.urllib3.exceptions.TimeoutError,
-                    requests.exceptions.Timeout, socket.timeout) as error:
-                logger.verbose("Connection to \"%s\" timed out.", url)
-                errors += 1
-                continue
-            except FileExistsException as error:
-                if not quiet:
-                    logger.verbose('%s', error)
-                skipped += 1
-            except (urllib.error.HTTPError,
-                    urllib.error.URLError,
-                    http.client.HTTPException,
-                    TimeoutError,
-                    UnicodeEncodeError,
-                    ConnectionError,
-                    requests.exceptions.RequestException,
-                    requests.exceptions.ConnectionError,
-                    requests.exceptions.HTTPError,
-                    requests.packages.urllib3.exceptions.DecodeError,
-                    requests.packages.urllib3.exceptions.LocationParseError,
-                    ValueError) as error:
-                if urls:
-                    if len(urls) == 1:
-                        urls = urls[0]
-                    logger.verbose("Error %s for %s", repr(error), urls)
-                errors += 1
-                continue
-
-    return (processed, downloaded, skipped, errors)
+                items.append((url, mutated_identifier))
+
+            # The files of an album are downloaded concurrently.
+            results = fetch_items(
+                executor, functools.partial(fetch_item, name=link.name),
+                items, max_files=num - downloaded if num > 0 else 0)
+
+            # A link is recorded in the index once all of its files are there.
+            complete = True
+            for result in results:
+                if result == ITEM_DOWNLOADED:
+                    downloaded += 1
+                elif result == ITEM_SKIPPED:
+                    skipped += 1
+                else:
+                    if result == ITEM_ERROR:
+                        errors += 1
+                    complete = False
+
+            if complete:
+                download_index.add_link(link.name, link.url)
+            else:
+                failed.append(link.name)
+            if num > 0 and downloaded >= num:
+                break
+            if budget.exhausted():
+                logger.info("Download budget used up, stopping /r/%s.",
+                            subreddit)
+                break
+
+        # A plan has not downloaded anything yet, the run that executes it
+        # saves the cursor.
+        if update and not plan:
+            if rejected is not None:
+                seen.extend(rejected.get_names(subreddit))
+            save_update_cursor(subreddit, download_index, seen, failed)
+
+    link_pipeline.log_stats()
+    filtered = add_filtered(subreddit, rejected)
+    return (processed + filtered, downloaded, skipped + filtered, errors)
 
 ### Only needed when called directly.
 if __name__ == "__main__":
@@ -0,0 +1,168 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Adaptive polling of subreddits for the watch mode.
+#
+# Every subreddit is polled about when target_links new links are expected,
+# so busy subreddits are polled more often than quiet ones. The post rate of
+# a subreddit is an exponentially weighted average of the new links per
+# second found by its polls. The intervals are kept between min_interval and
+# max_interval. If all polls together would need more listing requests than
+# the reddit API allows (request_rate, one request per poll), all intervals
+# are stretched by the same factor, even beyond max_interval.
+
+import logging
+
+DEFAULT_MIN_INTERVAL = 60.0
+DEFAULT_MAX_INTERVAL = 3600.0
+# The default page size of reddit, so a poll usually takes one request.
+DEFAULT_TARGET_LINKS = 25
+# Weight of the newest observation in the average post rate.
+DEFAULT_SMOOTHING = 0.3
+
+logger = logging.getLogger()
+
+
+class SubredditState(object):
+    def __init__(self, key, now):
+        self.key = key
+        # new links per second, None until two polls have been made
+        self.rate = None
+        # start of the last poll, the first one is due right away
+        self.last_poll = None
+        self.added = now
+        # start of the running poll
+        self.started = None
+        self.polling = False
+        self.removed = False
+
+
+# Keys are (subreddit, destination) tuples.
+class Scheduler(object):
+    def __init__(self, request_rate, min_interval=DEFAULT_MIN_INTERVAL,
+                 max_interval=DEFAULT_MAX_INTERVAL,
+                 target_links=DEFAULT_TARGET_LINKS,
+                 smoothing=DEFAULT_SMOOTHING):
+        # request_rate: listing requests per second all polls may use
+        self.request_rate = request_rate
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_links = target_links
+        self.smoothing = smoothing
+        # key -> SubredditState, in the order the keys were added
+        self.states = dict()
+        # factor all intervals are stretched by to stay within request_rate
+        self.stretch = 1.0
+
+    def update(self, keys, now):
+        # Sets the subreddits to poll. New keys are due right away, the state
+        # of known ones is kept.
+        keys = list(keys)
+        wanted = set(keys)
+        for key in keys:
+            state = self.states.get(key)
+            if state is None:
+                self.states[key] = SubredditState(key, now)
+            else:
+                state.removed = False
+        for (key, state) in list(self.states.items()):
+            if key not in wanted:
+                if state.polling:
+                    state.removed = True
+                else:
+                    del self.states[key]
+        self._update_stretch()
+
+    def get_interval(self, state):
+        # Seconds between two polls of the subreddit of state.
+        if state.rate is None:
+            # Measure the rate soon.
+            interval = self.min_interval
+        elif state.rate <= 0:
+            interval = self.max_interval
+        else:
+            interval = min(self.max_interval,
+                           max(self.min_interval,
+                               self.target_links / state.rate))
+        return interval * self.stretch
+
+    def get_next_poll(self, state):
+        if state.last_poll is None:
+            return state.added
+        return state.last_poll + self.get_interval(state)
+
+    def _update_stretch(self):
+        old_stretch = self.stretch
+        self.stretch = 1.0
+        polls = sum(1.0 / self.get_interval(state)
+                    for state in self.states.values() if not state.removed)
+        if self.request_rate > 0 and polls > self.request_rate:
+            self.stretch = polls / self.request_rate
+        if abs(self.stretch - old_stretch) > 0.01 * old_stretch:
+            logger.debug("Polling %d subreddits takes %.3f requests per "
+                         "second, stretching the intervals by %.2f.",
+                         len(self.states), polls, self.stretch)
+
+    def get_due(self, now, limit=None):
+        # Returns the keys that are due, the longest overdue first.
+        due = [state for state in self.states.values()
+               if not state.polling and not state.removed and
+               self.get_next_poll(state) <= now]
+        due.sort(key=self.get_next_poll)
+        return [state.key for state in due[:limit]]
+
+    def get_delay(self, now):
+        # Seconds until the next poll is due, None if nothing is waiting.
+        waiting = [self.get_next_poll(state)
+                   for state in self.states.values()
+                   if not state.polling and not state.removed]
+        if not waiting:
+            return None
+        return max(0.0, min(waiting) - now)
+
+    def start(self, key, now):
+        state = self.states[key]
+        state.polling = True
+        state.started = now
+
+    def finish(self, key, links, now):
+        # links: number of new links the poll found
+        state = self.states.get(key)
+        if state is None:
+            return
+        state.polling = False
+        if state.removed:
+            del self.states[key]
+            self._update_stretch()
+            return
+        if state.last_poll is not None:
+            # The first poll sees the whole listing, not the new links.
+            elapsed = max(state.started - state.last_poll, 1.0)
+            rate = links / elapsed
+            if state.rate is None:
+                state.rate = rate
+            else:
+                state.rate = (self.smoothing * rate +
+                              (1 - self.smoothing) * state.rate)
+        state.last_poll = state.started
+        self._update_stretch()
+        logger.debug("/r/%s: %d new links, %s links per hour, next poll in "
+                     "%d seconds.", key[0], links,
+                     "unknown" if state.rate is None else
+                     "%.1f" % (state.rate * 3600),
+                     max(0, self.get_next_poll(state) - now))
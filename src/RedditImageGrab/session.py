@@ -0,0 +1,160 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Keep-alive HTTP sessions shared by the listing and the download code.
+#
+# Every process gets its own requests.Session (sockets must never be shared
+# across a fork), which keeps one connection pool per host. Connections to
+# www.reddit.com and i.imgur.com are therefore only set up once per worker
+# instead of once per request.
+
+import logging
+import os
+import threading
+import time
+import urllib.parse
+import weakref
+
+import requests
+import requests.adapters
+
+from . import metrics
+
+USER_AGENT = ("reddit-download script. "
+              "http://github.com/whatevsz/reddit-download")
+
+# Number of hosts to keep a connection pool for.
+DEFAULT_POOL_CONNECTIONS = 10
+# Number of connections kept alive per host.
+DEFAULT_POOL_MAXSIZE = 10
+
+logger = logging.getLogger()
+
+pool_connections = DEFAULT_POOL_CONNECTIONS
+pool_maxsize = DEFAULT_POOL_MAXSIZE
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class CountingHTTPAdapter(requests.adapters.HTTPAdapter):
+    """HTTPAdapter that counts requests and new connections per host"""
+
+    def __init__(self, *args, **kwargs):
+        self.stats = {}
+        self._stats_lock = threading.Lock()
+        # urllib3 keeps running totals on every pool, remember what we have
+        # already accounted for so evicted and recreated pools do not break
+        # the numbers.
+        self._seen = weakref.WeakKeyDictionary()
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, stream=False, timeout=None, verify=True,
+             cert=None, proxies=None):
+        start = time.monotonic()
+        try:
+            return super().send(request, stream=stream, timeout=timeout,
+                                verify=verify, cert=cert, proxies=proxies)
+        finally:
+            metrics.observe_latency(
+                urllib.parse.urlparse(request.url).netloc.lower(),
+                time.monotonic() - start)
+            self._count(request, verify, cert, proxies)
+
+    def _count(self, request, verify, cert, proxies):
+        try:
+            if hasattr(self, "get_connection_with_tls_context"):
+                pool = self.get_connection_with_tls_context(
+                    request, verify, proxies=proxies, cert=cert)
+            else:
+                pool = self.get_connection(request.url, proxies)
+        except Exception:
+            return
+        host = urllib.parse.urlparse(request.url).netloc
+        with self._stats_lock:
+            (seen_requests, seen_connections) = self._seen.get(pool, (0, 0))
+            self._seen[pool] = (pool.num_requests, pool.num_connections)
+            host_stats = self.stats.setdefault(
+                host, {"requests": 0, "connections": 0})
+            host_stats["requests"] += pool.num_requests - seen_requests
+            host_stats["connections"] += \
+                pool.num_connections - seen_connections
+
+
+def configure(connections=None, maxsize=None):
+    # Has to be called before the first session is created, i.e. before the
+    # worker processes are started.
+    global pool_connections, pool_maxsize
+    if connections:
+        pool_connections = connections
+    if maxsize:
+        pool_maxsize = maxsize
+
+
+def _create_session():
+    session = requests.Session()
+    session.headers["User-Agent"] = USER_AGENT
+    adapter = CountingHTTPAdapter(pool_connections=pool_connections,
+                                  pool_maxsize=pool_maxsize)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session():
+    pid = os.getpid()
+    with _sessions_lock:
+        session = _sessions.get(pid)
+        if session is None:
+            # Sessions inherited from the parent process are useless after a
+            # fork, throw them away.
+            _sessions.clear()
+            session = _create_session()
+            _sessions[pid] = session
+    return session
+
+
+def get(url, **kwargs):
+    return get_session().get(url, **kwargs)
+
+
+def get_connection_stats():
+    # Returns {host: {"requests": n, "connections": n}} for this process.
+    # Every request that did not need a new connection reused one.
+    session = get_session()
+    stats = {}
+    for adapter in set(session.adapters.values()):
+        if not isinstance(adapter, CountingHTTPAdapter):
+            continue
+        with adapter._stats_lock:
+            for (host, host_stats) in adapter.stats.items():
+                merged = stats.setdefault(
+                    host, {"requests": 0, "connections": 0})
+                merged["requests"] += host_stats["requests"]
+                merged["connections"] += host_stats["connections"]
+    for host_stats in stats.values():
+        host_stats["reused"] = max(
+            0, host_stats["requests"] - host_stats["connections"])
+    return stats
+
+
+def log_connection_stats(level=logging.DEBUG):
+    for (host, host_stats) in sorted(get_connection_stats().items()):
+        logger.log(level, "Host %s: %d requests over %d connections, %d "
+                   "reused.", host, host_stats["requests"],
+                   host_stats["connections"], host_stats["reused"])
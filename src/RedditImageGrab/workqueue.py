@@ -0,0 +1,301 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A durable work queue shared by several download hosts.
+#
+# The queue is a SQLite database, usually on storage all hosts can reach. A
+# coordinator adds the work items, every node leases one item per consumer.
+# A lease ends after lease seconds unless it is renewed; a thread in every
+# process renews the leases the process holds. Items of a node that went
+# away without returning them are leased again once their lease has
+# expired, up to max_attempts times, so no item is lost. A node that stops
+# cleanly returns its items at once.
+#
+# Only the holder of a lease can complete an item. While a node is alive
+# nobody else gets its items; if it was too slow to renew a lease and the
+# item was taken over, the links both nodes downloaded are skipped by the
+# download index of whoever comes second.
+#
+# The default rollback journal is used instead of WAL, which does not work
+# on network file systems.
+
+import contextlib
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+STATES = (PENDING, LEASED, DONE, FAILED)
+
+DEFAULT_LEASE = 300.0
+DEFAULT_POLL_INTERVAL = 5.0
+DEFAULT_MAX_ATTEMPTS = 3
+# Seconds to wait for a lock held by another process.
+LOCK_TIMEOUT = 60.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    item TEXT NOT NULL,
+    state TEXT NOT NULL,
+    owner TEXT,
+    expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS items_state ON items (state, id);
+"""
+
+logger = logging.getLogger()
+
+
+class WorkQueue(object):
+    def __init__(self, path, lease=DEFAULT_LEASE,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.path = path
+        self.lease_time = lease
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        # Transactions are started explicitly, see _transaction().
+        self.connection = sqlite3.connect(path, timeout=LOCK_TIMEOUT,
+                                          check_same_thread=False,
+                                          isolation_level=None)
+        with self._transaction():
+            for statement in SCHEMA.split(";"):
+                if statement.strip():
+                    self.connection.execute(statement)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # Takes the write lock of the database right away, so two nodes never
+        # lease the same item.
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def put(self, items):
+        # items: JSON serializable objects. Returns their number.
+        now = time.time()
+        rows = [(json.dumps(item, sort_keys=True), PENDING, now)
+                for item in items]
+        with self._transaction():
+            self.connection.executemany(
+                "INSERT INTO items (item, state, updated) VALUES (?, ?, ?)",
+                rows)
+        return len(rows)
+
+    def lease(self, owner):
+        # Returns (id, item) of the oldest item nobody holds a lease on, or
+        # None if there is none right now.
+        with self._transaction():
+            while True:
+                now = time.time()
+                row = self.connection.execute(
+                    "SELECT id, item, state, owner, attempts FROM items "
+                    "WHERE state = ? OR (state = ? AND expires < ?) "
+                    "ORDER BY id LIMIT 1", (PENDING, LEASED, now)).fetchone()
+                if row is None:
+                    return None
+                (item_id, item, state, old_owner, attempts) = row
+                if state == LEASED:
+                    logger.warning("The lease of %s on item %d has expired.",
+                                   old_owner, item_id)
+                if attempts >= self.max_attempts:
+                    logger.error("Item %d has been leased %d times without "
+                                 "being completed, giving up: %s", item_id,
+                                 attempts, item)
+                    self.connection.execute(
+                        "UPDATE items SET state = ?, owner = NULL, "
+                        "expires = NULL, updated = ? WHERE id = ?",
+                        (FAILED, now, item_id))
+                    continue
+                self.connection.execute(
+                    "UPDATE items SET state = ?, owner = ?, expires = ?, "
+                    "attempts = attempts + 1, updated = ? WHERE id = ?",
+                    (LEASED, owner, now + self.lease_time, now, item_id))
+                return (item_id, json.loads(item))
+
+    def _update_lease(self, item_id, owner, assignments, values):
+        # Returns whether owner still held the lease.
+        with self._transaction():
+            cursor = self.connection.execute(
+                "UPDATE items SET " + assignments + ", updated = ? "
+                "WHERE id = ? AND owner = ? AND state = ?",
+                values + (time.time(), item_id, owner, LEASED))
+            return cursor.rowcount == 1
+
+    def renew(self, item_id, owner):
+        return self._update_lease(item_id, owner, "expires = ?",
+                                  (time.time() + self.lease_time,))
+
+    def complete(self, item_id, owner):
+        return self._update_lease(item_id, owner,
+                                  "state = ?, owner = NULL, expires = NULL",
+                                  (DONE,))
+
+    def release(self, item_id, owner):
+        # Returns the item to the queue. This does not count as an attempt.
+        return self._update_lease(
+            item_id, owner, "state = ?, owner = NULL, expires = NULL, "
+            "attempts = attempts - 1", (PENDING,))
+
+    def get_counts(self):
+        # Returns {state: number of items}.
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT state, COUNT(*) FROM items GROUP BY state").fetchall()
+        counts = dict((state, 0) for state in STATES)
+        counts.update(rows)
+        return counts
+
+    def is_finished(self):
+        # Items with an expired lease still count as unfinished, they will
+        # be leased again.
+        counts = self.get_counts()
+        return counts[PENDING] == 0 and counts[LEASED] == 0
+
+
+class Node(object):
+    # The side of one process of a node. Holds the leases of the process and
+    # renews them from a thread.
+    def __init__(self, path, lease=DEFAULT_LEASE,
+                 poll_interval=DEFAULT_POLL_INTERVAL):
+        self.queue = WorkQueue(path, lease)
+        self.owner = get_owner()
+        self.poll_interval = poll_interval
+        self.held = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.heartbeat = threading.Thread(target=self._renew,
+                                          args=(lease / 3,),
+                                          name="heartbeat", daemon=True)
+        self.heartbeat.start()
+
+    def _renew(self, interval):
+        while not self.stopped.wait(interval):
+            with self.lock:
+                held = list(self.held)
+            for item_id in held:
+                try:
+                    renewed = self.queue.renew(item_id, self.owner)
+                except sqlite3.Error as error:
+                    logger.warning("Cannot renew the lease on item %d: %s",
+                                   item_id, error)
+                    continue
+                if not renewed:
+                    logger.warning("Lost the lease on item %d.", item_id)
+                    with self.lock:
+                        self.held.discard(item_id)
+
+    def get(self):
+        # Returns (id, item) of the next item or None once every item of the
+        # queue is done. Waits while all remaining items are leased by
+        # others, their leases might still expire.
+        while True:
+            job = self.queue.lease(self.owner)
+            if job is not None:
+                with self.lock:
+                    self.held.add(job[0])
+                return job
+            if self.queue.is_finished():
+                return None
+            time.sleep(self.poll_interval)
+
+    def _end_lease(self, item_id, end):
+        with self.lock:
+            self.held.discard(item_id)
+        if not end(item_id, self.owner):
+            logger.warning("Item %d has been taken over by another node.",
+                           item_id)
+
+    def complete(self, item_id):
+        self._end_lease(item_id, self.queue.complete)
+
+    def release(self, item_id):
+        self._end_lease(item_id, self.queue.release)
+
+    def close(self):
+        # Returns the items that are still held.
+        self.stopped.set()
+        self.heartbeat.join()
+        with self.lock:
+            held = list(self.held)
+        for item_id in held:
+            self.release(item_id)
+        self.queue.close()
+
+
+def get_owner():
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+
+queue_path = None
+lease_time = DEFAULT_LEASE
+poll_interval = DEFAULT_POLL_INTERVAL
+_nodes = {}
+_nodes_lock = threading.Lock()
+
+
+def configure(path, lease=DEFAULT_LEASE,
+              poll=DEFAULT_POLL_INTERVAL):
+    # Makes the workers take their items from the queue at path. Every
+    # process opens its own connection.
+    global queue_path, lease_time, poll_interval
+    queue_path = path
+    lease_time = lease
+    poll_interval = poll
+
+
+def is_configured():
+    return queue_path is not None
+
+
+def get_node():
+    # Returns the Node of this process.
+    pid = os.getpid()
+    with _nodes_lock:
+        node = _nodes.get(pid)
+        if node is None:
+            # Connections and threads of the parent must not be used.
+            _nodes.clear()
+            node = _nodes[pid] = Node(queue_path, lease_time, poll_interval)
+    return node
+
+
+def close_node():
+    pid = os.getpid()
+    with _nodes_lock:
+        node = _nodes.pop(pid, None)
+    if node is not None:
+        node.close()
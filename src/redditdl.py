@@ -16,7 +16,11 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import ctypes
+import asyncio
+import atexit
+import concurrent.futures
+import itertools
+import json
 import logging
 import logging.handlers
 import multiprocessing
@@ -24,11 +28,30 @@ import optparse
 import os
 import queue
 import random
+import re
+import signal
+import sqlite3
 import sys
 import time
 import traceback
 
+import RedditImageGrab.asyncdownload
+import RedditImageGrab.budget
+import RedditImageGrab.classify
+import RedditImageGrab.dedup
+import RedditImageGrab.httpcache
+import RedditImageGrab.imgur
+import RedditImageGrab.index
+import RedditImageGrab.linkfilter
+import RedditImageGrab.manifest
+import RedditImageGrab.metrics
+import RedditImageGrab.profiling
+import RedditImageGrab.ratelimit
+import RedditImageGrab.reddit
 import RedditImageGrab.redditdownload
+import RedditImageGrab.scheduler
+import RedditImageGrab.session
+import RedditImageGrab.workqueue
 
 NAME = "reddit-download"
 VERSION = "0.1"
@@ -68,18 +91,56 @@ DEFAULT_LIST_EXTENSION = ".list"
 # we should see no more than one request every two seconds from you."
 DEFAULT_FLOOD_TIMEOUT = 2000
 DEFAULT_MAX_PROCESSES = 10
+DEFAULT_POOL_CONNECTIONS = \
+    RedditImageGrab.session.DEFAULT_POOL_CONNECTIONS
+DEFAULT_POOL_SIZE = RedditImageGrab.session.DEFAULT_POOL_MAXSIZE
+ENGINE_PROCESSES = "processes"
+ENGINE_ASYNCIO = "asyncio"
+DEFAULT_ENGINE = ENGINE_PROCESSES
+DEFAULT_LOOPS = 1
+ORDER_LIST = "list"
+ORDER_SHUFFLE = "shuffle"
+ORDER_ROUND_ROBIN = "round-robin"
+DEFAULT_ORDER = ORDER_LIST
+DEFAULT_CONCURRENCY = RedditImageGrab.asyncdownload.DEFAULT_CONCURRENCY
+DEFAULT_CHUNK_SIZE = RedditImageGrab.redditdownload.DEFAULT_CHUNK_SIZE
+DEFAULT_BUFFER_SIZE = RedditImageGrab.redditdownload.DEFAULT_BUFFER_SIZE
+DEFAULT_LISTING_QUEUE_SIZE = \
+    RedditImageGrab.redditdownload.DEFAULT_LISTING_QUEUE_SIZE
+DEFAULT_RESOLVE_QUEUE_SIZE = \
+    RedditImageGrab.redditdownload.DEFAULT_RESOLVE_QUEUE_SIZE
 DEFAULT_CREATE_DESTINATION = False
 DEFAULT_RECURSIVE = False
 DEFAULT_DESTINATION = os.getcwd()
 DEFAULT_NO_SFW = False
 DEFAULT_NO_NSFW = False
+DEFAULT_UPDATE = False
+DEFAULT_DEDUP = False
+DEFAULT_CACHE = False
+DEFAULT_CACHE_TTL = RedditImageGrab.httpcache.DEFAULT_TTL
+DEFAULT_CACHE_SIZE = \
+    RedditImageGrab.httpcache.DEFAULT_MAX_SIZE // (1024 * 1024)
+DEFAULT_ALBUM_CACHE_TTL = RedditImageGrab.imgur.DEFAULT_ALBUM_TTL
+DEFAULT_ALBUM_CONCURRENCY = \
+    RedditImageGrab.redditdownload.DEFAULT_ALBUM_CONCURRENCY
 DEFAULT_SCORE = 0
+DEFAULT_SORT = RedditImageGrab.reddit.SORT_HOT
+DEFAULT_BATCH = 1
 DEFAULT_REGEX = None
 DEFAULT_SHUFFLE = None
 DEFAULT_SHUFFLE_LISTS = False
 DEFAULT_SHUFFLE_LIST_SUBREDDITS = False
 DEFAULT_SHUFFLE_ALL_SUBREDDITS = False
 DEFAULT_LOGGING_ENABLED = True
+LOG_FORMAT_TEXT = "text"
+LOG_FORMAT_JSON = "json"
+DEFAULT_LOG_FORMAT = LOG_FORMAT_TEXT
+DEFAULT_METRICS_INTERVAL = RedditImageGrab.metrics.DEFAULT_REPORT_INTERVAL
+DEFAULT_LEASE = RedditImageGrab.workqueue.DEFAULT_LEASE
+DEFAULT_MIN_INTERVAL = RedditImageGrab.scheduler.DEFAULT_MIN_INTERVAL
+DEFAULT_MAX_INTERVAL = RedditImageGrab.scheduler.DEFAULT_MAX_INTERVAL
+# Seconds between two checks of the lists for changes in --watch mode.
+DEFAULT_LIST_CHECK_INTERVAL = 30.0
 
 ERROR_INVALID_DESTINATION = 1
 ERROR_INVALID_COMMAND_LINE = 2  # same in optparse
@@ -114,6 +175,108 @@ class LevelFilter(object):
         self.__maxlvl = maxlvl
 
 
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line. The message already contains the traceback
+    # of exceptions logged in the workers, see logging.handlers.QueueHandler.
+    def format(self, record):
+        entry = {"time": time.strftime("%Y-%m-%dT%H:%M:%S",
+                                       time.localtime(record.created)) +
+                 ".%03d" % record.msecs,
+                 "level": record.levelname,
+                 "process": record.processName,
+                 "pid": record.process,
+                 "message": record.getMessage()}
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry)
+
+
+class ListWatcher(object):
+    # Reads the lists of a --watch run again when they change.
+    def __init__(self, args, recursive, list_extension, destination):
+        self.args = args
+        self.recursive = recursive
+        self.list_extension = list_extension
+        self.destination = destination
+        # path -> modification time at the last check, None before the
+        # first one
+        self.mtimes = None
+        # path -> [subreddit, ...]
+        self.subreddits = dict()
+
+    def check(self):
+        # Returns the lists as [(list destination, [subreddit, ...]), ...]
+        # if one of them has been added, changed or removed since the last
+        # call, None otherwise. Only changed lists are read again.
+        paths = find_lists(self.args, self.recursive, self.list_extension,
+                           report=self.mtimes is None)
+        mtimes = dict()
+        for path in paths:
+            try:
+                mtimes[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+        if mtimes == self.mtimes:
+            return None
+        for (path, mtime) in mtimes.items():
+            if self.mtimes is not None and self.mtimes.get(path) == mtime:
+                continue
+            try:
+                self.subreddits[path] = parse_file(path)
+            except OSError as error:
+                logger.error("Cannot read list \"%s\": %s", path, error)
+                self.subreddits[path] = list()
+                continue
+            if self.mtimes is not None:
+                logger.info("List \"%s\" has been %s, it has %d "
+                            "subreddits.", path,
+                            "changed" if path in self.mtimes else "added",
+                            len(self.subreddits[path]))
+        for path in list(self.subreddits):
+            if path not in mtimes:
+                logger.info("List \"%s\" has been removed.", path)
+                del self.subreddits[path]
+        self.mtimes = mtimes
+        lists = list()
+        for path in paths:
+            if path not in mtimes:
+                continue
+            list_destination = get_list_destination(
+                path, self.destination, self.list_extension)
+            if list_destination:
+                lists.append((list_destination, self.subreddits[path]))
+        return lists
+
+
+# Thread in the main process that owns the log handlers, see
+# setup_logging(). It is started by start_logging().
+log_listener = None
+log_listener_started = False
+
+
+def start_logging():
+    # Starts writing the queued records. Not before the workers have been
+    # forked, the thread holds the locks of the queue and the handlers.
+    global log_listener_started
+    if log_listener is not None and not log_listener_started:
+        log_listener.start()
+        log_listener_started = True
+
+
+def shutdown_logging():
+    # Writes the records that are still queued and closes the handlers.
+    global log_listener
+    if log_listener is not None:
+        # Records of a run that ended before the workers were started are
+        # still waiting.
+        start_logging()
+        log_listener.stop()
+        log_listener = None
+    logging.shutdown()
+
+
 def check_file(file_path, ext):
     return (file_path.endswith(list_extension)
             and os.path.basename(file_path) != list_extension)
@@ -133,6 +296,50 @@ def get_lists(directory, recursive, list_extension):
                 if check_file(path, list_extension)]
 
 
+def find_lists(args, recursive, list_extension, report=True):
+    # Returns the paths of the list files given as args, which can be files
+    # and directories, in order and without duplicates.
+    # report: log duplicates and paths that do not exist
+    paths = list()
+    for path in args:
+        if os.path.isdir(path):
+            candidates = get_lists(path, recursive=recursive,
+                                   list_extension=list_extension)
+        elif os.path.isfile(path):
+            candidates = [path] if check_file(path, list_extension) else []
+        else:
+            if report:
+                logger.error("Invalid path: %s not found.", path)
+            continue
+        for list_path in candidates:
+            if list_path in paths:
+                if report:
+                    logger.info("%s already encountered, ignored.",
+                                list_path)
+            else:
+                paths.append(list_path)
+    return paths
+
+
+def get_list_destination(path, destination, list_extension):
+    # Returns the directory for the list at path inside destination, creating
+    # it if necessary, or None if the path is taken by something else.
+    list_destination = os.path.join(
+        destination, os.path.basename(path)[:-len(list_extension)])
+    logger.debug("Desination set to \"%s\"", list_destination)
+    if not os.path.isdir(list_destination):
+        logger.debug("\"%s\" is not a directory.", list_destination)
+        if os.path.exists(list_destination):
+            logger.debug("\"%s\" is a valid path.", list_destination)
+            logger.error("Invalid destination: %s. Skipping list %s",
+                         list_destination, path)
+            return None
+        logger.debug("Creating destination directory \"%s\".",
+                     list_destination)
+        os.makedirs(list_destination)
+    return list_destination
+
+
 def check_line(line):
     return line and not line.startswith(COMMENT_CHAR)
 
@@ -147,56 +354,472 @@ def parse_file(path):
     return subreddits
 
 
+# Orderings of the work items. Every function gets the lists as
+# [(list destination, [subreddit, ...]), ...] and returns the
+# (subreddit, destination) items in the order they are handed to the workers.
+def order_by_list(lists):
+    return [(subreddit, destination) for (destination, subreddits) in lists
+            for subreddit in subreddits]
+
+
+def order_shuffled(lists):
+    items = order_by_list(lists)
+    random.shuffle(items)
+    return items
+
+
+def order_round_robin(lists):
+    # one subreddit of every list in turn
+    columns = itertools.zip_longest(
+        *[[(subreddit, destination) for subreddit in subreddits]
+          for (destination, subreddits) in lists])
+    return [item for column in columns for item in column if item]
+
+
+ORDERS = {ORDER_LIST: order_by_list,
+          ORDER_SHUFFLE: order_shuffled,
+          ORDER_ROUND_ROBIN: order_round_robin}
+
+
+def get_batches(items, size):
+    # Groups the (subreddit, list destination) items into batches of up to
+    # size items, see get_batch_links(). A batch never has a subreddit twice,
+    # the links of a combined listing are split by subreddit.
+    if size <= 1:
+        return items
+    batches = list()
+    batch = list()
+    for item in items:
+        if len(batch) >= size or item[0].lower() in \
+                [subreddit.lower() for (subreddit, _) in batch]:
+            batches.append(batch)
+            batch = list()
+        batch.append(item)
+    if batch:
+        batches.append(batch)
+    return [batch if len(batch) > 1 else batch[0] for batch in batches]
+
+
+def is_batch(item):
+    return isinstance(item, list)
+
+
+def get_manifest_items(records, destination):
+    # Returns a (subreddit, destination, [record, ...]) item for every
+    # subreddit directory of the manifest records.
+    items = list()
+    for (subreddit_destination, subreddit_records) in \
+            RedditImageGrab.manifest.group_by_destination(records):
+        (list_destination, subreddit) = os.path.split(subreddit_destination)
+        items.append((subreddit, os.path.join(destination, list_destination),
+                      subreddit_records))
+    return items
+
+
+def get_item(item):
+    # Returns (subreddit, destination, manifest records or None) of a work
+    # item, see get_manifest_items().
+    if len(item) > 2:
+        return item
+    return (item[0], item[1], None)
+
+
+def get_shared_item(item, destination):
+    # The work item as it is put into the shared queue of --coordinate, with
+    # its list destination relative to DEST.
+    if is_batch(item):
+        return {"batch": [get_shared_item(batch_item, destination)
+                          for batch_item in item]}
+    (subreddit, list_destination, records) = get_item(item)
+    return {"subreddit": subreddit,
+            "destination": os.path.relpath(list_destination, destination),
+            "records": records}
+
+
+def get_work_item(shared_destination=None):
+    # Returns (lease, work item), the item is None if there is no work left.
+    # With --join, the items come from the shared queue, lease is their id
+    # there and shared_destination the DEST they are downloaded to.
+    if not RedditImageGrab.workqueue.is_configured():
+        return (None, processqueue.get())
+    if RedditImageGrab.budget.exhausted():
+        # Leave the remaining items to the other nodes.
+        return (None, None)
+    job = RedditImageGrab.workqueue.get_node().get()
+    if job is None:
+        return (None, None)
+    (lease, shared_item) = job
+    return (lease, get_local_item(shared_item, shared_destination))
+
+
+def get_local_item(shared_item, shared_destination):
+    # The work item of an item of the shared queue, see get_shared_item().
+    if "batch" in shared_item:
+        return [get_local_item(batch_item, shared_destination)[:2]
+                for batch_item in shared_item["batch"]]
+    return (shared_item["subreddit"],
+            os.path.join(shared_destination, shared_item["destination"]),
+            shared_item["records"])
+
+
+def get_batch_items(item):
+    # The (subreddit, subreddit destination) items of a batch, for
+    # redditdownload.get_combined_links().
+    return [(subreddit, os.path.join(destination, subreddit))
+            for (subreddit, destination) in item]
+
+
+def get_listing_options(download_options):
+    # The download options that select the links of a listing.
+    return dict((key, download_options[key]) for key in
+                ("num", "update", "score", "sort", "time_filter",
+                 "link_filter"))
+
+
+def get_jobs(item, splitter=None):
+    # Returns (subreddit, list destination, manifest records, links,
+    # rejected) for every subreddit of a work item. links and rejected are
+    # the links of a batch and the ones the filter rejected, taken from
+    # splitter, or None if the subreddit fetches its own listing.
+    if not is_batch(item):
+        return [get_item(item) + (None, None)]
+    if splitter is None:
+        return [(subreddit, destination, None, None, None)
+                for (subreddit, destination) in item]
+    return [(subreddit, destination, None, splitter.get_links(subreddit),
+             splitter.rejected) for (subreddit, destination) in item]
+
+
+def end_work_item(lease, completed=True):
+    # Completes an item of the shared queue or, if it has not been
+    # downloaded, returns it to the queue.
+    if lease is None:
+        return
+    node = RedditImageGrab.workqueue.get_node()
+    if completed:
+        node.complete(lease)
+    else:
+        node.release(lease)
+
+
+def get_subreddit_destination(subreddit, destination):
+    # Returns the directory for subreddit inside destination, creating it if
+    # necessary, or None if the path is taken by something else.
+    subreddit_destination = os.path.join(destination, subreddit)
+    if not os.path.isdir(subreddit_destination):
+        if os.path.exists(subreddit_destination):
+            logger.error("Invalid destination: %s. Skipping subreddit %s",
+                         subreddit_destination, subreddit)
+            return None
+        os.makedirs(subreddit_destination)
+    return subreddit_destination
+
+
+def log_unexpected_exception(error):
+    logger.critical("Encountered unexpected exception %s.",
+                    repr(error), exc_info=True, stack_info=True)
+    exc_type, exc_value, exc_traceback = sys.exc_info()
+    traceback.print_tb(exc_traceback)
+    traceback.print_exception(exc_type, exc_value, exc_traceback)
+
+
+def add_stats(subreddit, subreddit_destination, total, downloaded, skipped,
+              errors):
+    RedditImageGrab.metrics.add("subreddits")
+    RedditImageGrab.metrics.add("processed", total)
+    RedditImageGrab.metrics.add("downloaded", downloaded)
+    RedditImageGrab.metrics.add("skipped", skipped)
+    RedditImageGrab.metrics.add("errors", errors)
+
+    logger.info("Done downloading from /r/%s to \"%s\" Downloaded: %d, "
+                "skipped/errors %d/%d, total processed: %d", subreddit,
+                subreddit_destination, downloaded, skipped, errors, total)
+
+
+def get_worker_name(process=None):
+    # Name of a worker process for its profile, unique within a run.
+    process = process or multiprocessing.current_process()
+    return "%s-%d" % (process.name, process.pid)
+
+
+def log_phases(phases):
+    for (phase, _) in RedditImageGrab.metrics.PHASES:
+        histogram = phases.get(phase)
+        if histogram is None or not histogram.count:
+            continue
+        logger.info("Phase %-10s %8d times, %9.2f s total, %9.2f ms on "
+                    "average", phase + ":", histogram.count, histogram.sum,
+                    histogram.sum * 1000 / histogram.count)
+
+
+def open_content_store(dedup_store):
+    if not dedup_store:
+        return None
+    return RedditImageGrab.dedup.open_store(dedup_store)
+
+
+def add_dedup_stats(content_store):
+    if content_store is None:
+        return
+    content_store.log_stats()
+    RedditImageGrab.metrics.add("dedup_files", content_store.linked_files)
+    RedditImageGrab.metrics.add("dedup_bytes_saved",
+                                content_store.linked_bytes)
+    RedditImageGrab.metrics.add("dedup_bytes_avoided",
+                                content_store.avoided_bytes)
+    content_store.close()
+
+
+def watch(scheduler, list_watcher, order, done_queue, consumers,
+          check_interval=DEFAULT_LIST_CHECK_INTERVAL):
+    # Hands the subreddits to the workers whenever the scheduler says they
+    # are due, until the budget is used up or the process is interrupted.
+    # done_queue: the workers put (subreddit, destination, new links) here
+    #             when they are done with an item
+    # consumers: items that are worked on at the same time at most
+    polling = 0
+    next_check = 0
+    try:
+        while True:
+            now = time.time()
+            if now >= next_check:
+                lists = list_watcher.check()
+                if lists is not None:
+                    scheduler.update(ORDERS[order](lists), now)
+                next_check = now + check_interval
+            if RedditImageGrab.budget.exhausted():
+                logger.info("Download budget used up, stopping.")
+                return
+            for key in scheduler.get_due(now, consumers - polling):
+                scheduler.start(key, now)
+                processqueue.put(key)
+                polling += 1
+            timeout = next_check - now
+            if polling < consumers:
+                delay = scheduler.get_delay(now)
+                if delay is not None:
+                    timeout = min(timeout, delay)
+            try:
+                (subreddit, destination, links) = done_queue.get(
+                    timeout=max(timeout, 0.01))
+            except queue.Empty:
+                continue
+            polling -= 1
+            scheduler.finish((subreddit, destination), links, time.time())
+    except KeyboardInterrupt:
+        logger.info("Stopping, waiting for the running downloads.")
+
+
+def report_done(done_queue, subreddit, destination, links=0):
+    # Tells watch() that an item is done.
+    if done_queue is not None:
+        done_queue.put((subreddit, destination, links))
+
+
+def get_batch_links(item, download_options):
+    # Fetches the combined listing of a batch, see get_jobs().
+    logger.info("Fetching one listing for /r/%s",
+                RedditImageGrab.reddit.get_combined_name(
+                    [subreddit for (subreddit, _) in item]))
+    try:
+        return RedditImageGrab.redditdownload.get_combined_links(
+            get_batch_items(item), **get_listing_options(download_options))
+    except Exception as error:
+        log_unexpected_exception(error)
+        return RedditImageGrab.reddit.LinkSplitter([])
+
+
+# Downloads one (subreddit, list destination, manifest records, links,
+# rejected) job of a work item, see get_jobs(). Returns False if the
+# subreddit has been skipped because the download budget is used up.
+def download_job(job, content_store, download_options, done_queue):
+    (subreddit, destination, planned, links, rejected) = job
+    if RedditImageGrab.budget.exhausted():
+        logger.debug("Download budget used up, skipping /r/%s.", subreddit)
+        report_done(done_queue, subreddit, destination)
+        return False
+    subreddit_destination = get_subreddit_destination(subreddit, destination)
+    if not subreddit_destination:
+        report_done(done_queue, subreddit, destination)
+        return True
+
+    logger.info("Starting download from /r/%s to %s", subreddit,
+                subreddit_destination)
+
+    #(total, downloaded, skipped, errors) = (10, 5, 3, 2)
+    #time.sleep(random.randrange(3,8))
+
+    RedditImageGrab.metrics.add("active_subreddits")
+    try:
+        (total, downloaded, skipped, errors) = \
+            RedditImageGrab.redditdownload.download(
+                subreddit, subreddit_destination, last="",
+                content_store=content_store, planned=planned, links=links,
+                rejected=rejected, **download_options)
+    except Exception as error:
+        log_unexpected_exception(error)
+        total = downloaded = skipped = errors = 0
+    finally:
+        RedditImageGrab.metrics.add("active_subreddits", -1)
+
+    report_done(done_queue, subreddit, destination, total)
+    add_stats(subreddit, subreddit_destination, total, downloaded, skipped,
+              errors)
+    RedditImageGrab.session.log_connection_stats()
+    if RedditImageGrab.httpcache.cache:
+        RedditImageGrab.httpcache.cache.log_stats()
+    return True
+
+
 # Worker method
-def download_subreddit(stats_array, score, max_downloads, no_sfw, no_nsfw,
-                       regex, verbose, flood_timeout):
+# metrics_queue: queue to send the statistics of the process to, see
+#                metrics.Collector
+# download_options: keyword arguments for redditdownload.download()
+# profile_path: if set, the process is profiled, see profiling.stop()
+# shared_destination: DEST of the items of the shared queue, see
+#                     get_work_item()
+# done_queue: see watch()
+def download_subreddit(metrics_queue, metrics_interval, dedup_store,
+                       download_options, profile_path=None,
+                       shared_destination=None, done_queue=None):
+    RedditImageGrab.metrics.start_reporting(metrics_queue, metrics_interval)
+    RedditImageGrab.profiling.start(profile_path)
+    content_store = open_content_store(dedup_store)
     while True:
-        try:
-            (subreddit, destination) = processqueue.get(block=True, timeout=2)
-        except queue.Empty:
+        (lease, item) = get_work_item(shared_destination)
+        if item is None:
             logger.debug("No more items to process. Process done.")
+            RedditImageGrab.workqueue.close_node()
+            add_dedup_stats(content_store)
+            RedditImageGrab.profiling.stop(profile_path, get_worker_name())
+            RedditImageGrab.metrics.stop_reporting()
             return
-        subreddit_destination = os.path.join(destination, subreddit)
-        if not os.path.isdir(subreddit_destination):
-            if os.path.exists(subreddit_destination):
-                logger.error("Invalid destination: %s. Skipping subreddit %s",
-                             subreddit_destination, subreddit)
-                continue
-            os.makedirs(subreddit_destination)
+        completed = True
+        try:
+            splitter = None
+            if is_batch(item) and not RedditImageGrab.budget.exhausted():
+                splitter = get_batch_links(item, download_options)
+            for job in get_jobs(item, splitter):
+                if not download_job(job, content_store, download_options,
+                                    done_queue):
+                    completed = False
+        except (KeyboardInterrupt, SystemExit):
+            end_work_item(lease, completed=False)
+            raise
+        end_work_item(lease, completed)
+
+
+# Worker method for --engine asyncio. Runs one event loop that downloads up
+# to max_subreddits subreddits at the same time, sharing concurrency
+# transfers between them.
+# download_options: keyword arguments for asyncdownload.download()
+def download_subreddit_async(metrics_queue, metrics_interval, dedup_store,
+                             download_options, max_subreddits, concurrency,
+                             profile_path=None, shared_destination=None,
+                             done_queue=None):
+    RedditImageGrab.metrics.start_reporting(metrics_queue, metrics_interval)
+    RedditImageGrab.profiling.start(profile_path)
+    content_store = open_content_store(dedup_store)
+    asyncio.run(_download_subreddits_async(
+        content_store, download_options, max_subreddits, concurrency,
+        shared_destination, done_queue))
+    RedditImageGrab.workqueue.close_node()
+    add_dedup_stats(content_store)
+    if RedditImageGrab.httpcache.cache:
+        RedditImageGrab.httpcache.cache.log_stats()
+    RedditImageGrab.profiling.stop(profile_path, get_worker_name())
+    RedditImageGrab.metrics.stop_reporting()
+
+
+async def _download_subreddits_async(content_store, download_options,
+                                     max_subreddits, concurrency,
+                                     shared_destination, done_queue):
+    loop = asyncio.get_running_loop()
+    transfers = asyncio.Semaphore(concurrency)
+    host_slots = dict()
+    # Waiting for a work item blocks for long with --join and --watch. It
+    # gets threads of its own, in the default executor it would take the
+    # threads the downloads need for the disk and the index.
+    item_executor = concurrent.futures.ThreadPoolExecutor(max_subreddits)
+
+    async def worker(client):
+        while True:
+            (lease, item) = await loop.run_in_executor(
+                item_executor, get_work_item, shared_destination)
+            if item is None:
+                logger.debug("No more items to process. Worker done.")
+                return
+            completed = True
+            try:
+                splitter = None
+                if is_batch(item) and \
+                        not RedditImageGrab.budget.exhausted():
+                    splitter = await get_batch_links(client, item)
+                for job in get_jobs(item, splitter):
+                    if not await download_job(client, job):
+                        completed = False
+            except (KeyboardInterrupt, SystemExit, asyncio.CancelledError):
+                end_work_item(lease, completed=False)
+                raise
+            await loop.run_in_executor(None, end_work_item, lease, completed)
+
+    async def get_batch_links(client, item):
+        # See get_batch_links()
+        logger.info("Fetching one listing for /r/%s",
+                    RedditImageGrab.reddit.get_combined_name(
+                        [subreddit for (subreddit, _) in item]))
+        try:
+            return await RedditImageGrab.asyncdownload.get_combined_links(
+                client, get_batch_items(item),
+                **get_listing_options(download_options))
+        except Exception as error:
+            log_unexpected_exception(error)
+            return RedditImageGrab.reddit.LinkSplitter([])
+
+    async def download_job(client, job):
+        # See download_job()
+        (subreddit, destination, planned, links, rejected) = job
+        if RedditImageGrab.budget.exhausted():
+            logger.debug("Download budget used up, skipping /r/%s.",
+                         subreddit)
+            report_done(done_queue, subreddit, destination)
+            return False
+        subreddit_destination = get_subreddit_destination(subreddit,
+                                                          destination)
+        if not subreddit_destination:
+            report_done(done_queue, subreddit, destination)
+            return True
 
         logger.info("Starting download from /r/%s to %s", subreddit,
                     subreddit_destination)
 
-        #(total, downloaded, skipped, errors) = (10, 5, 3, 2)
-        #time.sleep(random.randrange(3,8))
-
-        # sfw and nsfw means (n)sfw ONLY ... ffs
+        RedditImageGrab.metrics.add("active_subreddits")
         try:
             (total, downloaded, skipped, errors) = \
-                RedditImageGrab.redditdownload.download(
-                    subreddit, subreddit_destination, last="", score=score,
-                    num=max_downloads, update=False, sfw=no_nsfw,
-                    nsfw=no_sfw, regex=regex, verbose=verbose,
-                    quiet=(not verbose), timeout=flood_timeout)
-        except (KeyboardInterrupt, SystemExit):
-            raise
+                await RedditImageGrab.asyncdownload.download(
+                    subreddit, subreddit_destination, last="",
+                    client=client, transfers=transfers,
+                    host_slots=host_slots, content_store=content_store,
+                    planned=planned, links=links, rejected=rejected,
+                    **download_options)
         except Exception as error:
-            logger.critical("Encountered unexpected exception %s.",
-                            repr(error), exc_info=True, stack_info=True)
-            exc_type, exc_value, exc_traceback = sys.exc_info()
-            traceback.print_tb(exc_traceback)
-            traceback.print_exception(exc_type, exc_value, exc_traceback)
+            log_unexpected_exception(error)
             total = downloaded = skipped = errors = 0
+        finally:
+            RedditImageGrab.metrics.add("active_subreddits", -1)
 
-        stats_array[0] += total
-        stats_array[1] += downloaded
-        stats_array[2] += skipped
-        stats_array[3] += errors
+        report_done(done_queue, subreddit, destination, total)
+        add_stats(subreddit, subreddit_destination, total, downloaded,
+                  skipped, errors)
+        return True
 
-        logger.info("Done downloading from /r/%s to \"%s\" Downloaded: %d, "
-                    "skipped/errors %d/%d, total processed: %d", subreddit,
-                    subreddit_destination, downloaded, skipped, errors, total)
-        processqueue.task_done()
+    try:
+        async with RedditImageGrab.asyncdownload.create_client(
+                concurrency) as client:
+            await asyncio.gather(*[worker(client)
+                                   for _ in range(max_subreddits)])
+    finally:
+        item_executor.shutdown(wait=False)
 
 
 if __name__ == '__main__':
@@ -227,15 +850,31 @@ if __name__ == '__main__':
                       type="string", default=DEFAULT_SHUFFLE,
                       metavar="OPTIONS",
                       help="changes the shuffling behaviour.Valid OPTIONS "
-                      "include: lists, list-subreddits, all-subreddits")
+                      "include: lists, list-subreddits, all-subreddits "
+                      "(same as --order {0})".format(ORDER_SHUFFLE))
+    parser.add_option("--order", action="store", type="choice",
+                      dest="order", default=DEFAULT_ORDER,
+                      choices=sorted(ORDERS), metavar="ORDER",
+                      help="hand the subreddits of all lists to the workers "
+                      "in this order: {0} (one list after another), {1} or "
+                      "{2} (one subreddit of every list in turn) "
+                      "[default: {3}]".format(ORDER_LIST, ORDER_SHUFFLE,
+                                              ORDER_ROUND_ROBIN,
+                                              DEFAULT_ORDER))
     parser.add_option("--no-log", action="store_false", dest="logging_enabled",
                       default=DEFAULT_LOGGING_ENABLED, help="disable logging, "
-                      "no log file will be used. [NOT IMPLEMENTED]")
+                      "no log file will be used.")
     parser.add_option("-l", "--logfile", action="store",
                       dest="commandline_logfile", default=logfile,
                       type="string", metavar="FILE", help="redirect logging "
-                      "into FILE instead of the default location [NOT "
-                      "IMPLEMENTED]")
+                      "into FILE instead of the default location")
+    parser.add_option("--log-format", action="store", type="choice",
+                      dest="log_format", default=DEFAULT_LOG_FORMAT,
+                      choices=[LOG_FORMAT_TEXT, LOG_FORMAT_JSON],
+                      metavar="FORMAT", help="write log messages as {0} or "
+                      "as one {1} object per line [default: {2}]".format(
+                          LOG_FORMAT_TEXT, LOG_FORMAT_JSON,
+                          DEFAULT_LOG_FORMAT))
 
     group = optparse.OptionGroup(parser, "filter options")
     group.add_option("--no-sfw", action="store_true", dest="no_sfw",
@@ -247,21 +886,233 @@ if __name__ == '__main__':
     group.add_option("--score", action="store", type="int", dest="score",
                      default=DEFAULT_SCORE, help="do not download images with "
                      "a rating lower than SCORE", metavar="SCORE")
+    group.add_option("--sort", action="store", type="choice", dest="sort",
+                     default=DEFAULT_SORT,
+                     choices=list(RedditImageGrab.reddit.SORTS),
+                     metavar="SORT", help="fetch the {0}, {1} or {2} listing "
+                     "of every subreddit. A {2} listing is only fetched down "
+                     "to the first link below --score. --update always uses "
+                     "{1} [default: {3}]".format(
+                         *(RedditImageGrab.reddit.SORTS + (DEFAULT_SORT,))))
+    group.add_option("--time", action="store", type="choice",
+                     dest="time_filter", default=None,
+                     choices=list(RedditImageGrab.reddit.TIME_FILTERS),
+                     metavar="WINDOW", help="with --sort {0}, the time window "
+                     "of the listing: {1}. Reddit's default is {2}".format(
+                         RedditImageGrab.reddit.SORT_TOP,
+                         ", ".join(RedditImageGrab.reddit.TIME_FILTERS[:-1]) +
+                         " or " + RedditImageGrab.reddit.TIME_FILTERS[-1],
+                         RedditImageGrab.reddit.TIME_FILTERS[1]))
     group.add_option("--regex", action="store", type="string", dest="regex",
                      default=DEFAULT_REGEX, help="only download images with "
                      "titles that match the given regular expression")
+    group.add_option("--flair", action="store", type="string", dest="flair",
+                     default=None, metavar="REGEX", help="only download "
+                     "links with a flair that matches REGEX")
+    group.add_option("--domain", action="append", type="string",
+                     dest="domains", default=[], metavar="DOMAIN",
+                     help="only download links to DOMAIN or its subdomains. "
+                     "Can be given multiple times")
+    group.add_option("--exclude-domain", action="append", type="string",
+                     dest="exclude_domains", default=[], metavar="DOMAIN",
+                     help="do not download links to DOMAIN or its "
+                     "subdomains. Can be given multiple times")
+    group.add_option("--max-age", action="store", type="float",
+                     dest="max_age", default=None, metavar="HOURS",
+                     help="only download links posted in the last HOURS "
+                     "hours")
+    group.add_option("--no-self", action="store_true", dest="no_self",
+                     default=False, help="do not download self posts")
     parser.add_option_group(group)
 
     group = optparse.OptionGroup(parser, "download options")
+    group.add_option("--engine", action="store", type="choice",
+                     dest="engine", default=DEFAULT_ENGINE,
+                     choices=[ENGINE_PROCESSES, ENGINE_ASYNCIO],
+                     metavar="ENGINE", help="download with a pool of "
+                     "blocking worker processes (\"{0}\") or with event "
+                     "loops (\"{1}\", requires aiohttp). With \"{1}\", "
+                     "--processes sets the number of subreddits every event "
+                     "loop works on at the same time [default: {2}]".format(
+                         ENGINE_PROCESSES, ENGINE_ASYNCIO, DEFAULT_ENGINE))
+    group.add_option("--loops", action="store", type="int", dest="loops",
+                     default=DEFAULT_LOOPS, metavar="NUM", help="run NUM "
+                     "event loops in separate processes, e.g. one per core. "
+                     "Only used with --engine {0} [default: {1}]".format(
+                         ENGINE_ASYNCIO, DEFAULT_LOOPS))
+    group.add_option("--concurrency", action="store", type="int",
+                     dest="concurrency", default=DEFAULT_CONCURRENCY,
+                     metavar="NUM", help="run up to NUM transfers at the "
+                     "same time in every event loop. Only used with --engine "
+                     "{0} [default: {1}]".format(ENGINE_ASYNCIO,
+                                                 DEFAULT_CONCURRENCY))
     group.add_option("--max", action="store", type="int", dest="max_downloads",
                      default=0, help="download a maximum of NUM pictures per "
                      "subreddit", metavar="NUM")
+    group.add_option("--max-total", action="store", type="int",
+                     dest="max_total", default=0, metavar="NUM",
+                     help="download a maximum of NUM pictures in total, "
+                     "shared by all processes")
+    group.add_option("--max-total-bytes", action="store", type="int",
+                     dest="max_total_bytes", default=0, metavar="BYTES",
+                     help="stop starting new downloads once BYTES bytes have "
+                     "been downloaded in total")
+    group.add_option("-u", "--update", action="store_true", dest="update",
+                     default=DEFAULT_UPDATE, help="only fetch links that are "
+                     "newer than the newest link seen by the last update of "
+                     "the subreddit")
+    group.add_option("--batch", action="store", type="int", dest="batch",
+                     default=DEFAULT_BATCH, metavar="NUM", help="fetch the "
+                     "links of up to NUM subreddits with one listing request "
+                     "and split them by subreddit. Saves requests with many "
+                     "small subreddits, but all of them share the {0} links "
+                     "reddit serves for one listing [default: {1}]".format(
+                         RedditImageGrab.reddit.REDDIT_LINK_LIMIT,
+                         DEFAULT_BATCH))
+    group.add_option("--dedup", action="store_true", dest="dedup",
+                     default=DEFAULT_DEDUP, help="hardlink files with the "
+                     "same content instead of storing them again, across "
+                     "all subreddits and lists")
+    group.add_option("--dedup-store", action="store", type="string",
+                     dest="dedup_store", default=None, metavar="FILE",
+                     help="keep the content hashes for --dedup in FILE "
+                     "[default: DEST/{0}]".format(
+                         RedditImageGrab.dedup.STORE_FILE_NAME))
+    group.add_option("--cache", action="store_true", dest="cache",
+                     default=DEFAULT_CACHE, help="cache listings and imgur "
+                     "albums on disk and only download them again if they "
+                     "have changed")
+    group.add_option("--cache-dir", action="store", type="string",
+                     dest="cache_dir", default=None, metavar="DIR",
+                     help="keep the cache of --cache in DIR "
+                     "[default: DEST/{0}]".format(
+                         RedditImageGrab.httpcache.CACHE_DIR_NAME))
+    group.add_option("--cache-ttl", action="store", type="int",
+                     dest="cache_ttl", default=DEFAULT_CACHE_TTL,
+                     metavar="SECONDS", help="use cached responses for "
+                     "SECONDS seconds without asking the server if they "
+                     "have changed [default: {0}]".format(DEFAULT_CACHE_TTL))
+    group.add_option("--cache-size", action="store", type="int",
+                     dest="cache_size", default=DEFAULT_CACHE_SIZE,
+                     metavar="MB", help="limit the cache to MB megabytes "
+                     "[default: {0}]".format(DEFAULT_CACHE_SIZE))
+    group.add_option("--album-cache-ttl", action="store", type="int",
+                     dest="album_cache_ttl", default=DEFAULT_ALBUM_CACHE_TTL,
+                     metavar="SECONDS", help="remember the images of imgur "
+                     "albums for SECONDS seconds in DEST/{0}, 0 disables it "
+                     "[default: {1}]".format(
+                         RedditImageGrab.imgur.ALBUM_CACHE_FILE_NAME,
+                         DEFAULT_ALBUM_CACHE_TTL))
+    group.add_option("--album-concurrency", action="store", type="int",
+                     dest="album_concurrency",
+                     default=DEFAULT_ALBUM_CONCURRENCY, metavar="NUM",
+                     help="download up to NUM images of an album at the "
+                     "same time from one host [default: {0}]".format(
+                         DEFAULT_ALBUM_CONCURRENCY))
+    group.add_option("--url-rules", action="store", type="string",
+                     dest="url_rules", default=None, metavar="FILE",
+                     help="classify link URLs by the rules in FILE before "
+                     "the built-in ones. One \"direct|resolvable|unsupported "
+                     "DOMAIN [PATH-REGEX]\" or \"direct|resolvable|"
+                     "unsupported .EXTENSION\" per line, unsupported links "
+                     "are skipped without a request")
     group.add_option("--flood-timeout", action="store", type="int",
                      dest="flood_timeout", default=DEFAULT_FLOOD_TIMEOUT,
                      metavar="MILLISECONDS", help="wait MILLISECONDS between "
                      "connections to the server [default: {0}]".
                      format(DEFAULT_FLOOD_TIMEOUT))
+    group.add_option("--host-rate", action="append", type="string",
+                     dest="host_rates", default=[],
+                     metavar="HOST=RATE[/BURST]", help="send at most RATE "
+                     "requests per second to HOST, shared by all processes. "
+                     "Can be given multiple times. The rate of the reddit "
+                     "API is set with --flood-timeout")
+    group.add_option("--chunk-size", action="store", type="int",
+                     dest="chunk_size", default=DEFAULT_CHUNK_SIZE,
+                     metavar="BYTES", help="read responses in pieces of "
+                     "BYTES bytes [default: {0}]".format(DEFAULT_CHUNK_SIZE))
+    group.add_option("--buffer-size", action="store", type="int",
+                     dest="buffer_size", default=DEFAULT_BUFFER_SIZE,
+                     metavar="BYTES", help="buffer up to BYTES bytes before "
+                     "writing to disk [default: {0}]".format(
+                         DEFAULT_BUFFER_SIZE))
+    group.add_option("--listing-queue", action="store", type="int",
+                     dest="listing_queue_size",
+                     default=DEFAULT_LISTING_QUEUE_SIZE, metavar="NUM",
+                     help="fetch up to NUM links ahead of the downloads "
+                     "[default: {0}]".format(DEFAULT_LISTING_QUEUE_SIZE))
+    group.add_option("--resolve-queue", action="store", type="int",
+                     dest="resolve_queue_size",
+                     default=DEFAULT_RESOLVE_QUEUE_SIZE, metavar="NUM",
+                     help="resolve up to NUM links ahead of the downloads "
+                     "[default: {0}]".format(DEFAULT_RESOLVE_QUEUE_SIZE))
+    group.add_option("--pool-connections", action="store", type="int",
+                     dest="pool_connections",
+                     default=DEFAULT_POOL_CONNECTIONS, metavar="NUM",
+                     help="keep connection pools for NUM hosts per process "
+                     "[default: {0}]".format(DEFAULT_POOL_CONNECTIONS))
+    group.add_option("--pool-size", action="store", type="int",
+                     dest="pool_size", default=DEFAULT_POOL_SIZE,
+                     metavar="NUM", help="keep a maximum of NUM connections "
+                     "per host alive in every process [default: {0}]".
+                     format(DEFAULT_POOL_SIZE))
+
+    parser.add_option_group(group)
+
+    group = optparse.OptionGroup(parser, "plan and execute")
+    group.add_option("--plan", action="store", type="string", dest="plan",
+                     default=None, metavar="FILE", help="do not download "
+                     "anything, write the links that would be downloaded and "
+                     "their image URLs to FILE, one JSON object per line")
+    group.add_option("--execute", action="store_true", dest="execute",
+                     default=False, help="the arguments are manifests "
+                     "written by --plan, download them without asking reddit "
+                     "for listings. The filter options are not applied "
+                     "again")
+    group.add_option("--lines", action="store", type="string", dest="lines",
+                     default=None, metavar="FIRST-LAST", help="only execute "
+                     "the lines FIRST to LAST of the manifests, counted "
+                     "across all of them and starting at 1. Either end may "
+                     "be left out")
+    parser.add_option_group(group)
+
+    group = optparse.OptionGroup(parser, "watch mode")
+    group.add_option("--watch", action="store_true", dest="watch",
+                     default=False, help="keep running and poll every "
+                     "subreddit again for new links, busy ones more often "
+                     "than quiet ones, within the request rate of "
+                     "--flood-timeout. Lists are read again when they "
+                     "change. Implies --update")
+    group.add_option("--min-interval", action="store", type="float",
+                     dest="min_interval", default=DEFAULT_MIN_INTERVAL,
+                     metavar="SECONDS", help="with --watch, poll a subreddit "
+                     "at most every SECONDS seconds [default: {0}]".format(
+                         DEFAULT_MIN_INTERVAL))
+    group.add_option("--max-interval", action="store", type="float",
+                     dest="max_interval", default=DEFAULT_MAX_INTERVAL,
+                     metavar="SECONDS", help="with --watch, poll a subreddit "
+                     "at least every SECONDS seconds, unless the request "
+                     "rate does not allow it [default: {0}]".format(
+                         DEFAULT_MAX_INTERVAL))
+    parser.add_option_group(group)
 
+    group = optparse.OptionGroup(parser, "distributed downloads")
+    group.add_option("--coordinate", action="store", type="string",
+                     dest="coordinate", default=None, metavar="QUEUE",
+                     help="add the subreddits of the lists (or the manifests "
+                     "with --execute) to the shared queue QUEUE, a SQLite "
+                     "file on storage all nodes can reach, and exit")
+    group.add_option("--join", action="store", type="string", dest="join",
+                     default=None, metavar="QUEUE", help="download the items "
+                     "of the shared queue QUEUE to DEST until all of them are "
+                     "done. Nodes can join and leave at any time, the items "
+                     "of a node that went away are downloaded by another one "
+                     "once its leases have expired")
+    group.add_option("--lease", action="store", type="float", dest="lease",
+                     default=DEFAULT_LEASE, metavar="SECONDS",
+                     help="with --join, keep the items for SECONDS seconds "
+                     "without renewing the lease. They are renewed while the "
+                     "node is alive [default: {0}]".format(DEFAULT_LEASE))
     parser.add_option_group(group)
 
     group = optparse.OptionGroup(parser, "output control")
@@ -271,7 +1122,39 @@ if __name__ == '__main__':
                      help="be more verbose")
     parser.add_option_group(group)
 
+    group = optparse.OptionGroup(parser, "maintenance")
+    group.add_option("--rebuild-index", action="store_true",
+                     dest="rebuild_index", default=False,
+                     help="rebuild the download index of every directory "
+                     "below DEST from the files on disk and exit")
+    parser.add_option_group(group)
+
+    group = optparse.OptionGroup(parser, "statistics")
+    group.add_option("--metrics-file", action="store", type="string",
+                     dest="metrics_file", default=None, metavar="FILE",
+                     help="keep the statistics of the run in FILE in the "
+                     "Prometheus text format while it is going")
+    group.add_option("--metrics-port", action="store", type="int",
+                     dest="metrics_port", default=None, metavar="PORT",
+                     help="serve the statistics of the run in the Prometheus "
+                     "text format on http://127.0.0.1:PORT/metrics")
+    group.add_option("--metrics-interval", action="store", type="float",
+                     dest="metrics_interval",
+                     default=DEFAULT_METRICS_INTERVAL, metavar="SECONDS",
+                     help="update the statistics every SECONDS seconds "
+                     "[default: {0}]".format(DEFAULT_METRICS_INTERVAL))
+    group.add_option("--stats-json", action="store", type="string",
+                     dest="stats_json", default=None, metavar="FILE",
+                     help="write the statistics of the run to FILE as JSON "
+                     "when it is done")
+    parser.add_option_group(group)
+
     group = optparse.OptionGroup(parser, "debug options")
+    group.add_option("--profile", action="store", type="string",
+                     dest="profile", default=None, metavar="FILE",
+                     help="profile the workers and write the merged profile "
+                     "to FILE (see the pstats module), and log where the "
+                     "time of the downloads was spent")
     group.add_option("--debug", action="store_true", dest="debug",
                      help="print debug information")
     parser.add_option_group(group)
@@ -284,12 +1167,118 @@ if __name__ == '__main__':
     no_sfw = options.no_sfw
     no_nsfw = options.no_nsfw
     max_downloads = options.max_downloads
+    max_total = options.max_total
+    max_total_bytes = options.max_total_bytes
+    # Every poll of --watch only fetches the new links.
+    update = options.update or options.watch
+    dedup_store = None
+    if options.dedup or options.dedup_store:
+        dedup_store = options.dedup_store or os.path.join(
+            destination, RedditImageGrab.dedup.STORE_FILE_NAME)
+    cache_dir = None
+    if options.cache or options.cache_dir:
+        cache_dir = options.cache_dir or os.path.join(
+            destination, RedditImageGrab.httpcache.CACHE_DIR_NAME)
+    cache_ttl = options.cache_ttl
+    cache_size = options.cache_size
     max_processes = options.max_processes
     flood_timeout = options.flood_timeout
     list_extension = options.list_extension
     shuffle = options.shuffle
+    order = options.order
     recursive = options.recursive
     verbose = options.verbose
+    pool_connections = options.pool_connections
+    pool_size = options.pool_size
+    listing_queue_size = options.listing_queue_size
+    resolve_queue_size = options.resolve_queue_size
+    chunk_size = options.chunk_size
+    buffer_size = options.buffer_size
+    engine = options.engine
+    loops = options.loops
+    concurrency = options.concurrency
+
+    if (engine == ENGINE_ASYNCIO and
+            not RedditImageGrab.asyncdownload.is_available()):
+        parser.error("--engine {0} requires aiohttp".format(ENGINE_ASYNCIO))
+    if loops < 1 or concurrency < 1:
+        parser.error("--loops and --concurrency must be at least 1")
+    if chunk_size < 1 or buffer_size < 1:
+        parser.error("--chunk-size and --buffer-size must be at least 1")
+    if max_downloads < 0 or max_total < 0 or max_total_bytes < 0:
+        parser.error("--max, --max-total and --max-total-bytes must not be "
+                     "negative")
+    if options.metrics_interval <= 0:
+        parser.error("--metrics-interval must be positive")
+    if cache_ttl < 0 or cache_size < 0:
+        parser.error("--cache-ttl and --cache-size must not be negative")
+    if options.album_cache_ttl < 0:
+        parser.error("--album-cache-ttl must not be negative")
+    if options.album_concurrency < 1:
+        parser.error("--album-concurrency must be at least 1")
+    if options.batch < 1:
+        parser.error("--batch must be at least 1")
+    if options.max_age is not None and options.max_age <= 0:
+        parser.error("--max-age must be positive")
+    # Compiled once and inherited by the workers.
+    try:
+        link_filter = RedditImageGrab.linkfilter.LinkFilter(
+            score=score, sfw=no_nsfw, nsfw=no_sfw, regex=regex,
+            domains=options.domains, exclude_domains=options.exclude_domains,
+            max_age=options.max_age * 3600 if options.max_age else None,
+            no_self=options.no_self, flair=options.flair)
+    except re.error as error:
+        parser.error("--regex or --flair: {0}".format(error))
+    if options.url_rules:
+        # Inherited by the workers.
+        try:
+            RedditImageGrab.classify.configure(options.url_rules)
+        except (OSError, ValueError) as error:
+            parser.error("--url-rules: {0}".format(error))
+
+    if options.watch and (options.plan or options.execute or
+                          options.coordinate or options.join):
+        parser.error("--watch cannot be used with --plan, --execute, "
+                     "--coordinate or --join")
+    if options.batch > 1 and (options.watch or options.execute):
+        parser.error("--batch cannot be used with --watch or --execute")
+    if not 0 < options.min_interval <= options.max_interval:
+        parser.error("--min-interval must be positive and not larger than "
+                     "--max-interval")
+    if (options.update or options.watch) and \
+            options.sort != RedditImageGrab.reddit.SORT_NEW and \
+            options.sort != DEFAULT_SORT:
+        parser.error("--update and --watch only work on the {0} "
+                     "listing".format(RedditImageGrab.reddit.SORT_NEW))
+    if options.time_filter and options.sort != RedditImageGrab.reddit.SORT_TOP:
+        parser.error("--time requires --sort {0}".format(
+            RedditImageGrab.reddit.SORT_TOP))
+    if options.coordinate and options.join:
+        parser.error("--coordinate and --join cannot be used together")
+    if options.join and (args or options.execute):
+        parser.error("--join takes its work from the queue, no lists or "
+                     "manifests expected")
+    if options.lease <= 0:
+        parser.error("--lease must be positive")
+    if options.plan and options.execute:
+        parser.error("--plan and --execute cannot be used together")
+    (first_line, last_line) = (None, None)
+    if options.lines:
+        if not options.execute:
+            parser.error("--lines requires --execute")
+        try:
+            (first_line, last_line) = \
+                RedditImageGrab.manifest.parse_range(options.lines)
+        except ValueError as error:
+            parser.error("--lines: {0}".format(error))
+
+    host_rates = list()
+    for host_rate in options.host_rates:
+        try:
+            host_rates.append(
+                RedditImageGrab.ratelimit.parse_rate(host_rate))
+        except ValueError as error:
+            parser.error(str(error))
 
     shuffle_lists = DEFAULT_SHUFFLE_LISTS
     shuffle_list_subreddits = DEFAULT_SHUFFLE_LIST_SUBREDDITS
@@ -312,7 +1301,7 @@ if __name__ == '__main__':
     if list_extension[0] != '.':
         list_extension = ".{0}".format(list_extension)
 
-    if len(args) < 1:
+    if len(args) < 1 and not (options.rebuild_index or options.join):
         parser.error("expected at least one argument")
 
     if not os.path.isdir(destination):
@@ -341,6 +1330,7 @@ if __name__ == '__main__':
     #    lambda msg, *args, **kwargs: \
     #        logger.log(logging.VERBOSE, msg, *args, **kwargs)
 
+    logfile = options.commandline_logfile
     need_rollover = False
     if os.path.isfile(logfile):
         need_rollover = True
@@ -348,10 +1338,18 @@ if __name__ == '__main__':
     stdout_handler = logging.StreamHandler(sys.stdout)
     stderr_handler = logging.StreamHandler(sys.stderr)
     logfile_handler = logging.NullHandler()
-    logfile_handler = logging.handlers.RotatingFileHandler(logfile,
-                                                           backupCount=9)
-
-    if need_rollover:
+    if options.logging_enabled and logfile:
+        try:
+            if os.path.dirname(logfile):
+                os.makedirs(os.path.dirname(logfile), exist_ok=True)
+            logfile_handler = logging.handlers.RotatingFileHandler(
+                logfile, backupCount=9)
+        except OSError as error:
+            print("Could not open the log file {0}, no logging to a file "
+                  "will be done. Error: {1}".format(logfile, repr(error)))
+            need_rollover = False
+
+    if need_rollover and options.logging_enabled:
         logfile_handler.doRollover()
 
     stdout_handler.addFilter(LevelFilter(minlvl=logging.NOTSET,
@@ -371,136 +1369,376 @@ if __name__ == '__main__':
     stderr_handler.setLevel(console_logging_level)
     logfile_handler.setLevel(logging.DEBUG)
 
-    formatter = logging.Formatter(
-        fmt="[{asctime}] [{levelname}] [{processName}] {message}",
-        style='{')
+    if options.log_format == LOG_FORMAT_JSON:
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(
+            fmt="[{asctime}] [{levelname}] [{processName}] {message}",
+            style='{')
 
     stdout_handler.setFormatter(formatter)
     stderr_handler.setFormatter(formatter)
     logfile_handler.setFormatter(formatter)
 
-    logger.addHandler(stdout_handler)
-    logger.addHandler(stderr_handler)
-    logger.addHandler(logfile_handler)
+    # The handlers are owned by a single thread in the main process. All
+    # processes, including the main process, only put their records into a
+    # queue, so lines written by different workers never interleave and the
+    # file is only rotated by one process. The workers inherit the queue
+    # handler when they are forked. The listener thread is only started
+    # after that, until then the records wait in the queue.
+    log_queue = multiprocessing.Queue()
+    log_listener = logging.handlers.QueueListener(
+        log_queue, stdout_handler, stderr_handler, logfile_handler,
+        respect_handler_level=True)
+    atexit.register(shutdown_logging)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
 
     logger.debug("Logging setup completed")
     logger.debug("Command line: \"%s\"", " ".join(sys.argv))
     logger.debug("Options extracted: %s", options)
     logger.debug("Arguments extracted: %s", args)
 
-    paths = list()  # lazyness
-    # [ ( PATH , [ SUBREDDITS , ... ] ) , ... ]
-    # Cannot be a dict, otherwise correct order would not be guaranteed
-    lists = list()
-    for path in args:
-        if os.path.isdir(path):
-            for list_path in get_lists(path, recursive=recursive,
-                                       list_extension=list_extension):
-                if list_path in paths:
-                    logger.info("%s already encountered, ignored.", list_path)
-                else:
-                    lists.append((list_path, list()))
-                    paths.append(list_path)
-        elif os.path.isfile(path):
-            if check_file(path, list_extension):
-                if path in paths:
-                    logger.info("%s already encountered, ignored.", path)
-                else:
-                    lists.append((path, list()))
-                    paths.append(path)
-        else:
-            logger.error("Invalid path: %s not found.", path)
+    if options.rebuild_index:
+        # No workers are started.
+        start_logging()
+        logger.info("Rebuilding the download index below \"%s\".",
+                    destination)
+        count = RedditImageGrab.index.rebuild_tree(destination)
+        logger.info("Rebuilt the index of %d directories.", count)
+        shutdown_logging()
+        sys.exit(0)
 
-    if len(lists) == 0:
-        logger.error("No lists found.")
+    # Every work item is (subreddit, list destination), with --batch a
+    # list of them, or, with --execute, (subreddit, list destination,
+    # manifest records). With --join, the
+    # workers take them from the shared queue.
+    if options.join:
+        list_destinations = list()
+        work_items = list()
+    elif options.execute:
+        list_destinations = list()
+        try:
+            records = list(RedditImageGrab.manifest.read(
+                args, first=first_line, last=last_line))
+        except (OSError, ValueError) as error:
+            logger.error("Cannot read the manifest: %s", error)
+            sys.exit(ERROR_INVALID_COMMAND_LINE)
+        if len(records) == 0:
+            logger.error("No links found in the manifests.")
+            sys.exit(0)
+        work_items = get_manifest_items(records, destination)
+        logger.info("Executing %d links of %d subreddits from %d "
+                    "manifests.", len(records), len(work_items), len(args))
+    else:
+        # [ ( PATH , [ SUBREDDITS , ... ] ) , ... ]
+        # Cannot be a dict, otherwise correct order would not be guaranteed
+        lists = [(path, list()) for path in
+                 find_lists(args, recursive, list_extension)]
+
+        if len(lists) == 0:
+            logger.error("No lists found.")
+            sys.exit(0)
+
+        for (path, subreddits) in lists:
+            subreddits.extend(parse_file(path))
+
+        logger.debug("Subreddit lists: %s", lists)
+
+        # shuffle subreddits in every list if necessary. if all subreddits all
+        # shuffled anyway, we can skip this
+        if shuffle_list_subreddits and not shuffle_all_subreddits:
+            logger.debug("Shuffling subreddits in every list.")
+            for (_, subreddits) in lists:
+                random.shuffle(subreddits)
+
+        # shuffle lists if necessary. again, not if all subreddits are shuffled
+        # anyway
+        if shuffle_lists and not shuffle_all_subreddits:
+            logger.debug("Shuffling lists.")
+            random.shuffle(lists)
+
+        # all subreddits of all lists are shuffled when they are queued
+        if shuffle_all_subreddits:
+            order = ORDER_SHUFFLE
+
+        list_destinations = list()
+        for (path, subreddits) in lists:
+            logger.debug("Working on list \"%s\" with subreddits %s.", path,
+                         subreddits)
+            list_destination = get_list_destination(path, destination,
+                                                    list_extension)
+            if not list_destination:
+                continue
+            logger.info("Downloading subreddits in list \"%s\" into folder "
+                        "\"%s\"", os.path.basename(path), list_destination)
+            list_destinations.append((list_destination, subreddits))
+
+        work_items = ORDERS[order](list_destinations)
+        logger.debug("Queueing %d subreddits in %s order.", len(work_items),
+                     order)
+        if options.batch > 1:
+            subreddit_count = len(work_items)
+            work_items = get_batches(work_items, options.batch)
+            logger.info("Fetching up to %d subreddits with one listing, %d "
+                        "listings instead of %d.", options.batch,
+                        len(work_items), subreddit_count)
+
+    if options.coordinate:
+        try:
+            shared_queue = RedditImageGrab.workqueue.WorkQueue(
+                options.coordinate)
+            added = shared_queue.put([get_shared_item(item, destination)
+                                      for item in work_items])
+            counts = shared_queue.get_counts()
+            shared_queue.close()
+        except (OSError, sqlite3.Error) as error:
+            logger.error("Cannot add the items to the shared queue \"%s\": "
+                         "%s", options.coordinate, error)
+            sys.exit(ERROR_INVALID_COMMAND_LINE)
+        logger.info("Added %d items to the shared queue \"%s\". It has %d "
+                    "pending, %d leased, %d done and %d failed items.", added,
+                    options.coordinate,
+                    counts[RedditImageGrab.workqueue.PENDING],
+                    counts[RedditImageGrab.workqueue.LEASED],
+                    counts[RedditImageGrab.workqueue.DONE],
+                    counts[RedditImageGrab.workqueue.FAILED])
+        shutdown_logging()
         sys.exit(0)
 
-    for (path, subreddits) in lists:
-        subreddits.extend(parse_file(path))
-
-    logger.debug("Subreddit lists: %s", lists)
-
-    # shuffle subreddits in every list if necessary. if all subreddits all
-    # shuffled anyway, we can skip this
-    if shuffle_list_subreddits and not shuffle_all_subreddits:
-        logger.debug("Shuffling subreddits in every list.")
-        for (_, subreddits) in lists:
-            random.shuffle(subreddits)
-
-    # shuffle lists if necessary. again, not if all subreddits are shuffled
-    # anyway
-    if shuffle_lists and not shuffle_all_subreddits:
-        logger.debug("Shuffling lists.")
-        random.shuffle(lists)
-
-    # if all subreddits should be shuffled, we have to repack "lists". we pack
-    # all subreddits under one list
-    if shuffle_all_subreddits:
-        logger.critical("function implementation faulty, DO NO USE")
-        raise NotImplementedError()
-        #all_subreddits_list = list()
-        #all_subreddits_list.append(("shuffled-subreddits", list()))
-        #for (_, subreddits) in lists:
-        #    all_subreddits_list[0][1].extend(subreddits)
-        #lists = all_subreddits_list
-
-    processqueue = multiprocessing.JoinableQueue()
+    # The rate limiter lives in shared memory, all hosts have to be known
+    # before the workers are started.
+    for (host, rate, burst) in host_rates:
+        logger.debug("Limiting %s to %s requests per second (burst %s).",
+                     host, rate, burst)
+        try:
+            RedditImageGrab.ratelimit.limiter.set_rate(host, rate, burst)
+        except ValueError as error:
+            logger.error("%s", error)
+            sys.exit(ERROR_INVALID_COMMAND_LINE)
+    # --flood-timeout sets the rate of the reddit API.
+    RedditImageGrab.reddit.set_rate(flood_timeout)
+
+    # Every worker creates its own session with these settings.
+    RedditImageGrab.session.configure(connections=pool_connections,
+                                      maxsize=pool_size)
+
+    # Shared by all workers, so it has to exist before they are started.
+    if max_total or max_total_bytes:
+        logger.debug("Limiting the run to %s files and %s bytes.",
+                     max_total or "unlimited", max_total_bytes or "unlimited")
+    RedditImageGrab.budget.configure(max_files=max_total,
+                                     max_bytes=max_total_bytes)
+
+    if cache_dir:
+        logger.debug("Caching responses in \"%s\".", cache_dir)
+        RedditImageGrab.httpcache.configure(
+            cache_dir, ttl=cache_ttl, max_size=cache_size * 1024 * 1024)
+    if options.album_cache_ttl:
+        # Every worker opens the database itself.
+        RedditImageGrab.imgur.configure(
+            os.path.join(destination,
+                         RedditImageGrab.imgur.ALBUM_CACHE_FILE_NAME),
+            ttl=options.album_cache_ttl)
+    if options.join:
+        logger.info("Joining the shared queue \"%s\".", options.join)
+        RedditImageGrab.workqueue.configure(options.join, lease=options.lease)
+
+    # One pool of workers serves all lists. The queue holds every work item
+    # of the run, followed by one None per consumer to tell it to stop.
+    processqueue = multiprocessing.Queue()
     lock = multiprocessing.Lock()
 
-    stats_array = multiprocessing.Array(ctypes.c_int, 4)
-
-    for (path, subreddits) in lists:
-        logger.debug("Working on list \"%s\" with subreddits %s.", path,
-                     subreddits)
-        list_destination = os.path.join(
-            destination, os.path.basename(path)[:-len(list_extension)])
-        logger.debug("Desination set to \"%s\"", list_destination)
-        if not os.path.isdir(list_destination):
-            logger.debug("\"%s\" is not a directory.", list_destination)
-            if os.path.exists(list_destination):
-                logger.debug("\"%s\" is a valid path.", list_destination)
-                logger.error("Invalid destination: %s. Skipping list %s",
-                             list_destination, path)
-                continue
-            logger.debug("Creating destination directory \"%s\".",
-                         list_destination)
-            os.makedirs(list_destination)
-        logger.info("Downloading subreddits in list \"%s\" into folder \"%s\"",
-                    os.path.basename(path), list_destination)
-        for subreddit in subreddits:
-            # Feed the processqueue
-            processqueue.put((subreddit, list_destination))
-        # Start processes
-        for i in range(min(len(subreddits), max_processes)):
-            process = multiprocessing.Process(
-                target=download_subreddit,
-                kwargs={"stats_array": stats_array,
-                        "score": score,
-                        "max_downloads": max_downloads,
-                        "no_sfw": no_sfw,
-                        "no_nsfw": no_nsfw,
+    # Every worker sends its statistics here, see metrics.Collector.
+    metrics_queue = multiprocessing.Queue()
+
+    # In --watch mode, watch() queues the items when they are due.
+    if not options.watch:
+        for work_item in work_items:
+            processqueue.put(work_item)
+    done_queue = multiprocessing.Queue() if options.watch else None
+
+    # Opened before the workers are forked, they all append to it.
+    plan_writer = None
+    if options.plan:
+        try:
+            plan_writer = RedditImageGrab.manifest.Writer(
+                options.plan, destination, lock)
+        except OSError as error:
+            logger.error("Cannot write the manifest \"%s\": %s",
+                         options.plan, error)
+            sys.exit(ERROR_INVALID_COMMAND_LINE)
+
+    # sfw and nsfw means (n)sfw ONLY ... ffs
+    download_options = {"score": score,
+                        "num": max_downloads,
+                        "update": update,
+                        "sfw": no_nsfw,
+                        "nsfw": no_sfw,
                         "regex": regex,
                         "verbose": verbose,
-                        "flood_timeout": flood_timeout})
-            process.start()
-            # prevent all processes from starting simultaneously. Not actually
-            # necessary, as all requests to reddit adhere to the 2000ms
-            # timeout, but good to preserve correct order of startup.
-            time.sleep(0.2)
-            logger.debug("Started process %s", process.name)
-        logger.debug("Waiting for processes to finish ...")
-        processqueue.join()
-        logger.debug("All processes finished.")
-        logger.info("Downloads from subreddits in list \"%s\" completed, can "
-                    "be found in %s", os.path.basename(path), list_destination)
+                        "quiet": (not verbose),
+                        "timeout": flood_timeout,
+                        "chunk_size": chunk_size,
+                        "buffer_size": buffer_size,
+                        "album_concurrency": options.album_concurrency,
+                        "sort": options.sort,
+                        "time_filter": options.time_filter,
+                        "link_filter": link_filter,
+                        "plan": plan_writer.write if plan_writer else None}
+    worker_kwargs = {"metrics_queue": metrics_queue,
+                     "metrics_interval": options.metrics_interval,
+                     "dedup_store": dedup_store,
+                     "download_options": download_options,
+                     "profile_path": options.profile,
+                     "shared_destination": destination,
+                     "done_queue": done_queue}
+    if engine == ENGINE_ASYNCIO:
+        # every process runs one event loop handling max_processes
+        # subreddits at the same time
+        target = download_subreddit_async
+        # With --join and --watch, the number of items is not known.
+        num_processes = loops if options.join or options.watch else \
+            min(len(work_items), loops)
+        consumers = num_processes * max_processes
+        worker_kwargs.update({"max_subreddits": max_processes,
+                              "concurrency": concurrency})
+    else:
+        target = download_subreddit
+        num_processes = max_processes if options.join or options.watch \
+            else min(len(work_items), max_processes)
+        consumers = num_processes
+        download_options.update(
+            {"listing_queue_size": listing_queue_size,
+             "resolve_queue_size": resolve_queue_size})
+    if not (options.join or options.watch):
+        for _ in range(consumers):
+            processqueue.put(None)
+
+    processes = list()
+    for i in range(num_processes):
+        process = multiprocessing.Process(target=target,
+                                          kwargs=worker_kwargs)
+        process.start()
+        processes.append(process)
+        logger.debug("Started process %s", process.name)
+    start_logging()
+
+    # Started after the workers, no threads may be running when they fork.
+    # Until all work items are taken, the stop markers are queued behind
+    # them.
+    shared_queue = None
+    if options.join:
+        shared_queue = RedditImageGrab.workqueue.WorkQueue(options.join)
+
+        def get_queue_depth():
+            return shared_queue.get_counts()[RedditImageGrab.workqueue.PENDING]
+    else:
+        def get_queue_depth():
+            if options.watch:
+                return processqueue.qsize()
+            return max(0, processqueue.qsize() - consumers)
+    collector = RedditImageGrab.metrics.Collector(
+        metrics_queue, interval=options.metrics_interval,
+        textfile=options.metrics_file, get_queue_depth=get_queue_depth)
+    if options.metrics_port is not None:
+        try:
+            collector.serve(options.metrics_port)
+        except OSError as error:
+            logger.error("Cannot serve metrics on port %s: %s",
+                         options.metrics_port, error)
+
+    if options.watch:
+        # SIGTERM stops the daemon like Ctrl-C. The workers have been forked
+        # already and keep the default handler, they finish their items.
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        request_rate = 1000.0 / max(flood_timeout,
+                                    RedditImageGrab.reddit.REDDIT_MIN_TIMEOUT)
+        scheduler = RedditImageGrab.scheduler.Scheduler(
+            request_rate, min_interval=options.min_interval,
+            max_interval=options.max_interval)
+        logger.info("Watching the lists, polling at most %.2f subreddits "
+                    "per second.", request_rate)
+        watch(scheduler,
+              ListWatcher(args, recursive, list_extension, destination),
+              order, done_queue, consumers)
+        for _ in range(consumers):
+            processqueue.put(None)
+
+    logger.debug("Waiting for processes to finish ...")
+    # Workers send their final statistics when they exit.
+    for process in processes:
+        process.join()
+    logger.debug("All processes finished.")
+    collector.stop()
+    all_totals = collector.get_totals()
+    totals = all_totals["values"]
+    if not plan_writer:
+        for (list_destination, _) in list_destinations:
+            logger.info("Downloads from list \"%s\" completed, can be found "
+                        "in %s", os.path.basename(list_destination),
+                        list_destination)
 
     logger.info("--------------------------------------")
-    logger.info("Finished downloading.")
-    logger.info("Total downloaded files: %s", stats_array[1])
-    logger.info("Total skipped/errors:   %s/%s", stats_array[2],
-                stats_array[3])
-    logger.info("Total processed:        %s", stats_array[0])
+    if plan_writer:
+        plan_writer.close()
+        logger.info("Finished planning.")
+        logger.info("Total planned links:    %s, written to \"%s\"",
+                    totals["planned"], options.plan)
+    else:
+        logger.info("Finished downloading.")
+    logger.info("Total downloaded files: %s (%s bytes)",
+                totals["downloaded"], totals["bytes"])
+    logger.info("Total skipped/errors:   %s/%s", totals["skipped"],
+                totals["errors"])
+    logger.info("Total processed:        %s", totals["processed"])
+    if RedditImageGrab.budget.budget:
+        (budget_files, budget_bytes) = \
+            RedditImageGrab.budget.budget.get_usage()
+        logger.info("Budget used:            %s files, %s bytes%s",
+                    budget_files, budget_bytes,
+                    " (exhausted)" if RedditImageGrab.budget.exhausted()
+                    else "")
+    if dedup_store:
+        logger.info("Total deduplicated:     %s files, %s bytes saved, %s "
+                    "bytes not transferred", totals["dedup_files"],
+                    totals["dedup_bytes_saved"], totals["dedup_bytes_avoided"])
+    if shared_queue:
+        counts = shared_queue.get_counts()
+        shared_queue.close()
+        logger.info("Shared queue:           %s pending, %s leased, %s done, "
+                    "%s failed items",
+                    counts[RedditImageGrab.workqueue.PENDING],
+                    counts[RedditImageGrab.workqueue.LEASED],
+                    counts[RedditImageGrab.workqueue.DONE],
+                    counts[RedditImageGrab.workqueue.FAILED])
+    if totals["filtered"]:
+        logger.info("Total filtered:         %s links rejected in the "
+                    "listings", totals["filtered"])
+    if totals["unsupported"]:
+        logger.info("Total unsupported:      %s links skipped without a "
+                    "request", totals["unsupported"])
+    if totals["rejected"]:
+        logger.info("Total rejected:         %s responses, %s bytes not "
+                    "transferred", totals["rejected"],
+                    totals["rejected_bytes_avoided"])
+    if options.profile:
+        log_phases(all_totals["phases"])
+        stats = RedditImageGrab.profiling.merge(
+            options.profile,
+            [RedditImageGrab.profiling.get_worker_path(
+                options.profile, get_worker_name(process))
+             for process in processes])
+        if stats is not None:
+            logger.info("Profile of all workers written to \"%s\":\n%s",
+                        options.profile,
+                        RedditImageGrab.profiling.format_report(stats))
     logger.info("--------------------------------------")
+    if options.stats_json:
+        try:
+            collector.write_json(options.stats_json)
+        except OSError as error:
+            logger.error("Cannot write statistics to \"%s\": %s",
+                         options.stats_json, error)
 
     logger.debug("Shutting down logging system. Bye.")
-    logging.shutdown()
+    shutdown_logging()
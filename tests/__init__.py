@@ -0,0 +1,36 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Unit tests of the parts that do not need the network.
+#
+# Usage, from the top directory: python -m unittest (or python -m pytest)
+
+import logging
+import os.path
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "src"))
+
+# redditdl.py normally adds the VERBOSE level the modules log with.
+if not hasattr(logging, "VERBOSE"):
+    logging.VERBOSE = 15
+    logging.addLevelName(logging.VERBOSE, "VERBOSE")
+    logging.Logger.verbose = \
+        lambda obj, msg, *args, **kwargs: \
+        obj.log(logging.VERBOSE, msg, *args, **kwargs)
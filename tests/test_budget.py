@@ -0,0 +1,102 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import multiprocessing
+import unittest
+
+from RedditImageGrab import budget
+
+
+def reserve_all(shared_budget, results):
+    # Worker: reserves files until the budget is used up.
+    reserved = 0
+    while True:
+        try:
+            shared_budget.reserve_file()
+        except budget.BudgetExhaustedException:
+            break
+        reserved += 1
+    results.put(reserved)
+
+
+class BudgetTest(unittest.TestCase):
+    def test_file_limit(self):
+        run_budget = budget.Budget(max_files=2)
+        run_budget.reserve_file()
+        run_budget.reserve_file()
+        self.assertTrue(run_budget.exhausted())
+        with self.assertRaises(budget.BudgetExhaustedException):
+            run_budget.reserve_file()
+        # A download that did not produce a file gives its slot back.
+        run_budget.release_file()
+        self.assertFalse(run_budget.exhausted())
+        run_budget.reserve_file()
+        self.assertEqual(run_budget.get_usage(), (2, 0))
+
+    def test_byte_limit(self):
+        run_budget = budget.Budget(max_bytes=100)
+        run_budget.reserve_file()
+        run_budget.add_bytes(60)
+        self.assertFalse(run_budget.exhausted())
+        run_budget.add_bytes(60)
+        # Running downloads are finished, new ones are not started.
+        self.assertEqual(run_budget.get_usage(), (1, 120))
+        with self.assertRaises(budget.BudgetExhaustedException):
+            run_budget.reserve_file()
+
+    def test_no_limit(self):
+        run_budget = budget.Budget()
+        for _ in range(100):
+            run_budget.reserve_file()
+        run_budget.add_bytes(2 ** 40)
+        self.assertFalse(run_budget.exhausted())
+
+    def test_shared_by_processes(self):
+        run_budget = budget.Budget(max_files=50)
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=reserve_all,
+                                           args=(run_budget, results))
+                   for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        reserved = sum(results.get(timeout=30) for _ in workers)
+        for worker in workers:
+            worker.join()
+        self.assertEqual(reserved, 50)
+
+
+class ConfigureTest(unittest.TestCase):
+    def tearDown(self):
+        budget.configure()
+
+    def test_without_limits(self):
+        self.assertIsNone(budget.configure())
+        budget.reserve_file()
+        budget.add_bytes(10)
+        self.assertFalse(budget.exhausted())
+
+    def test_with_limits(self):
+        self.assertIsNotNone(budget.configure(max_files=1))
+        budget.reserve_file()
+        self.assertTrue(budget.exhausted())
+        budget.release_file()
+        self.assertFalse(budget.exhausted())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import tempfile
+import unittest
+
+from RedditImageGrab import classify
+
+
+class ClassifierTest(unittest.TestCase):
+    def setUp(self):
+        self.classifier = classify.Classifier()
+
+    def test_default_rules(self):
+        for (url, kind) in (
+                ("http://i.imgur.com/AbC12.JPG", classify.DIRECT),
+                ("http://imgur.com/a/abc12#0", classify.RESOLVABLE),
+                ("http://imgur.com/gallery/abc12", classify.UNSUPPORTED),
+                ("http://i.imgur.com/AbC12.gifv", classify.UNSUPPORTED),
+                ("https://v.redd.it/abc12", classify.UNSUPPORTED),
+                ("https://www.youtube.com/watch?v=x.jpg",
+                 classify.UNSUPPORTED),
+                ("https://www.reddit.com/r/pics/comments/abc/title/",
+                 classify.UNSUPPORTED),
+                ("https://i.redd.it/abc12.png", classify.DIRECT),
+                ("http://imgur.com/AbC12", classify.UNKNOWN),
+                ("http://example.com/image", classify.UNKNOWN)):
+            self.assertEqual(self.classifier.classify(url), kind, msg=url)
+
+    def test_subdomains_but_not_suffixes(self):
+        self.assertEqual(self.classifier.classify("http://m.youtube.com/x"),
+                         classify.UNSUPPORTED)
+        self.assertEqual(
+            self.classifier.classify("http://notyoutube.com/x.jpg"),
+            classify.DIRECT)
+
+    def test_rules_added_first_win(self):
+        self.classifier.add_rules([(classify.DIRECT, "gfycat.com",
+                                    r"\.gif$")],
+                                  [(classify.UNSUPPORTED, ".GIF")],
+                                  first=True)
+        self.assertEqual(self.classifier.classify("http://gfycat.com/x.gif"),
+                         classify.DIRECT)
+        self.assertEqual(self.classifier.classify("http://gfycat.com/x"),
+                         classify.UNSUPPORTED)
+        self.assertEqual(self.classifier.classify("http://x.com/x.gif"),
+                         classify.UNSUPPORTED)
+
+    def test_invalid_rules(self):
+        with self.assertRaises(ValueError):
+            self.classifier.add_rules([("image", "example.com", None)])
+        # There is no resolver for other domains.
+        with self.assertRaises(ValueError):
+            self.classifier.add_rules([(classify.RESOLVABLE, "example.com",
+                                        None)])
+
+
+class ParseRulesTest(unittest.TestCase):
+    def parse(self, text):
+        (handle, path) = tempfile.mkstemp(prefix="reddit-download-test-")
+        self.addCleanup(os.remove, path)
+        with os.fdopen(handle, "w") as rules_file:
+            rules_file.write(text)
+        return classify.parse_rules(path)
+
+    def test_parse_rules(self):
+        self.assertEqual(self.parse(
+            "# comment\n"
+            "\n"
+            "direct  i.example.com\n"
+            "unsupported example.com ^/video/ .*\n"
+            "direct .webp\n"),
+            ([("direct", "i.example.com", None),
+              ("unsupported", "example.com", "^/video/ .*")],
+             [("direct", ".webp")]))
+
+    def test_errors_name_the_line(self):
+        for text in ("direct\n",
+                     "image example.com\n",
+                     "direct .webp ^/x\n",
+                     "direct example.com ([\n"):
+            with self.assertRaisesRegex(ValueError, ":1: ", msg=text):
+                self.parse(text)
+        with self.assertRaisesRegex(ValueError, ":3: "):
+            self.parse("# comment\ndirect .webp\nresolvable example.com\n")
+
+
+if __name__ == '__main__':
+    unittest.main()
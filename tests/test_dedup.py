@@ -0,0 +1,148 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+from RedditImageGrab import dedup
+from RedditImageGrab import index
+from RedditImageGrab import redditdownload
+
+
+class ContentStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="reddit-download-test-")
+        self.store = dedup.open_store(self.directory)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, "wb") as test_file:
+            test_file.write(content)
+        digest = dedup.new_hash()
+        digest.update(content)
+        return (path, digest.hexdigest())
+
+    def test_store_is_created_in_a_directory(self):
+        self.assertEqual(self.store.path, os.path.join(
+            self.directory, dedup.STORE_FILE_NAME))
+
+    def test_find_by_digest_and_url(self):
+        (path, digest) = self.write("a.jpg", b"image")
+        self.store.add(digest, path, 5, url="http://x/a.jpg")
+        self.assertEqual(self.store.find_digest(digest), (path, 5))
+        self.assertEqual(self.store.find_url("http://x/a.jpg"), (path, 5))
+        self.assertIsNone(self.store.find_url("http://x/b.jpg"))
+
+    def test_changed_or_missing_files_are_forgotten(self):
+        (path, digest) = self.write("a.jpg", b"image")
+        self.store.add(digest, path, 5, url="http://x/a.jpg")
+        self.write("a.jpg", b"other image")
+        self.assertIsNone(self.store.find_url("http://x/a.jpg"))
+        # Even after the content is back, the entry is gone.
+        self.write("a.jpg", b"image")
+        self.assertIsNone(self.store.find_digest(digest))
+        (path, digest) = self.write("b.jpg", b"image")
+        self.store.add(digest, path, 5)
+        os.remove(path)
+        self.assertIsNone(self.store.find_digest(digest))
+
+    def test_link_replaces_the_copy(self):
+        (source, _) = self.write("a.jpg", b"image")
+        (copy, _) = self.write("b.jpg", b"image")
+        self.assertTrue(self.store.link(source, copy))
+        self.assertTrue(os.path.samefile(source, copy))
+        # No temporary files are left behind.
+        self.assertFalse(any(name.endswith(".link")
+                             for name in os.listdir(self.directory)))
+        self.assertTrue(self.store.link(source, source))
+
+    def test_link_fails_across_file_systems(self):
+        (source, _) = self.write("a.jpg", b"image")
+        (copy, _) = self.write("b.jpg", b"image")
+        with unittest.mock.patch.object(
+                dedup.os, "link",
+                side_effect=OSError(errno.EXDEV, "cross-device link")):
+            self.assertFalse(self.store.link(source, copy))
+        self.assertFalse(os.path.samefile(source, copy))
+        with unittest.mock.patch.object(
+                dedup.os, "link", side_effect=OSError(errno.EIO, "I/O")):
+            with self.assertRaises(OSError):
+                self.store.link(source, copy)
+
+
+class SaveFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="reddit-download-test-")
+        self.store = dedup.open_store(self.directory)
+        self.download_index = index.open_index(self.directory)
+
+    def tearDown(self):
+        self.download_index.close()
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def save(self, identifier, content, url):
+        temp_path = os.path.join(self.directory, ".%s.part" % identifier)
+        with open(temp_path, "wb") as temp_file:
+            temp_file.write(content)
+        file_hash = dedup.new_hash()
+        file_hash.update(content)
+        dest_path = os.path.join(self.directory, identifier + ".jpg")
+        self.assertTrue(redditdownload.save_file(
+            temp_path, dest_path, identifier, len(content), file_hash, url,
+            None, self.download_index, self.store))
+        self.assertFalse(os.path.exists(temp_path))
+        return dest_path
+
+    def test_copies_become_hardlinks(self):
+        first = self.save("First", b"image", "http://x/a.jpg")
+        second = self.save("Second", b"image", "http://y/a.jpg")
+        third = self.save("Third", b"other", "http://x/b.jpg")
+        self.assertTrue(os.path.samefile(first, second))
+        self.assertFalse(os.path.samefile(first, third))
+        self.assertEqual((self.store.linked_files, self.store.linked_bytes),
+                         (1, 5))
+        self.assertIn("Second", self.download_index)
+        # Both URLs lead to the first file.
+        self.assertEqual(self.store.find_url("http://y/a.jpg"), (first, 5))
+
+    def test_known_urls_are_linked_without_a_download(self):
+        first = self.save("First", b"image", "http://x/a.jpg")
+        self.assertFalse(redditdownload.link_known_url(
+            "http://x/b.jpg", self.directory, "Second", self.download_index,
+            255, "t3_2", self.store))
+        self.assertTrue(redditdownload.link_known_url(
+            "http://x/a.jpg", self.directory, "Second", self.download_index,
+            255, "t3_2", self.store))
+        self.assertTrue(os.path.samefile(
+            first, os.path.join(self.directory, "Second.jpg")))
+        self.assertEqual(self.store.avoided_bytes, 5)
+        self.assertIn("Second", self.download_index)
+
+
+if __name__ == '__main__':
+    unittest.main()
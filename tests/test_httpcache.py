@@ -0,0 +1,139 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+from RedditImageGrab import httpcache
+
+URL = "http://www.reddit.com/r/pics/new.json"
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers=None, content=b""):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.content = content
+
+
+class HTTPCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="reddit-download-test-")
+        self.cache = httpcache.HTTPCache(self.directory, ttl=60)
+        self.now = 1000.0
+        self.requests = []
+        self.responses = []
+        for patcher in (
+                unittest.mock.patch.object(httpcache.time, "time",
+                                           lambda: self.now),
+                unittest.mock.patch.object(httpcache.ratelimit, "acquire",
+                                           lambda url: 0.0),
+                unittest.mock.patch.object(httpcache.session, "get",
+                                           self.get)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def get(self, url, params=None, headers=None, timeout=None):
+        self.requests.append(headers)
+        return self.responses.pop(0)
+
+    def test_fresh_responses_need_no_request(self):
+        self.responses.append(FakeResponse(
+            200, {"etag": "\"1\"", "content-type": "application/json"},
+            b"{\"a\": 1}"))
+        self.assertEqual(self.cache.get(URL, {"limit": 100}).content,
+                         b"{\"a\": 1}")
+        self.now += 30
+        response = self.cache.get(URL, {"limit": 100})
+        self.assertEqual(response.json(), {"a": 1})
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        # Other parameters are another document.
+        self.assertIsNone(self.cache.lookup(URL, {"limit": 25}))
+
+    def test_stale_responses_are_revalidated(self):
+        self.responses.append(FakeResponse(
+            200, {"etag": "\"1\"", "last-modified": "Mon, 1 Jan 2024"},
+            b"listing"))
+        self.cache.get(URL)
+        self.now += 120
+        self.responses.append(FakeResponse(304))
+        self.assertEqual(self.cache.get(URL).content, b"listing")
+        self.assertEqual(self.requests[1],
+                         {"If-None-Match": "\"1\"",
+                          "If-Modified-Since": "Mon, 1 Jan 2024"})
+        self.assertEqual(self.cache.revalidated, 1)
+        # The 304 made the entry fresh again.
+        self.now += 30
+        self.cache.get(URL)
+        self.assertEqual(len(self.requests), 2)
+
+    def test_changed_responses_replace_the_entry(self):
+        self.responses.append(FakeResponse(200, {"etag": "\"1\""}, b"old"))
+        self.cache.get(URL)
+        self.now += 120
+        self.responses.append(FakeResponse(200, {"etag": "\"2\""}, b"new"))
+        self.assertEqual(self.cache.get(URL).content, b"new")
+        entry = self.cache.lookup(URL)
+        self.assertEqual((entry.content, entry.meta["headers"]),
+                         (b"new", {"etag": "\"2\""}))
+
+    def test_errors_are_not_cached(self):
+        self.responses.append(FakeResponse(503, content=b"busy"))
+        self.assertEqual(self.cache.get(URL).status_code, 503)
+        self.assertIsNone(self.cache.lookup(URL))
+
+    def test_truncated_entries_are_ignored(self):
+        self.cache.store(URL, None, {}, b"listing")
+        (_, body_path) = self.cache._get_paths(self.cache.get_key(URL))
+        with open(body_path, "wb") as body_file:
+            body_file.write(b"list")
+        self.assertIsNone(self.cache.lookup(URL))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        self.cache.max_size = 10
+        for (number, mtime) in ((1, 300), (2, 100), (3, 200)):
+            url = "%s?page=%d" % (URL, number)
+            self.cache.store(url, None, {}, b"x" * 4)
+            (_, body_path) = self.cache._get_paths(self.cache.get_key(url))
+            os.utime(body_path, (mtime, mtime))
+        self.cache.evict()
+        self.assertIsNone(self.cache.lookup(URL + "?page=2"))
+        self.assertIsNotNone(self.cache.lookup(URL + "?page=1"))
+        self.assertIsNotNone(self.cache.lookup(URL + "?page=3"))
+
+
+class CachedResponseTest(unittest.TestCase):
+    def test_charset(self):
+        response = httpcache.CachedResponse(
+            URL, 200, {"content-type": "text/html; charset=\"latin-1\""},
+            "caf\xe9".encode("latin-1"))
+        self.assertEqual(response.text, "caf\xe9")
+        response.headers = {"content-type": "text/html; charset=nonsense"}
+        self.assertEqual(response.text, "caf\ufffd")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os.path
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+from RedditImageGrab import imgur
+
+ALBUM_PAGE = """
+<script>
+album = {"images":[
+  {"hash":"AbC12","title":"first","ext":".PNG","width":10},
+  {"hash":"dEf34","title":"no extension"},
+  {"hash":"gHi56","animated":true,"ext":".gif"},
+  {"hash":"AbC12","ext":".png"}
+]};
+</script>
+"""
+
+
+class AlbumTest(unittest.TestCase):
+    def test_get_album_id(self):
+        self.assertEqual(imgur.get_album_id("http://imgur.com/a/abc12#0"),
+                         "abc12")
+        self.assertEqual(imgur.get_album_id("https://imgur.com/a/abc12/"),
+                         "abc12")
+        self.assertIsNone(imgur.get_album_id("http://imgur.com/abc12"))
+        self.assertIsNone(imgur.get_album_id("http://imgur.com/a/"))
+
+    def test_parse_album(self):
+        self.assertEqual(imgur.parse_album(ALBUM_PAGE),
+                         [("AbC12", ".png"), ("dEf34", ".jpg"),
+                          ("gHi56", ".gif")])
+        self.assertEqual(imgur.parse_album("<html>removed</html>"), [])
+
+    def test_get_image_urls(self):
+        self.assertEqual(imgur.get_image_urls([("AbC12", ".png"),
+                                               ("dEf34", ".jpg")]),
+                         ["http://i.imgur.com/AbC12.png",
+                          "http://i.imgur.com/dEf34.jpg"])
+
+
+class AlbumCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="reddit-download-test-")
+        self.now = 1000.0
+        patcher = unittest.mock.patch.object(imgur.time, "time",
+                                             lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        imgur.configure(os.path.join(self.directory,
+                                     imgur.ALBUM_CACHE_FILE_NAME), ttl=60)
+
+    def tearDown(self):
+        with imgur._caches_lock:
+            for cache in imgur._caches.values():
+                cache.close()
+            imgur._caches.clear()
+        imgur.configure(None)
+        shutil.rmtree(self.directory)
+
+    def test_items_are_kept_for_the_ttl(self):
+        items = [("AbC12", ".png"), ("dEf34", ".jpg")]
+        imgur.cache_items("abc12", items)
+        self.now += 30
+        self.assertEqual(imgur.get_cached_items("abc12"), items)
+        self.assertIsNone(imgur.get_cached_items("other"))
+        self.now += 30
+        self.assertIsNone(imgur.get_cached_items("abc12"))
+
+    def test_empty_albums_are_not_cached(self):
+        imgur.cache_items("abc12", [])
+        self.assertIsNone(imgur.get_cached_items("abc12"))
+
+    def test_disabled(self):
+        imgur.configure(None)
+        imgur.cache_items("abc12", [("AbC12", ".png")])
+        self.assertIsNone(imgur.get_cache())
+        self.assertIsNone(imgur.get_cached_items("abc12"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from RedditImageGrab import index
+
+
+class IndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="reddit-download-test-")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, *path, size=3):
+        path = os.path.join(self.directory, *path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as test_file:
+            test_file.write(b"x" * size)
+        return path
+
+
+class DownloadIndexTest(IndexTestCase):
+    def test_files_and_links(self):
+        with index.open_index(self.directory) as download_index:
+            download_index.add_file("A title", os.path.join(
+                self.directory, "A title.jpg"), 10, name="t3_1",
+                url="http://x/a.jpg")
+            download_index.add_link("t3_1", "http://imgur.com/a/x")
+            self.assertIn("A title", download_index)
+            self.assertNotIn("Other", download_index)
+            self.assertTrue(download_index.has_url("http://x/a.jpg"))
+            self.assertFalse(download_index.has_url("http://x/b.jpg"))
+            self.assertTrue(download_index.has_link("t3_1"))
+            self.assertFalse(download_index.has_link("t3_2"))
+        # The entries are kept on disk.
+        with index.open_index(self.directory) as download_index:
+            self.assertFalse(download_index.created)
+            self.assertIn("A title", download_index)
+            self.assertTrue(download_index.has_link("t3_1"))
+
+    def test_cursors(self):
+        with index.open_index(self.directory) as download_index:
+            self.assertIsNone(download_index.get_cursor("pics"))
+            download_index.set_cursor("Pics", "t3_1")
+            download_index.set_cursor("pics", "t3_2")
+            self.assertEqual(download_index.get_cursor("PICS"), "t3_2")
+
+    def test_existing_files_are_indexed_once(self):
+        self.write("First.jpg")
+        self.write(".hidden.jpg")
+        self.write(".First.jpg.part")
+        os.mkdir(os.path.join(self.directory, "subdirectory"))
+        with index.open_index(self.directory) as download_index:
+            self.assertTrue(download_index.created)
+            self.assertIn("First", download_index)
+            self.assertNotIn(".hidden", download_index)
+            self.assertNotIn("subdirectory", download_index)
+        # Files added later are only found by a rebuild.
+        self.write("Second.png")
+        with index.open_index(self.directory) as download_index:
+            self.assertNotIn("Second", download_index)
+            self.assertEqual(download_index.rebuild(), 2)
+            self.assertIn("Second", download_index)
+
+    def test_rebuild_drops_missing_files(self):
+        path = self.write("Gone.jpg")
+        with index.open_index(self.directory) as download_index:
+            os.remove(path)
+            download_index.add_link("t3_1")
+            self.assertEqual(download_index.rebuild(), 0)
+            self.assertNotIn("Gone", download_index)
+            # Links are not stored on disk, they are kept.
+            self.assertTrue(download_index.has_link("t3_1"))
+
+
+class RebuildTreeTest(IndexTestCase):
+    def test_directories_with_files_or_an_index(self):
+        self.write("list", "pics", "a.jpg")
+        self.write("list", "pics", "b.jpg")
+        self.write("list", "aww", "c.jpg")
+        os.makedirs(os.path.join(self.directory, "list", "empty"))
+        # Only has an index, its files are gone.
+        os.makedirs(os.path.join(self.directory, "indexed"))
+        index.DownloadIndex(os.path.join(self.directory, "indexed")).close()
+        self.assertEqual(index.rebuild_tree(self.directory), 3)
+        with index.DownloadIndex(os.path.join(
+                self.directory, "list", "pics")) as download_index:
+            self.assertIn("a", download_index)
+            self.assertIn("b", download_index)
+        self.assertFalse(os.path.exists(os.path.join(
+            self.directory, "list", "empty", index.INDEX_FILE_NAME)))
+
+    def test_hidden_directories_are_skipped(self):
+        self.write("pics", "a.jpg")
+        self.write(".reddit-download-cache", "76", "7646c1d0")
+        self.assertEqual(index.rebuild_tree(self.directory), 1)
+        self.assertFalse(os.path.exists(os.path.join(
+            self.directory, ".reddit-download-cache", "76",
+            index.INDEX_FILE_NAME)))
+
+
+if __name__ == '__main__':
+    unittest.main()
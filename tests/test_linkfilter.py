@@ -0,0 +1,154 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import unittest
+
+from RedditImageGrab import linkfilter
+
+
+def get_data(**fields):
+    data = {"title": "A title", "url": "http://i.imgur.com/a.jpg",
+            "name": "t3_1", "score": 10, "over_18": False,
+            "subreddit": "pics"}
+    data.update(fields)
+    return data
+
+
+class DomainTest(unittest.TestCase):
+    def test_subdomains_match(self):
+        self.assertTrue(linkfilter.is_domain_allowed(
+            "i.imgur.com", {"imgur.com"}, set()))
+        self.assertTrue(linkfilter.is_domain_allowed(
+            "imgur.com", {"imgur.com"}, set()))
+
+    def test_only_whole_labels_match(self):
+        self.assertFalse(linkfilter.is_domain_allowed(
+            "notimgur.com", {"imgur.com"}, set()))
+        self.assertFalse(linkfilter.is_domain_allowed(
+            "imgur.com", {"i.imgur.com"}, set()))
+
+    def test_excluded_wins(self):
+        self.assertFalse(linkfilter.is_domain_allowed(
+            "i.imgur.com", {"imgur.com"}, {"i.imgur.com"}))
+        self.assertTrue(linkfilter.is_domain_allowed(
+            "m.imgur.com", {"imgur.com"}, {"i.imgur.com"}))
+
+    def test_no_included_allows_everything_else(self):
+        self.assertTrue(linkfilter.is_domain_allowed(
+            "example.com", set(), {"imgur.com"}))
+        self.assertFalse(linkfilter.is_domain_allowed(
+            "i.imgur.com", set(), {"imgur.com"}))
+
+    def test_link_domain(self):
+        self.assertEqual(linkfilter.get_link_domain(
+            get_data(domain="I.Imgur.com")), "i.imgur.com")
+        # Without the domain field, the host of the URL is used.
+        self.assertEqual(linkfilter.get_link_domain(
+            get_data(url="https://Example.com:8080/a.jpg")), "example.com")
+
+    def test_option_domains_are_normalized(self):
+        link_filter = linkfilter.LinkFilter(domains=[".IMGUR.com."])
+        self.assertIsNone(link_filter.get_reason(
+            get_data(domain="i.imgur.com")))
+
+
+class LinkFilterTest(unittest.TestCase):
+    def test_negative_scores_are_rejected_by_default(self):
+        link_filter = linkfilter.LinkFilter()
+        self.assertIsNone(link_filter.get_reason(get_data(score=0)))
+        self.assertEqual(link_filter.get_reason(get_data(score=-1)),
+                         linkfilter.SCORE)
+
+    def test_without_checks(self):
+        link_filter = linkfilter.LinkFilter(score=None)
+        self.assertFalse(link_filter)
+        self.assertIsNone(link_filter.get_reason(get_data(score=-5)))
+
+    def test_first_failing_check_is_the_reason(self):
+        link_filter = linkfilter.LinkFilter(score=20, sfw=True,
+                                            regex="Other")
+        self.assertEqual(link_filter.get_reason(get_data(over_18=True)),
+                         linkfilter.SCORE)
+        self.assertEqual(link_filter.get_reason(
+            get_data(score=30, over_18=True)), linkfilter.NSFW)
+        self.assertEqual(link_filter.get_reason(get_data(score=30)),
+                         linkfilter.TITLE)
+
+    def test_nsfw_only(self):
+        link_filter = linkfilter.LinkFilter(nsfw=True)
+        self.assertEqual(link_filter.get_reason(get_data()), linkfilter.SFW)
+        self.assertIsNone(link_filter.get_reason(get_data(over_18=True)))
+
+    def test_self_posts(self):
+        link_filter = linkfilter.LinkFilter(no_self=True)
+        self.assertEqual(link_filter.get_reason(get_data(is_self=True)),
+                         linkfilter.SELF)
+        self.assertIsNone(link_filter.get_reason(get_data()))
+
+    def test_max_age(self):
+        link_filter = linkfilter.LinkFilter(max_age=3600)
+        now = time.time()
+        self.assertIsNone(link_filter.get_reason(
+            get_data(created_utc=now - 60)))
+        self.assertEqual(link_filter.get_reason(
+            get_data(created_utc=now - 7200)), linkfilter.AGE)
+        # Links without a creation time are kept.
+        self.assertIsNone(link_filter.get_reason(get_data()))
+
+    def test_regex_and_flair_match_at_the_start(self):
+        link_filter = linkfilter.LinkFilter(regex="A", flair="OC")
+        self.assertIsNone(link_filter.get_reason(
+            get_data(link_flair_text="OC")))
+        self.assertEqual(link_filter.get_reason(
+            get_data(link_flair_text="Not OC")), linkfilter.FLAIR)
+        self.assertEqual(link_filter.get_reason(get_data()),
+                         linkfilter.FLAIR)
+        self.assertEqual(link_filter.get_reason(
+            get_data(title="The title", link_flair_text="OC")),
+            linkfilter.TITLE)
+
+
+class RejectedTest(unittest.TestCase):
+    def test_split_by_subreddit(self):
+        rejected = linkfilter.Rejected(split=True)
+        rejected.add(get_data(name="t3_1", subreddit="Pics"),
+                     linkfilter.SCORE)
+        rejected.add(get_data(name="t3_2", subreddit="pics"),
+                     linkfilter.NSFW)
+        rejected.add(get_data(name="t3_3", subreddit="aww"),
+                     linkfilter.SCORE)
+        self.assertEqual(rejected.get("PICS"),
+                         {linkfilter.SCORE: 1, linkfilter.NSFW: 1})
+        self.assertEqual(rejected.get_names("pics"), ["t3_1", "t3_2"])
+        self.assertEqual(rejected.get_names("aww"), ["t3_3"])
+        self.assertEqual(rejected.get("other"), {})
+        self.assertEqual(rejected.get_names("other"), [])
+
+    def test_not_split(self):
+        rejected = linkfilter.Rejected()
+        rejected.add(get_data(name="t3_1", subreddit="pics"),
+                     linkfilter.SCORE)
+        rejected.add(get_data(name="t3_2", subreddit="aww"),
+                     linkfilter.SCORE)
+        self.assertEqual(rejected.get("anything"), {linkfilter.SCORE: 2})
+        self.assertEqual(rejected.get_names(), ["t3_1", "t3_2"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from RedditImageGrab import manifest
+
+
+def get_record(**fields):
+    record = {"name": "t3_1", "title": "A title", "score": 1,
+              "nsfw": False, "url": "http://imgur.com/a/x",
+              "subreddit": "pics", "destination": "list/pics",
+              "urls": ["http://i.imgur.com/x.jpg"]}
+    record.update(fields)
+    return record
+
+
+class ParseRangeTest(unittest.TestCase):
+    def test_ranges(self):
+        self.assertEqual(manifest.parse_range("3-7"), (3, 7))
+        self.assertEqual(manifest.parse_range("3-"), (3, None))
+        self.assertEqual(manifest.parse_range("-7"), (None, 7))
+        self.assertEqual(manifest.parse_range(" 2 - 2 "), (2, 2))
+
+    def test_invalid_ranges(self):
+        for text in ("3", "a-b", "0-5", "5-0", "7-3", "1.5-2"):
+            with self.assertRaises(ValueError, msg=text):
+                manifest.parse_range(text)
+
+
+class CheckRecordTest(unittest.TestCase):
+    def test_valid_record(self):
+        manifest.check_record(get_record())
+        manifest.check_record(get_record(destination="list/./pics"))
+        manifest.check_record(get_record(destination="list/sub/../pics"))
+
+    def test_destination_must_stay_below_dest(self):
+        for destination in ("/etc", "..", "../list/pics", "list/../../x",
+                            ".", "list/.."):
+            with self.assertRaises(ValueError, msg=destination):
+                manifest.check_record(get_record(destination=destination))
+
+    def test_missing_fields(self):
+        record = get_record()
+        del record["urls"]
+        del record["name"]
+        with self.assertRaisesRegex(ValueError, "name, urls"):
+            manifest.check_record(record)
+
+    def test_invalid_types(self):
+        with self.assertRaises(ValueError):
+            manifest.check_record(["not", "an", "object"])
+        with self.assertRaises(ValueError):
+            manifest.check_record(get_record(urls="http://x/a.jpg"))
+
+
+class ReadTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="reddit-download-test-")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, lines):
+        path = os.path.join(self.directory, name)
+        with open(path, "w", encoding="utf-8") as manifest_file:
+            for line in lines:
+                manifest_file.write(line + "\n")
+        return path
+
+    def test_lines_are_numbered_across_manifests(self):
+        first = self.write("a.jsonl", [json.dumps(get_record(name="t3_1")),
+                                       "",
+                                       json.dumps(get_record(name="t3_2"))])
+        second = self.write("b.jsonl", [json.dumps(get_record(name="t3_3"))])
+        names = [record["name"] for record in
+                 manifest.read([first, second], first=2, last=3)]
+        self.assertEqual(names, ["t3_2", "t3_3"])
+
+    def test_invalid_line(self):
+        path = self.write("a.jsonl", [json.dumps(get_record()), "{"])
+        with self.assertRaisesRegex(ValueError, "a.jsonl:2:"):
+            list(manifest.read([path]))
+
+    def test_group_by_destination(self):
+        records = [get_record(name="t3_1", destination="l/a"),
+                   get_record(name="t3_2", destination="l/b"),
+                   get_record(name="t3_3", destination="l/./a")]
+        groups = manifest.group_by_destination(records)
+        self.assertEqual([(destination, [record["name"] for record in group])
+                          for (destination, group) in groups],
+                         [("l/a", ["t3_1", "t3_3"]), ("l/b", ["t3_2"])])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os.path
+import queue
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+import urllib.request
+
+from RedditImageGrab import metrics
+
+
+class HistogramTest(unittest.TestCase):
+    def test_observe_and_merge(self):
+        histogram = metrics.Histogram((1.0, 2.0, float("inf")))
+        for value in (0.5, 1.0, 1.5, 100.0):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        other = metrics.Histogram.from_dict(histogram.to_dict(),
+                                            histogram.buckets)
+        histogram.merge(other)
+        self.assertEqual(histogram.counts, [4, 2, 2])
+        self.assertEqual((histogram.sum, histogram.count), (206.0, 8))
+
+
+class CollectorTest(unittest.TestCase):
+    def setUp(self):
+        # Stopping waits for the collector to notice, keep that short.
+        patcher = unittest.mock.patch.object(metrics, "POLL_INTERVAL", 0.01)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.directory = tempfile.mkdtemp(prefix="reddit-download-test-")
+        self.textfile = os.path.join(self.directory, "metrics.prom")
+        self.inqueue = queue.Queue()
+        self.collector = metrics.Collector(self.inqueue, interval=3600,
+                                           textfile=self.textfile,
+                                           get_queue_depth=lambda: 3)
+
+    def tearDown(self):
+        self.collector.stop()
+        shutil.rmtree(self.directory)
+
+    def report(self, worker, downloaded, latency=None):
+        worker_metrics = metrics.WorkerMetrics()
+        worker_metrics.add("downloaded", downloaded)
+        worker_metrics.add("bytes", downloaded * 1000)
+        if latency is not None:
+            worker_metrics.observe_latency("i.imgur.com", latency)
+            worker_metrics.observe_phase("write", latency)
+        self.inqueue.put((worker, worker_metrics.snapshot()))
+
+    def test_latest_snapshots_are_added_up(self):
+        self.report("worker-1", 1)
+        self.report("worker-1", 5)
+        self.report("worker-2", 2)
+        # Stopping takes everything from the queue in order, the collector
+        # thread could store an older snapshot after a newer one.
+        self.collector.stop()
+        totals = self.collector.get_totals()
+        # Snapshots are complete, only the latest one of a worker counts.
+        self.assertEqual(totals["values"]["downloaded"], 7)
+        self.assertEqual(totals["values"]["bytes"], 7000)
+        self.assertEqual((totals["workers"], totals["queued_subreddits"]),
+                         (2, 3))
+
+    def test_prometheus_text(self):
+        self.report("worker-1", 2, latency=0.3)
+        self.report("worker-2", 1, latency=7.0)
+        self.collector.stop()
+        lines = self.collector.to_prometheus().splitlines()
+        self.assertIn("# TYPE reddit_download_downloaded_total counter",
+                      lines)
+        self.assertIn("reddit_download_downloaded_total 3", lines)
+        self.assertIn("reddit_download_active_subreddits 0", lines)
+        self.assertIn("reddit_download_queued_subreddits 3", lines)
+        self.assertIn("# TYPE reddit_download_request_duration_seconds "
+                      "histogram", lines)
+        # Buckets are cumulative.
+        self.assertIn('reddit_download_request_duration_seconds_bucket'
+                      '{host="i.imgur.com",le="0.25"} 0', lines)
+        self.assertIn('reddit_download_request_duration_seconds_bucket'
+                      '{host="i.imgur.com",le="0.5"} 1', lines)
+        self.assertIn('reddit_download_request_duration_seconds_bucket'
+                      '{host="i.imgur.com",le="+Inf"} 2', lines)
+        self.assertIn('reddit_download_request_duration_seconds_count'
+                      '{host="i.imgur.com"} 2', lines)
+        self.assertIn('reddit_download_phase_duration_seconds_bucket'
+                      '{phase="write",le="10.0"} 2', lines)
+
+    def test_textfile_is_written_on_stop(self):
+        self.report("worker-1", 4)
+        self.collector.stop()
+        with open(self.textfile) as textfile:
+            self.assertIn("reddit_download_downloaded_total 4\n",
+                          textfile.read())
+
+    def test_json(self):
+        self.report("worker-1", 1, latency=0.1)
+        self.collector.stop()
+        totals = json.loads(self.collector.to_json())
+        self.assertEqual(totals["values"]["downloaded"], 1)
+        self.assertEqual(totals["latencies"]["i.imgur.com"]["buckets"][-1],
+                         None)
+
+    def test_serve(self):
+        self.report("worker-1", 2)
+        self.collector.stop()
+        self.collector.serve(0)
+        url = "http://127.0.0.1:%d/metrics" % \
+            self.collector.server.server_address[1]
+        with urllib.request.urlopen(url, timeout=10) as response:
+            self.assertIn(b"reddit_download_downloaded_total 2\n",
+                          response.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+import unittest
+import unittest.mock
+
+from RedditImageGrab import pipeline
+
+
+def double(item):
+    return item * 2
+
+
+def fail(item):
+    raise ValueError("stage failed on %s" % item)
+
+
+class CountingSource(object):
+    # Endless source that records how far it got and whether it was closed.
+    def __init__(self):
+        self.produced = 0
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        try:
+            while True:
+                self.produced += 1
+                yield self.produced
+        finally:
+            self.closed.set()
+
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        # Closing waits for the stages to notice, keep that short.
+        patcher = unittest.mock.patch.object(pipeline, "POLL_INTERVAL", 0.01)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_items_pass_all_stages_in_order(self):
+        with pipeline.Pipeline(range(50), [("source", None),
+                                           ("double", double),
+                                           ("plus", lambda item: item + 1)],
+                               [2, 2, 2]) as items:
+            self.assertEqual(list(items),
+                             [number * 2 + 1 for number in range(50)])
+        self.assertEqual([stats.items for stats in items.stats],
+                         [50, 50, 50, 50])
+
+    def test_queue_sizes_must_match_stages(self):
+        with self.assertRaises(ValueError):
+            pipeline.Pipeline([], [("source", None), ("double", double)],
+                              [1])
+
+    def test_source_errors_reach_the_consumer(self):
+        def source():
+            yield 1
+            raise KeyError("listing")
+
+        with pipeline.Pipeline(source(), [("source", None),
+                                          ("double", double)],
+                               [1, 1]) as items:
+            iterator = iter(items)
+            self.assertEqual(next(iterator), 2)
+            with self.assertRaises(KeyError):
+                next(iterator)
+
+    def test_stage_errors_reach_the_consumer(self):
+        with pipeline.Pipeline(range(3), [("source", None), ("fail", fail)],
+                               [1, 1]) as items:
+            with self.assertRaisesRegex(ValueError, "stage failed on 0"):
+                list(items)
+
+    def test_close_stops_an_endless_source(self):
+        source = CountingSource()
+        items = pipeline.Pipeline(source, [("source", None),
+                                           ("double", double)], [3, 3])
+        with items:
+            for item in items:
+                if item >= 4:
+                    break
+        # close() has joined all threads, the generator has been closed.
+        self.assertTrue(source.closed.is_set())
+        self.assertFalse(any(thread.is_alive() for thread in items.threads))
+
+    def test_producer_only_runs_ahead_by_the_queue_sizes(self):
+        source = CountingSource()
+        with pipeline.Pipeline(source, [("source", None), ("double", double)],
+                               [3, 3]) as items:
+            iterator = iter(items)
+            next(iterator)
+            time.sleep(0.2)
+            # One item consumed, one in every queue slot and one held by
+            # each stage thread while it waits to put it.
+            self.assertLessEqual(source.produced, 1 + 3 + 3 + 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import unittest.mock
+
+from RedditImageGrab import ratelimit
+
+
+class HostRateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        # The buckets are refilled by a clock the test moves.
+        self.now = 100.0
+        patcher = unittest.mock.patch.object(ratelimit.time, "monotonic",
+                                             lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_then_rate(self):
+        limiter = ratelimit.HostRateLimiter({"example.com": (2.0, 3)})
+        waits = [limiter.reserve("example.com") for _ in range(5)]
+        self.assertEqual(waits, [0.0, 0.0, 0.0, 0.5, 1.0])
+
+    def test_refill_is_capped_at_burst(self):
+        limiter = ratelimit.HostRateLimiter({"example.com": (2.0, 3)})
+        for _ in range(5):
+            limiter.reserve("example.com")
+        # Two tokens were borrowed, one second gives two back.
+        self.now += 1.0
+        self.assertEqual(limiter.reserve("example.com"), 0.5)
+        self.now += 60.0
+        waits = [limiter.reserve("example.com") for _ in range(4)]
+        self.assertEqual(waits, [0.0, 0.0, 0.0, 0.5])
+
+    def test_hosts_have_their_own_buckets(self):
+        limiter = ratelimit.HostRateLimiter({"a.com": (1.0, 1),
+                                             "b.com": (1.0, 1)})
+        self.assertEqual(limiter.reserve("a.com"), 0.0)
+        self.assertEqual(limiter.reserve("b.com"), 0.0)
+        self.assertEqual(limiter.reserve("a.com"), 1.0)
+
+    def test_unknown_hosts_share_buckets(self):
+        limiter = ratelimit.HostRateLimiter(default_rate=(1.0, 1),
+                                            shared_buckets=1)
+        self.assertEqual(limiter.reserve("a.com"), 0.0)
+        self.assertEqual(limiter.reserve("b.com"), 1.0)
+
+    def test_changing_the_rate(self):
+        limiter = ratelimit.HostRateLimiter({"example.com": (1.0, 5)})
+        limiter.set_rate("example.com", 4.0, 2)
+        waits = [limiter.reserve("example.com") for _ in range(3)]
+        # The saved tokens are cut down to the new burst.
+        self.assertEqual(waits, [0.0, 0.0, 0.25])
+
+    def test_invalid_rates(self):
+        limiter = ratelimit.HostRateLimiter()
+        for (rate, burst) in ((0, 1), (-1.0, 1), (1.0, 0)):
+            with self.assertRaises(ValueError):
+                limiter.set_rate("example.com", rate, burst)
+
+    def test_too_many_hosts(self):
+        limiter = ratelimit.HostRateLimiter()
+        for number in range(ratelimit.MAX_CONFIGURED_HOSTS):
+            limiter.set_rate("host%d.com" % number, 1.0)
+        with self.assertRaises(ValueError):
+            limiter.set_rate("one-more.com", 1.0)
+        # Known hosts can still be changed.
+        limiter.set_rate("host0.com", 2.0)
+
+
+class ParseRateTest(unittest.TestCase):
+    def test_parse_rate(self):
+        self.assertEqual(ratelimit.parse_rate("I.Imgur.com=20"),
+                         ("i.imgur.com", 20.0, 1))
+        self.assertEqual(ratelimit.parse_rate("imgur.com = 0.5/4"),
+                         ("imgur.com", 0.5, 4))
+
+    def test_invalid(self):
+        for value in ("imgur.com", "imgur.com=fast", "imgur.com=1/2.5"):
+            with self.assertRaises(ValueError, msg=value):
+                ratelimit.parse_rate(value)
+
+    def test_get_host(self):
+        self.assertEqual(ratelimit.get_host("http://WWW.Reddit.com/r/x"),
+                         "www.reddit.com")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from RedditImageGrab import linkfilter
+from RedditImageGrab import reddit
+
+
+def get_name(number):
+    # Higher numbers are newer links.
+    return "t3_" + to_base36(number)
+
+
+def to_base36(number):
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    result = ""
+    while number:
+        (number, digit) = divmod(number, 36)
+        result = digits[digit] + result
+    return result or "0"
+
+
+def get_link_data(number, subreddit, score=10):
+    return {"title": "post %d" % number, "url": "http://x/%d.jpg" % number,
+            "name": get_name(number), "score": score, "over_18": False,
+            "subreddit": subreddit}
+
+
+def get_link(number, subreddit):
+    return reddit.get_link(get_link_data(number, subreddit))
+
+
+class LinkSplitterTest(unittest.TestCase):
+    def feed(self, splitter, links):
+        # Like get_links() with a "new" listing: newest first, is_past_end()
+        # before every link. Returns the number of links consumed.
+        consumed = 0
+        for (number, subreddit) in links:
+            if splitter.is_past_end(get_link_data(number, subreddit)):
+                break
+            consumed += 1
+            if not splitter.add(get_link(number, subreddit)):
+                break
+        return consumed
+
+    def get_numbers(self, splitter, subreddit):
+        return [reddit.get_id(link.name)
+                for link in splitter.get_links(subreddit)]
+
+    def test_links_are_split_by_subreddit(self):
+        splitter = reddit.LinkSplitter(["pics", "Aww"])
+        self.feed(splitter, [(6, "pics"), (5, "aww"), (4, "PICS"),
+                             (3, "other")])
+        self.assertEqual(self.get_numbers(splitter, "pics"), [6, 4])
+        self.assertEqual(self.get_numbers(splitter, "aww"), [5])
+        self.assertEqual(splitter.get_links("other"), [])
+
+    def test_limit_per_subreddit(self):
+        splitter = reddit.LinkSplitter(["pics", "aww"], limit=2)
+        consumed = self.feed(splitter, [(9, "pics"), (8, "pics"),
+                                        (7, "pics"), (6, "aww"),
+                                        (5, "aww"), (4, "aww")])
+        self.assertEqual(self.get_numbers(splitter, "pics"), [9, 8])
+        self.assertEqual(self.get_numbers(splitter, "aww"), [6, 5])
+        # The listing ends once both subreddits are full.
+        self.assertEqual(consumed, 5)
+
+    def test_stop_at_per_subreddit(self):
+        # pics has seen 7 and older, aww 4 and older. The "new" listing is
+        # ordered by age across both, so reaching 7 ends pics even though
+        # it is a link of aww.
+        splitter = reddit.LinkSplitter(
+            ["pics", "aww"], stop_at={"Pics": get_name(7),
+                                      "aww": get_name(4)})
+        consumed = self.feed(splitter, [(9, "pics"), (8, "aww"),
+                                        (7, "aww"), (6, "pics"),
+                                        (5, "aww"), (4, "pics"),
+                                        (3, "aww")])
+        self.assertEqual(self.get_numbers(splitter, "pics"), [9])
+        self.assertEqual(self.get_numbers(splitter, "aww"), [8, 7, 5])
+        # Reaching 4 ends aww as well, and with it the listing.
+        self.assertEqual(consumed, 5)
+
+    def test_subreddits_without_stop_at_stay_open(self):
+        splitter = reddit.LinkSplitter(["pics", "aww"],
+                                       stop_at={"pics": get_name(5),
+                                                "aww": None})
+        consumed = self.feed(splitter, [(6, "pics"), (5, "aww"),
+                                        (4, "pics"), (3, "aww")])
+        self.assertEqual(self.get_numbers(splitter, "pics"), [6])
+        self.assertEqual(self.get_numbers(splitter, "aww"), [5, 3])
+        self.assertEqual(consumed, 4)
+
+    def test_rejected_links_of_open_subreddits(self):
+        splitter = reddit.LinkSplitter(["pics", "aww"], limit=1)
+        splitter.add(get_link(9, "pics"))
+        splitter.add_rejected(get_link_data(8, "pics"), linkfilter.SCORE)
+        splitter.add_rejected(get_link_data(7, "aww"), linkfilter.SCORE)
+        splitter.add_rejected(get_link_data(6, "other"), linkfilter.SCORE)
+        # pics is full, its rejected links are not part of its run.
+        self.assertEqual(splitter.rejected.get_names("pics"), [])
+        self.assertEqual(splitter.rejected.get_names("aww"), [get_name(7)])
+        self.assertEqual(splitter.rejected.get_names("other"), [])
+
+
+class ListingTest(unittest.TestCase):
+    def test_parse_listing(self):
+        json_data = {"data": {"children": [
+            {"data": get_link_data(3, "pics")},
+            {"data": {"name": get_name(2), "title": "no url"}},
+            "junk",
+            {"data": get_link_data(1, "pics")}], "after": get_name(1)}}
+        (page, after) = reddit.parse_listing(json_data)
+        self.assertEqual([data["name"] for data in page],
+                         [get_name(3), get_name(1)])
+        self.assertEqual(after, get_name(1))
+
+    def test_parse_invalid_listing(self):
+        with self.assertRaises(KeyError):
+            reddit.parse_listing({"data": {}})
+
+    def test_is_past_end(self):
+        self.assertTrue(reddit.is_past_end(get_name(5), 10, "pics",
+                                           stop_at=get_name(5)))
+        self.assertFalse(reddit.is_past_end(get_name(6), 10, "pics",
+                                            stop_at=get_name(5)))
+        # Only the top listing is ordered by score.
+        self.assertTrue(reddit.is_past_end(get_name(6), 1, "pics",
+                                           sort=reddit.SORT_TOP,
+                                           min_score=2))
+        self.assertFalse(reddit.is_past_end(get_name(6), 1, "pics",
+                                            sort=reddit.SORT_NEW,
+                                            min_score=2))
+
+    def test_get_link_with_filter(self):
+        rejected = linkfilter.Rejected()
+        link_filter = linkfilter.LinkFilter(score=5)
+        self.assertIsNone(reddit.get_link(get_link_data(1, "pics", score=4),
+                                          link_filter, rejected.add))
+        link = reddit.get_link(get_link_data(2, "pics", score=5),
+                               link_filter, rejected.add)
+        self.assertEqual((link.name, link.subreddit), (get_name(2), "pics"))
+        self.assertEqual(rejected.get(), {linkfilter.SCORE: 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
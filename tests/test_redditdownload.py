@@ -0,0 +1,238 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+from RedditImageGrab import index
+from RedditImageGrab import metrics
+from RedditImageGrab import reddit
+from RedditImageGrab import redditdownload
+
+
+class UpdateCursorTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="reddit-download-test-")
+        self.download_index = index.open_index(self.directory)
+
+    def tearDown(self):
+        self.download_index.close()
+        shutil.rmtree(self.directory)
+
+    def test_start_without_update(self):
+        self.assertEqual(redditdownload.get_update_start(
+            "pics", None, False, self.download_index, sort=reddit.SORT_TOP),
+            (reddit.SORT_TOP, None))
+        # --last needs the "new" listing.
+        self.assertEqual(redditdownload.get_update_start(
+            "pics", "t3_5", False, self.download_index, sort=reddit.SORT_TOP),
+            (reddit.SORT_NEW, "t3_5"))
+
+    def test_start_of_an_update(self):
+        self.assertEqual(redditdownload.get_update_start(
+            "pics", None, True, self.download_index),
+            (reddit.SORT_NEW, None))
+        self.download_index.set_cursor("pics", "t3_5")
+        self.assertEqual(redditdownload.get_update_start(
+            "pics", None, True, self.download_index),
+            (reddit.SORT_NEW, "t3_5"))
+        # --last wins over the cursor.
+        self.assertEqual(redditdownload.get_update_start(
+            "pics", "t3_2", True, self.download_index),
+            (reddit.SORT_NEW, "t3_2"))
+
+    def test_newest_link_is_saved(self):
+        redditdownload.save_update_cursor(
+            "pics", self.download_index, ["t3_a", "t3_z", "t3_b"], [])
+        self.assertEqual(self.download_index.get_cursor("pics"), "t3_z")
+
+    def test_cursor_never_moves_back(self):
+        self.download_index.set_cursor("pics", "t3_z")
+        redditdownload.save_update_cursor(
+            "pics", self.download_index, ["t3_a", "t3_b"], [])
+        self.assertEqual(self.download_index.get_cursor("pics"), "t3_z")
+
+    def test_failed_links_are_tried_again(self):
+        seen = ["t3_a", "t3_b", "t3_c", "t3_d"]
+        redditdownload.save_update_cursor(
+            "pics", self.download_index, seen, ["t3_d", "t3_c"])
+        self.assertEqual(self.download_index.get_cursor("pics"), "t3_b")
+        # Nothing older than the failed link, nothing to save.
+        redditdownload.save_update_cursor(
+            "aww", self.download_index, seen, ["t3_a"])
+        self.assertIsNone(self.download_index.get_cursor("aww"))
+
+
+class CombinedStartTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="reddit-download-test-")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_cursors_of_all_subreddits(self):
+        pics = os.path.join(self.directory, "pics")
+        aww = os.path.join(self.directory, "aww")
+        os.mkdir(pics)
+        os.mkdir(aww)
+        with index.open_index(pics) as download_index:
+            download_index.set_cursor("pics", "t3_5")
+        items = [("pics", pics), ("aww", aww),
+                 ("new", os.path.join(self.directory, "new"))]
+        self.assertEqual(redditdownload.get_combined_start(items, True),
+                         (reddit.SORT_NEW, {"pics": "t3_5", "aww": None}))
+        # Nothing is created for subreddits that were never downloaded.
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "new")))
+        self.assertEqual(redditdownload.get_combined_start(
+            items, False, sort=reddit.SORT_TOP), (reddit.SORT_TOP, {}))
+
+
+class PartFileTest(unittest.TestCase):
+    URL = "http://i.imgur.com/AbC12.jpg"
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="reddit-download-test-")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def interrupt(self, data, etag="\"1\""):
+        # A download that received data and was interrupted.
+        part = redditdownload.PartFile(self.directory, self.URL)
+        part.accept_response(200, {"etag": etag})
+        part.open().write(data)
+        part.keep()
+        return part
+
+    def read(self, part):
+        with open(part.path, "rb") as part_file:
+            return part_file.read()
+
+    def test_interrupted_downloads_are_continued(self):
+        self.interrupt(b"first half")
+        # The next attempt, maybe in the next run, asks for the rest.
+        part = redditdownload.PartFile(self.directory, self.URL)
+        self.assertEqual(part.get_request_headers(),
+                         {"Range": "bytes=10-", "If-Range": "\"1\""})
+        self.assertTrue(part.accept_response(
+            206, {"content-range": "bytes 10-19/20"}))
+        part.open().write(b", the rest")
+        part.close()
+        self.assertEqual(self.read(part), b"first half, the rest")
+
+    def test_changed_files_start_over(self):
+        self.interrupt(b"old content")
+        part = redditdownload.PartFile(self.directory, self.URL)
+        self.assertFalse(part.accept_response(200, {"etag": "\"2\""}))
+        part.open().write(b"new")
+        part.keep()
+        self.assertEqual(self.read(part), b"new")
+        self.assertEqual(part.get_request_headers(),
+                         {"Range": "bytes=3-", "If-Range": "\"2\""})
+
+    def test_failure_before_starting_over_keeps_the_old_validator(self):
+        self.interrupt(b"old content")
+        part = redditdownload.PartFile(self.directory, self.URL)
+        # The file has changed, but the transfer fails before the part file
+        # is opened.
+        self.assertFalse(part.accept_response(200, {"etag": "\"2\""}))
+        part.keep()
+        self.assertEqual(part.get_request_headers(),
+                         {"Range": "bytes=11-", "If-Range": "\"1\""})
+        part = redditdownload.PartFile(self.directory, self.URL)
+        self.assertEqual(part.get_request_headers(),
+                         {"Range": "bytes=11-", "If-Range": "\"1\""})
+
+    def test_weak_etags_are_not_used(self):
+        part = self.interrupt(b"data", etag="W/\"1\"")
+        self.assertEqual(part.get_request_headers(), {})
+        self.assertFalse(os.path.exists(part.path))
+        part = redditdownload.PartFile(self.directory, self.URL)
+        part.accept_response(200, {"etag": "W/\"1\"",
+                                   "last-modified": "Mon, 1 Jan 2024"})
+        part.open().write(b"data")
+        part.keep()
+        self.assertEqual(part.get_request_headers(),
+                         {"Range": "bytes=4-",
+                          "If-Range": "Mon, 1 Jan 2024"})
+
+    def test_part_files_of_other_urls_are_ignored(self):
+        self.interrupt(b"data")
+        part = redditdownload.PartFile(self.directory, self.URL)
+        with open(part.meta_path, "w") as meta_file:
+            meta_file.write("{\"url\": \"http://x/other.jpg\", "
+                            "\"validator\": \"\\\"1\\\"\"}")
+        part = redditdownload.PartFile(self.directory, self.URL)
+        self.assertEqual(part.get_request_headers(), {})
+
+
+class SniffingTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = metrics.WorkerMetrics()
+        patcher = unittest.mock.patch.object(metrics, "worker_metrics",
+                                             self.metrics)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_needs_sniffing(self):
+        for content_type in (None, "application/octet-stream",
+                             "Binary/Octet-Stream; charset=x"):
+            self.assertTrue(redditdownload.needs_sniffing(
+                {"content-type": content_type}), msg=content_type)
+        self.assertFalse(redditdownload.needs_sniffing(
+            {"content-type": "image/png"}))
+        # Continued downloads keep their type.
+        self.assertFalse(redditdownload.needs_sniffing({}, offset=10))
+
+    def test_type_from_the_body(self):
+        for (head, extension) in ((b"\xff\xd8\xff\xe0\x00\x10JFIF", ".jpg"),
+                                  (b"\x89PNG\r\n\x1a\n\x00", ".png"),
+                                  (b"GIF89a\x01\x00", ".gif")):
+            self.assertEqual(redditdownload.check_response(
+                "http://x/file", {}, head), extension)
+
+    def test_type_from_the_headers(self):
+        self.assertEqual(redditdownload.check_response(
+            "http://x/a.png", {"content-type": "image/jpeg"}), ".jpg")
+
+    def test_rejected_bodies_are_not_transferred(self):
+        with self.assertRaises(redditdownload.WrongFileTypeException):
+            redditdownload.check_response(
+                "http://x/a.jpg", {"content-length": "1000"},
+                b"<!DOCTYPE html>")
+        with self.assertRaises(redditdownload.WrongFileTypeException):
+            redditdownload.check_response(
+                "http://x/page", {"content-type": "text/html"})
+        self.assertEqual(self.metrics.values["rejected"], 2)
+        self.assertEqual(self.metrics.values["rejected_bytes_avoided"],
+                         1000 - len(b"<!DOCTYPE html>"))
+
+    def test_read_head(self):
+        # Enough for the longest magic number, the PNG signature.
+        chunks = iter([b"GIF", b"8", b"9a\x01\x00", b"rest"])
+        self.assertEqual(redditdownload.read_head(chunks), b"GIF89a\x01\x00")
+        self.assertEqual(next(chunks), b"rest")
+        self.assertEqual(redditdownload.read_head(iter([b"GI"])), b"GI")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from RedditImageGrab import scheduler
+
+PICS = ("pics", "/tmp/pics")
+AWW = ("aww", "/tmp/aww")
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = scheduler.Scheduler(
+            request_rate=1.0, min_interval=60.0, max_interval=3600.0,
+            target_links=25, smoothing=0.5)
+
+    def poll(self, key, links, now):
+        self.scheduler.start(key, now)
+        self.scheduler.finish(key, links, now)
+
+    def get_interval(self, key):
+        return self.scheduler.get_interval(self.scheduler.states[key])
+
+    def test_new_subreddits_are_due_right_away(self):
+        self.scheduler.update([PICS, AWW], 0.0)
+        self.assertEqual(self.scheduler.get_due(0.0), [PICS, AWW])
+        self.assertEqual(self.scheduler.get_due(0.0, limit=1), [PICS])
+        self.scheduler.start(PICS, 0.0)
+        # Running polls are not due again.
+        self.assertEqual(self.scheduler.get_due(0.0), [AWW])
+
+    def test_interval_follows_the_post_rate(self):
+        self.scheduler.update([PICS], 0.0)
+        self.poll(PICS, 100, 0.0)
+        # The first poll sees the whole listing, the rate is still unknown.
+        self.assertIsNone(self.scheduler.states[PICS].rate)
+        self.assertEqual(self.scheduler.get_delay(0.0), 60.0)
+        # 50 new links in 100 seconds, 25 are expected after 50 seconds,
+        # which is below min_interval.
+        self.poll(PICS, 50, 100.0)
+        self.assertEqual(self.get_interval(PICS), 60.0)
+        # Averaged with 5 links in 1000 seconds.
+        self.poll(PICS, 5, 1100.0)
+        self.assertAlmostEqual(self.scheduler.states[PICS].rate, 0.2525)
+        self.assertAlmostEqual(self.get_interval(PICS), 25 / 0.2525)
+
+    def test_quiet_subreddits_are_polled_rarely(self):
+        self.scheduler.update([PICS], 0.0)
+        self.poll(PICS, 10, 0.0)
+        self.poll(PICS, 0, 60.0)
+        self.assertEqual(self.get_interval(PICS), 3600.0)
+        self.assertEqual(self.scheduler.get_due(3659.0), [])
+        self.assertEqual(self.scheduler.get_due(3660.0), [PICS])
+
+    def test_intervals_are_stretched_to_the_request_rate(self):
+        self.scheduler.request_rate = 1 / 30.0
+        keys = [("sub%d" % number, "/tmp") for number in range(4)]
+        self.scheduler.update(keys, 0.0)
+        # Four subreddits every 60 seconds would need a request every 15.
+        self.assertAlmostEqual(self.scheduler.stretch, 2.0)
+        self.assertAlmostEqual(self.get_interval(keys[0]), 120.0)
+        self.scheduler.update(keys[:2], 0.0)
+        self.assertEqual(self.scheduler.stretch, 1.0)
+
+    def test_removed_subreddits_finish_their_poll(self):
+        self.scheduler.update([PICS, AWW], 0.0)
+        self.scheduler.start(PICS, 0.0)
+        self.scheduler.update([AWW], 10.0)
+        self.assertIn(PICS, self.scheduler.states)
+        self.scheduler.finish(PICS, 3, 20.0)
+        self.assertNotIn(PICS, self.scheduler.states)
+        self.assertEqual(self.scheduler.get_due(20.0), [AWW])
+        # A subreddit added again while its poll runs is kept.
+        self.scheduler.start(AWW, 20.0)
+        self.scheduler.update([], 25.0)
+        self.scheduler.update([AWW], 26.0)
+        self.scheduler.finish(AWW, 3, 30.0)
+        self.assertEqual(self.scheduler.get_delay(30.0), 50.0)
+
+    def test_nothing_to_wait_for(self):
+        self.assertIsNone(self.scheduler.get_delay(0.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
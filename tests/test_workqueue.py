@@ -0,0 +1,133 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber@gmail.com>
+#
+# This file is part of reddit-download.
+#
+# reddit-download is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# reddit-download is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os.path
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+from RedditImageGrab import workqueue
+
+LEASE = 60.0
+
+
+class WorkQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="reddit-download-test-")
+        # The lease times are checked against a clock the test moves.
+        self.now = 1000.0
+        patcher = unittest.mock.patch.object(workqueue.time, "time",
+                                             lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.queue = self.open_queue()
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.directory)
+
+    def open_queue(self, max_attempts=workqueue.DEFAULT_MAX_ATTEMPTS):
+        return workqueue.WorkQueue(os.path.join(self.directory, "q.sqlite"),
+                                   lease=LEASE, max_attempts=max_attempts)
+
+    def expire(self):
+        self.now += LEASE + 1
+
+    def test_items_are_leased_in_order(self):
+        self.assertEqual(self.queue.put([{"a": 1}, ["b"]]), 2)
+        (first_id, first) = self.queue.lease("one")
+        (second_id, second) = self.queue.lease("two")
+        self.assertEqual((first, second), ({"a": 1}, ["b"]))
+        self.assertLess(first_id, second_id)
+        self.assertIsNone(self.queue.lease("three"))
+        self.assertFalse(self.queue.is_finished())
+
+    def test_only_the_owner_ends_a_lease(self):
+        self.queue.put(["a"])
+        (item_id, _) = self.queue.lease("one")
+        self.assertFalse(self.queue.complete(item_id, "two"))
+        self.assertFalse(self.queue.renew(item_id, "two"))
+        self.assertTrue(self.queue.renew(item_id, "one"))
+        self.assertTrue(self.queue.complete(item_id, "one"))
+        self.assertTrue(self.queue.is_finished())
+        self.assertEqual(self.queue.get_counts()[workqueue.DONE], 1)
+        # A completed item is not held anymore.
+        self.assertFalse(self.queue.complete(item_id, "one"))
+
+    def test_expired_leases_are_taken_over(self):
+        self.queue.put(["a"])
+        (item_id, _) = self.queue.lease("one")
+        self.now += LEASE - 1
+        self.assertIsNone(self.queue.lease("two"))
+        self.expire()
+        self.assertEqual(self.queue.lease("two"), (item_id, "a"))
+        # The first owner lost it.
+        self.assertFalse(self.queue.renew(item_id, "one"))
+        self.assertFalse(self.queue.complete(item_id, "one"))
+        self.assertTrue(self.queue.complete(item_id, "two"))
+
+    def test_renewing_keeps_the_lease(self):
+        self.queue.put(["a"])
+        (item_id, _) = self.queue.lease("one")
+        self.now += LEASE - 1
+        self.assertTrue(self.queue.renew(item_id, "one"))
+        self.now += LEASE - 1
+        self.assertIsNone(self.queue.lease("two"))
+
+    def test_items_fail_after_max_attempts(self):
+        self.queue.close()
+        self.queue = self.open_queue(max_attempts=2)
+        self.queue.put(["a", "b"])
+        (item_id, _) = self.queue.lease("one")
+        self.expire()
+        # The expired item comes first, it is older.
+        self.assertEqual(self.queue.lease("two"), (item_id, "a"))
+        self.expire()
+        (next_id, item) = self.queue.lease("three")
+        self.assertEqual(item, "b")
+        counts = self.queue.get_counts()
+        self.assertEqual(counts[workqueue.FAILED], 1)
+        self.assertEqual(counts[workqueue.LEASED], 1)
+        self.assertTrue(self.queue.complete(next_id, "three"))
+        self.assertTrue(self.queue.is_finished())
+
+    def test_release_does_not_count_as_attempt(self):
+        self.queue.close()
+        self.queue = self.open_queue(max_attempts=1)
+        self.queue.put(["a"])
+        for owner in ("one", "two", "three"):
+            (item_id, _) = self.queue.lease(owner)
+            self.assertTrue(self.queue.release(item_id, owner))
+            self.assertEqual(self.queue.get_counts()[workqueue.PENDING], 1)
+        (item_id, _) = self.queue.lease("four")
+        self.expire()
+        # The expired lease was the only attempt.
+        self.assertIsNone(self.queue.lease("five"))
+        self.assertEqual(self.queue.get_counts()[workqueue.FAILED], 1)
+        self.assertTrue(self.queue.is_finished())
+
+    def test_release_by_another_owner(self):
+        self.queue.put(["a"])
+        (item_id, _) = self.queue.lease("one")
+        self.assertFalse(self.queue.release(item_id, "two"))
+        self.assertEqual(self.queue.get_counts()[workqueue.LEASED], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()